@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from six.moves import BaseHTTPServer
 from six.moves import configparser as ConfigParser
 import gc
 import hashlib
@@ -28,6 +29,7 @@ import re
 import select
 import shutil
 from six.moves import reload_module
+from six.moves import socketserver
 import socket
 import string
 import subprocess
@@ -38,6 +40,7 @@ import time
 import git
 import gear
 import fixtures
+import paramiko
 import statsd
 import testtools
 from git import GitCommandError
@@ -53,6 +56,7 @@ import zuul.lib.swift
 import zuul.merger.client
 import zuul.merger.merger
 import zuul.merger.server
+import zuul.reporter.dispatcher
 import zuul.reporter.gerrit
 import zuul.reporter.github
 import zuul.reporter.smtp
@@ -444,9 +448,21 @@ class FakeGerritConnection(zuul.connection.gerrit.GerritConnection):
             return change.query()
         return {}
 
+    def queryChanges(self, numbers):
+        return [self.changes[int(number)].query() for number in numbers
+                if int(number) in self.changes]
+
     def simpleQuery(self, query):
         self.log.debug("simpleQuery: %s" % query)
         self.queries.append(query)
+        if ' OR ' in query:
+            l = []
+            for q in query.split(' OR '):
+                l.extend([r for r in self._simpleQuery(q) if r not in l])
+            return l
+        return self._simpleQuery(query)
+
+    def _simpleQuery(self, query):
         if query.startswith('change:'):
             # Query a specific changeid
             changeid = query[len('change:'):]
@@ -481,6 +497,306 @@ class FakeGerritConnection(zuul.connection.gerrit.GerritConnection):
         return os.path.join(self.upstream_root, project.name)
 
 
+class FakeGerritSSHServer(paramiko.ServerInterface):
+    """A local SSH server standing in for Gerrit's.
+
+    Any key is accepted.  Each command is recorded and passed to
+    handler, which returns the output (or a tuple of the output and
+    the error output) or raises an exception to fail the command;
+    unless it is released, the server holds each command
+    until the gate is set.
+    """
+    log = logging.getLogger("zuul.test.FakeGerritSSHServer")
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.commands = []
+        self.running = 0
+        self.max_running = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.lock = threading.Lock()
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self._stopped = False
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                client, addr = self.sock.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=self)
+            self.transports.append(transport)
+
+    def stop(self):
+        self._stopped = True
+        self.gate.set()
+        for transport in self.transports:
+            transport.close()
+        # Closing alone doesn't wake the thread waiting in accept()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.thread.join()
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._exec,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _exec(self, channel, command):
+        with self.lock:
+            self.commands.append(command)
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+        try:
+            # Give the transport a moment to acknowledge the request
+            # before any output is sent.
+            time.sleep(0.1)
+            self.gate.wait()
+            out = ''
+            if self.handler:
+                out = self.handler(command)
+            if isinstance(out, tuple):
+                out, err = out
+                channel.sendall_stderr(err)
+            channel.sendall(out)
+        except Exception as e:
+            channel.sendall_stderr('error: %s\n' % e)
+            status = 1
+        else:
+            status = 0
+        finally:
+            with self.lock:
+                self.running -= 1
+        channel.send_exit_status(status)
+        channel.close()
+
+
+class FakeGerritHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """A local stand-in for Gerrit's REST API, serving the changes of a
+    FakeGerritConnection.
+
+    Each request is recorded in requests, and each new HTTP connection
+    counted in connections.
+    """
+    daemon_threads = True
+
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+        self.requests = []
+        self.connections = 0
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeGerritHTTPHandler)
+        self.port = self.server_address[1]
+        self.url = 'http://127.0.0.1:%s' % self.port
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def queryChanges(self, query):
+        if ' OR ' in query:
+            changes = []
+            for q in query.split(' OR '):
+                changes.extend([c for c in self.queryChanges(q)
+                                if c not in changes])
+            return changes
+        changes = self.gerrit.changes.values()
+        if query.startswith('change:'):
+            query = query[len('change:'):]
+        if query.isdigit():
+            return [c for c in changes if c.number == int(query)]
+        if query.startswith('I'):
+            return [c for c in changes if c.data['id'] == query]
+        if query.startswith('message:'):
+            msg = query[len('message:'):].strip()
+            return [c for c in changes if msg in c.data['commitMessage']]
+        return changes
+
+    def formatTime(self, t):
+        return time.strftime('%Y-%m-%d %H:%M:%S.000000000', time.gmtime(t))
+
+    def formatChange(self, change):
+        data = change.data
+        current = data['currentPatchSet']['revision']
+        revisions = {}
+        for ps in change.patchsets:
+            rev = {'_number': int(ps['number']),
+                   'ref': ps['ref'],
+                   'files': dict([(f['file'], {}) for f in ps['files']
+                                  if f['file'] != '/COMMIT_MSG'])}
+            if ps['revision'] == current:
+                rev['commit'] = {'message': data['commitMessage'],
+                                 'parents': [{'commit': self.getParent(
+                                     change)}]}
+            revisions[ps['revision']] = rev
+        labels = {}
+        for name, low, high in change.categories.values():
+            labels[name] = {'all': []}
+        for approval in change.patchsets[-1]['approvals']:
+            name = change.categories[approval['type']][0]
+            vote = {'value': int(approval['value']),
+                    'date': self.formatTime(approval['grantedOn'])}
+            vote.update(approval['by'])
+            labels[name]['all'].append(vote)
+        for record in data['submitRecords']:
+            for label in record.get('labels', []):
+                if label['status'] == 'OK':
+                    labels[label['label']]['approved'] = {}
+                elif label['status'] == 'REJECT':
+                    labels[label['label']]['rejected'] = {}
+        return {'id': '%s~%s~%s' % (change.project, change.branch,
+                                    data['id']),
+                'project': change.project,
+                'branch': change.branch,
+                'change_id': data['id'],
+                'subject': data['subject'],
+                'status': data['status'],
+                '_number': change.number,
+                'owner': data['owner'],
+                'current_revision': current,
+                'revisions': revisions,
+                'labels': labels,
+                'submittable': data['submitRecords'][0]['status'] == 'OK'}
+
+    def getPatchset(self, change, ref):
+        return [ps for ps in change.patchsets if ps['ref'] == ref][0]
+
+    def getParent(self, change):
+        # The patchset of the change this one depends on
+        if change.depends_on_change:
+            ps = self.getPatchset(change.depends_on_change,
+                                  change.data['dependsOn'][0]['ref'])
+            return ps['revision']
+        return 'init'
+
+    def formatRelated(self, change):
+        related = []
+        if change.depends_on_change:
+            related.append((change.depends_on_change,
+                            change.data['dependsOn'][0]['ref']))
+        for needed in change.data.get('neededBy', []):
+            related.append((self.gerrit.changes[int(needed['number'])],
+                            needed['ref']))
+        ret = []
+        for other, ref in related:
+            ps = self.getPatchset(other, ref)
+            ret.append({
+                'change_id': other.data['id'],
+                '_change_number': other.number,
+                '_revision_number': int(ps['number']),
+                '_current_revision_number': other.latest_patchset,
+                'commit': {'commit': ps['revision'],
+                           'parents': [{'commit': self.getParent(other)}]}})
+        return {'changes': ret}
+
+
+class FakeGerritHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.getLogger("zuul.test.FakeGerritHTTPServer").debug(
+            format % args)
+
+    def _respond(self, data, content_type='application/json'):
+        if content_type == 'application/json':
+            data = ")]}'\n" + json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(('GET', self.path))
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        path = url.path
+        if path.startswith('/a/'):
+            path = path[2:]
+        if path == '/changes/':
+            results = [[server.formatChange(c)
+                        for c in server.queryChanges(q)]
+                       for q in params['q']]
+            if len(results) == 1:
+                results = results[0]
+            return self._respond(results)
+        m = re.match(r'/changes/(\d+)/revisions/current/related$', path)
+        if m:
+            change = server.gerrit.changes[int(m.group(1))]
+            return self._respond(server.formatRelated(change))
+        m = re.match(r'/(.*)/info/refs$', path)
+        if m:
+            data = '001e# service=git-upload-pack\n0000'
+            data += server.gerrit._uploadPack(m.group(1))
+            return self._respond(
+                data, 'application/x-git-upload-pack-advertisement')
+        self.send_error(404)
+
+    def do_POST(self):
+        server = self.server
+        server.requests.append(('POST', self.path))
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        path = self.path
+        if path.startswith('/a/'):
+            path = path[2:]
+        m = re.match(r'/changes/(\d+)/revisions/(\d+)/review$', path)
+        if m:
+            change = server.gerrit.changes[int(m.group(1))]
+            review = json.loads(body)
+            for label, value in review.get('labels', {}).items():
+                for cat, (name, low, high) in change.categories.items():
+                    if name == label:
+                        change.addApproval(cat, value,
+                                           username=server.gerrit.user)
+            change.messages.append(review.get('message'))
+            if review.get('message'):
+                change.setReported()
+            return self._respond({})
+        m = re.match(r'/changes/(\d+)/submit$', path)
+        if m:
+            server.gerrit.changes[int(m.group(1))].setMerged()
+            return self._respond({})
+        self.send_error(404)
+
+
 class GithubChangeReference(git.Reference):
     _common_path_default = "refs/pull"
     _points_to_commits_only = True
@@ -1286,6 +1602,7 @@ class ZuulTestCase(BaseTestCase):
         # the statsd client object is configured in the statsd module import
         reload_module(statsd)
         reload_module(zuul.scheduler)
+        reload_module(zuul.reporter.dispatcher)
 
         self.gearman_server = FakeGearmanServer()
 
@@ -1680,8 +1997,10 @@ class ZuulTestCase(BaseTestCase):
                 # Join ensures that the queue is empty _and_ events have been
                 # processed
                 self.eventQueuesJoin()
+                self.sched.report_dispatcher.join()
                 self.sched.run_handler_lock.acquire()
                 if (not self.merge_client.build_sets and
+                    self.sched.report_dispatcher.isIdle() and
                     all(self.eventQueuesEmpty()) and
                     self.haveAllBuildsReported() and
                     self.areAllBuildsWaiting()):
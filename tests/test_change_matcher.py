@@ -137,6 +137,40 @@ class TestMatchAllFiles(BaseTestMatcher):
     def test_matches_returns_true_when_single_file_matches(self):
         self._test_matches(True, files=['docs/foo'])
 
+    def test_regexes_combined(self):
+        self.assertIsNotNone(self.matcher.combined_regex)
+        matcher = cm.MatchAllFiles([cm.FileMatcher('(?i)^docs/.*$')])
+        # An inline flag would apply to the commit message regex too
+        self.assertIsNone(matcher.combined_regex)
+        self.change.files = ['/COMMIT_MSG', 'DOCS/foo']
+        self.assertTrue(matcher.matches(self.change))
+
+    def test_matches_cached_until_files_replaced(self):
+        self._test_matches(True, files=['docs/foo'])
+        self.change.files.append('foo/bar')
+        self._test_matches(True)
+        self._test_matches(False, files=['docs/foo', 'foo/bar'])
+
+
+class TestMatchAnyFiles(BaseTestMatcher):
+
+    def setUp(self):
+        super(TestMatchAnyFiles, self).setUp()
+        self.matcher = cm.MatchAnyFiles([cm.FileMatcher('^docs/.*$'),
+                                         cm.FileMatcher('^setup.py$')])
+
+    def test_matches_returns_true_when_any_file_matches(self):
+        self.change.files = ['/COMMIT_MSG', 'foo/bar', 'setup.py']
+        self.assertTrue(self.matcher.matches(self.change))
+
+    def test_matches_returns_false_when_no_file_matches(self):
+        self.change.files = ['/COMMIT_MSG', 'foo/bar']
+        self.assertFalse(self.matcher.matches(self.change))
+
+    def test_matches_returns_false_when_files_attr_missing(self):
+        delattr(self.change, 'files')
+        self.assertFalse(self.matcher.matches(self.change))
+
 
 class TestMatchAll(BaseTestMatcher):
 
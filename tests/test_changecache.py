@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import time
+
+import testtools
+
+from zuul.lib.changecache import ChangeCache
+from zuul.model import Change
+
+
+class TestChangeCache(testtools.TestCase):
+    log = logging.getLogger("zuul.test_changecache")
+
+    def _fill(self, cache, count):
+        changes = []
+        for x in range(count):
+            change = Change(None)
+            change.number = x
+            cache.set('%s,1' % x, change)
+            changes.append(change)
+        return changes
+
+    def test_hits_and_misses(self):
+        cache = ChangeCache('review', max_size=10)
+        change = self._fill(cache, 1)[0]
+        self.assertIs(change, cache.get('0,1'))
+        self.assertIsNone(cache.get('1,1'))
+        cache.delete('0,1')
+        self.assertIsNone(cache.get('0,1'))
+        self.assertEqual((1, 2, 0),
+                         (cache.hits, cache.misses, cache.evictions))
+
+    def test_lru_eviction(self):
+        cache = ChangeCache('review', max_size=3)
+        changes = self._fill(cache, 3)
+        # Nothing is evicted before maintenance, since it may be in
+        # use.
+        self._fill(cache, 5)
+        self.assertEqual(5, len(cache))
+
+        changes = self._fill(cache, 3)
+        cache.maintain([changes[0]])
+        self.assertEqual(3, len(cache))
+        # The oldest, 3,1 and 4,1, were evicted
+        self.assertEqual(['0,1', '1,1', '2,1'], cache.keys())
+        self.assertEqual(2, cache.evictions)
+
+        # Use 1,1 so that 2,1 is the least recently used, after the
+        # relevant 0,1
+        cache.get('1,1')
+        cache.maintain([changes[0]])
+        cache.set('5,1', Change(None))
+        self.assertEqual(['0,1', '1,1', '5,1'], cache.keys())
+
+    def test_ttl(self):
+        cache = ChangeCache('review', max_size=10, ttl=60)
+        changes = self._fill(cache, 3)
+        cache.maintain([])
+        self.assertEqual(3, len(cache))
+        # Pretend nothing has been used for an hour
+        for entry in cache._entries.values():
+            entry[1] -= 3600
+        cache.get('1,1')
+        cache.maintain([changes[2]])
+        self.assertEqual(['2,1', '1,1'], cache.keys())
+        self.assertTrue(time.time() - cache._entries['1,1'][1] < 60)
+
+    def test_prune(self):
+        cache = ChangeCache('review', max_size=10)
+        changes = self._fill(cache, 3)
+        cache.maintain([changes[1]], prune=True)
+        self.assertEqual(['1,1'], cache.keys())
+        self.assertEqual(2, cache.evictions)
@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+
+import fixtures
+import testtools
+
+from zuul.lib.eventjournal import EventJournal
+from zuul.model import TriggerEvent
+
+
+class TestEventJournal(testtools.TestCase):
+    log = logging.getLogger("zuul.test_eventjournal")
+
+    def setUp(self):
+        super(TestEventJournal, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'events.journal')
+
+    def _event(self, number):
+        event = TriggerEvent()
+        event.type = 'patchset-created'
+        event.project_name = 'org/project'
+        event.change_number = str(number)
+        event.patch_number = '1'
+        return event
+
+    def _numbers(self, events):
+        return [e.change_number for (sequence, e) in events]
+
+    def test_replay(self):
+        journal = EventJournal(self.path)
+        self.assertEqual([], journal.open())
+        sequences = [journal.append(self._event(x)) for x in range(5)]
+        journal.remove(sequences[1])
+        journal.remove(sequences[3])
+        # The journal is not closed, as if the process was killed
+        journal = EventJournal(self.path)
+        self.assertEqual(['0', '2', '4'], self._numbers(journal.open()))
+        sequence = journal.append(self._event(5))
+        self.assertTrue(sequence > sequences[-1])
+        journal.close()
+        journal = EventJournal(self.path)
+        self.assertEqual(['0', '2', '4', '5'], self._numbers(journal.open()))
+
+    def test_incomplete_record(self):
+        journal = EventJournal(self.path)
+        journal.open()
+        for x in range(3):
+            journal.append(self._event(x))
+        size = os.path.getsize(self.path)
+        journal.append(self._event(3))
+        with open(self.path, 'ab') as f:
+            f.truncate(size + 10)
+        journal = EventJournal(self.path)
+        self.assertEqual(['0', '1', '2'], self._numbers(journal.open()))
+        journal.append(self._event(4))
+        journal = EventJournal(self.path)
+        self.assertEqual(['0', '1', '2', '4'], self._numbers(journal.open()))
+
+    def test_compaction(self):
+        journal = EventJournal(self.path)
+        journal.compact_threshold = 10
+        journal.open()
+        journal.append(self._event('waiting'))
+        for x in range(9):
+            journal.remove(journal.append(self._event(x)))
+        size = os.path.getsize(self.path)
+        journal.remove(journal.append(self._event(9)))
+        # Only the waiting event is left
+        self.assertTrue(os.path.getsize(self.path) < size / 5)
+        self.assertEqual(0, journal.done)
+        journal = EventJournal(self.path)
+        self.assertEqual(['waiting'], self._numbers(journal.open()))
@@ -14,14 +14,27 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import os
+import threading
+import time
+
+import fixtures
+import paramiko
 
 try:
     from unittest import mock
 except ImportError:
     import mock
 
-from tests.base import BaseTestCase
-from zuul.connection.gerrit import GerritConnection
+from tests.base import (
+    BaseTestCase,
+    FakeGerritHTTPServer,
+    FakeGerritSSHServer,
+    ZuulTestCase,
+    iterate_timeout,
+)
+import zuul.exceptions
+from zuul.connection.gerrit import GerritConnection, GerritEventConnector
+from zuul.source.gerrit import GerritSource
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures/gerrit')
 
@@ -78,3 +91,316 @@ class TestGerrit(BaseTestCase):
                  'simple_query_pagination_old_3']
         expected_patches = 5
         self.run_query(files, expected_patches)
+
+
+class TestGerritSSHPool(BaseTestCase):
+
+    def setUp(self):
+        super(TestGerritSSHPool, self).setUp()
+        self.server = FakeGerritSSHServer()
+        self.addCleanup(self.server.stop)
+        key = paramiko.RSAKey.generate(1024)
+        keyfile = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                               'id_rsa')
+        key.write_private_key_file(keyfile)
+        self.gerrit = GerritConnection('review_gerrit', {
+            'user': 'gerrit',
+            'server': '127.0.0.1',
+            'port': self.server.port,
+            'sshkey': keyfile,
+            'ssh_channels': 2,
+        })
+        self.addCleanup(self.gerrit.ssh_pool.close)
+        self.results = {}
+
+    def _review(self, change, message, action={'verified': 1}):
+        def review():
+            try:
+                self.results[change] = self.gerrit.review(
+                    'org/project', change, message, action)
+            except Exception as e:
+                self.results[change] = e
+        thread = threading.Thread(target=review)
+        thread.start()
+        return thread
+
+    def _waitFor(self, check):
+        for x in range(100):
+            if check():
+                return
+            time.sleep(0.1)
+        raise Exception("Timeout waiting for %s" % check)
+
+    def test_ssh_channels(self):
+        self.server.gate.clear()
+        threads = [self._review('%s,1' % x, 'message %s' % x)
+                   for x in range(4)]
+        self._waitFor(lambda: self.server.running == 2)
+        self.assertEqual(2, self.gerrit.ssh_pool.in_use)
+        self.server.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(self.server.commands))
+        self.assertEqual(2, self.server.max_running)
+        self.assertEqual(0, self.gerrit.ssh_pool.in_use)
+
+    def test_reviews_batched(self):
+        self.server.gate.clear()
+        # Use up both channels
+        threads = [self._review('%s,1' % x, 'first %s' % x)
+                   for x in range(2)]
+        self._waitFor(lambda: self.server.running == 2)
+        threads += [self._restore('%s,1' % x) for x in range(2, 6)]
+        self._waitForPending(4)
+        self.server.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(self.server.commands))
+        batched = [c for c in self.server.commands if '--restore' in c]
+        self.assertEqual(1, len(batched))
+        for x in range(2, 6):
+            self.assertIn(' %s,1' % x, batched[0])
+        self.assertEqual({}, self.gerrit._pending_reviews)
+
+    def _restore(self, change):
+        return self._review(change, None, {'restore': True})
+
+    def _waitForPending(self, count):
+        self._waitFor(lambda: len(
+            self.gerrit._pending_reviews.get(
+                ('org/project', None, (('restore', True),)), [])) == count)
+
+    def _holdChannels(self):
+        self.server.gate.clear()
+        threads = [self._review('%s,1' % x, 'first %s' % x)
+                   for x in range(2)]
+        self._waitFor(lambda: self.server.running == 2)
+        return threads
+
+    def test_failed_batch_resent(self):
+        def handler(command):
+            if ' 3,1 ' in command + ' ':
+                raise Exception("change 3,1 is closed")
+            return ''
+        self.server.handler = handler
+        threads = self._holdChannels()
+        threads += [self._restore('%s,1' % x) for x in range(2, 6)]
+        self._waitForPending(4)
+        self.server.gate.set()
+        for thread in threads:
+            thread.join()
+        # The batch, then each of its reviews on its own
+        self.assertEqual(7, len(self.server.commands))
+        self.assertIsInstance(self.results.pop('3,1'), Exception)
+        for change, err in self.results.items():
+            self.assertEqual('', err, change)
+
+    def test_batch_output_returned(self):
+        self.server.handler = lambda command: ('', 'warning\n')
+        threads = self._holdChannels()
+        threads += [self._restore('%s,1' % x) for x in range(2, 4)]
+        self._waitForPending(2)
+        self.server.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(self.server.commands))
+        for x in range(2, 4):
+            self.assertEqual('warning\n', self.results['%s,1' % x])
+
+    def _sendUnbatched(self, message, action):
+        acquired = []
+        orig_acquire = self.gerrit.ssh_pool.acquire
+
+        def acquire():
+            acquired.append(True)
+            orig_acquire()
+        self.gerrit.ssh_pool.acquire = acquire
+        threads = self._holdChannels()
+        threads += [self._review('%s,1' % x, message, action)
+                    for x in range(2, 4)]
+        self._waitFor(lambda: len(acquired) == 4)
+        self.assertEqual({}, self.gerrit._pending_reviews)
+        self.server.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(self.server.commands))
+        for command in self.server.commands[2:]:
+            self.assertEqual(1, len([x for x in range(2, 4)
+                                     if ' %s,1' % x in command]))
+        return self.server.commands[2:]
+
+    def test_votes_not_batched(self):
+        self._sendUnbatched('second', {'verified': 1})
+
+    def test_submit_not_batched(self):
+        for command in self._sendUnbatched(None, {'submit': True}):
+            self.assertIn('--submit', command)
+
+
+class TestGerritHTTP(ZuulTestCase):
+
+    def setUp(self):
+        super(TestGerritHTTP, self).setUp()
+        self.server = FakeGerritHTTPServer(self.fake_gerrit)
+        self.addCleanup(self.server.stop)
+        self.gerrit = GerritConnection('review_gerrit', {
+            'user': 'gerrit',
+            'server': '127.0.0.1',
+            'baseurl': self.server.url,
+            'backend': 'http',
+        })
+
+    def test_query(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        A.addPatchset(['file1.txt'])
+        A.addApproval('CRVW', 2)
+        expected = self.fake_gerrit.query(A.number)
+        data = self.gerrit.query(A.number)
+        for key in ['id', 'number', 'project', 'branch', 'status', 'open',
+                    'owner', 'commitMessage']:
+            self.assertEqual(expected[key], data[key])
+        self.assertEqual(
+            [(ps['number'], ps['ref'], ps['revision'],
+              sorted([f['file'] for f in ps['files']]))
+             for ps in expected['patchSets']],
+            [(ps['number'], ps['ref'], ps['revision'],
+              sorted([f['file'] for f in ps['files']]))
+             for ps in data['patchSets']])
+        self.assertEqual(expected['currentPatchSet']['number'],
+                         data['currentPatchSet']['number'])
+        approvals = data['currentPatchSet']['approvals']
+        self.assertEqual(1, len(approvals))
+        self.assertEqual('Code-Review', approvals[0]['description'])
+        self.assertEqual('2', approvals[0]['value'])
+        self.assertEqual('reviewer_john', approvals[0]['by']['username'])
+        self.assertEqual('NOT_READY', data['submitRecords'][0]['status'])
+
+    def test_update_change(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project', 'master', 'B')
+        C = self.fake_gerrit.addFakeChange('org/project1', 'master', 'C')
+        B.setDependsOn(A, 1)
+        # C Depends-On: B
+        C.data['commitMessage'] = '%s\n\nDepends-On: %s\n' % (
+            C.subject, B.data['id'])
+        source = GerritSource({}, self.sched, self.gerrit)
+        change = source._getChange(str(B.number), '1')
+        self.assertEqual([A.number],
+                         [int(c.number) for c in change.needs_changes])
+        self.assertEqual([C.number],
+                         [int(c.number) for c in change.needed_by_changes])
+        self.assertEqual(1, self.server.connections)
+
+    def test_batched_dependencies(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        deps = [self.fake_gerrit.addFakeChange('org/project1', 'master', x)
+                for x in 'BCDE']
+        # A Depends-On: B, C, D, E
+        A.data['commitMessage'] = '%s\n\n%s\n' % (
+            A.subject, '\n'.join(['Depends-On: %s' % d.data['id']
+                                  for d in deps]))
+        source = GerritSource({}, self.sched, self.gerrit)
+        change = source._getChange(str(A.number), '1')
+        self.assertEqual([d.number for d in deps],
+                         [int(c.number) for c in change.needs_changes])
+        # For each of the two levels: one query for the changes, the
+        # related changes of each, and one request for the Depends-On
+        # and needed-by searches.
+        self.assertEqual(9, len(self.server.requests))
+
+    def test_depends_on_case(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        # A Depends-On: B, with the Change-Id in upper case
+        A.data['commitMessage'] = '%s\n\nDepends-On: %s\n' % (
+            A.subject, B.data['id'].upper())
+        source = GerritSource({}, self.sched, self.gerrit)
+        change = source._getChange(str(A.number), '1')
+        self.assertEqual([B.number],
+                         [int(c.number) for c in change.needs_changes])
+
+    def test_simple_queries(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project', 'master', 'B')
+        results = self.gerrit.simpleQueries(
+            ['change:%s' % A.data['id'], 'change:%s' % B.data['id']])
+        self.assertEqual([[str(A.number)], [str(B.number)]],
+                         [[r['number'] for r in result]
+                          for result in results])
+        self.assertEqual('1', results[0][0]['currentPatchSet']['number'])
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_review(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        self.gerrit.review('org/project', '%s,1' % A.number, 'Works',
+                           {'verified': 2, 'submit': True})
+        self.assertEqual(['Works'], A.messages)
+        self.assertEqual('2', A.patchsets[-1]['approvals'][0]['value'])
+        self.assertEqual('MERGED', A.data['status'])
+
+    def test_unreachable_review_not_sent(self):
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        self.server.stop()
+        self.assertRaises(zuul.exceptions.RequestNotSent,
+                          self.gerrit.review, 'org/project',
+                          '%s,1' % A.number, 'Works', {'verified': 2})
+
+    def test_info_refs(self):
+        refs = self.gerrit.getInfoRefs('org/project')
+        self.assertEqual(self.fake_gerrit.getInfoRefs('org/project'), refs)
+        self.assertIn('refs/heads/master', refs)
+
+
+class TestGerritEventConnector(ZuulTestCase):
+
+    def test_prefetch_ordered_and_coalesced(self):
+        "Test that events are delivered in order after refreshes"
+        # Use a single prefetch worker so that the refreshes queue up
+        # behind the first one.
+        self.fake_gerrit._stop_event_connector()
+        connector = GerritEventConnector(self.fake_gerrit, 1)
+        self.fake_gerrit.gerrit_event_connector = connector
+        connector.start()
+
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project', 'master', 'B')
+        source = self.fake_gerrit.attached_to['source'][0]
+        get_change = source._getChange
+        release = threading.Event()
+        refreshed = []
+        delivered = []
+
+        def slow_get_change(number, patchset, refresh=False, *args,
+                            **kw):
+            if refresh:
+                refreshed.append(number)
+                release.wait()
+            return get_change(number, patchset, refresh, *args, **kw)
+
+        add_event = self.sched.addEvent
+
+        def record_event(event):
+            delivered.append(event.change_number)
+            return add_event(event)
+
+        self.patch(source, '_getChange', slow_get_change)
+        self.patch(self.sched, 'addEvent', record_event)
+        for change in [A, B, B, A]:
+            self.fake_gerrit.addEvent(change.getChangeCommentEvent(1))
+        # The delivery thread is waiting for A's refresh, and the
+        # others are queued behind it.
+        for x in iterate_timeout(10, 'events to be queued'):
+            if connector._delivery_queue.qsize() == 3:
+                break
+        self.assertEqual([], delivered)
+        release.set()
+        self.waitUntilSettled()
+
+        numbers = [str(A.number), str(B.number), str(B.number),
+                   str(A.number)]
+        self.assertEqual(numbers, delivered)
+        # B's second event shared the refresh of its first, but A's
+        # second event arrived while A was being refreshed.
+        self.assertEqual(1, connector.coalesced)
+        self.assertEqual([str(A.number), str(B.number), str(A.number)],
+                         refreshed)
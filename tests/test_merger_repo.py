@@ -17,10 +17,15 @@
 
 import logging
 import os
+import shutil
+import threading
 
+import fixtures
 import git
 
-from zuul.merger.merger import Repo
+import zuul.model
+from zuul.merger.merger import InProcessRepo, MergeCache, Merger, Repo
+from zuul.merger.merger import reset_repo_to_head
 from tests.base import ZuulTestCase
 
 logging.basicConfig(level=logging.DEBUG,
@@ -32,6 +37,7 @@ class TestMergerRepo(ZuulTestCase):
 
     log = logging.getLogger("zuul.test.merger.repo")
     workspace_root = None
+    repo_class = Repo
 
     def setUp(self):
         super(TestMergerRepo, self).setUp()
@@ -51,8 +57,8 @@ class TestMergerRepo(ZuulTestCase):
             os.path.join(parent_path, 'subdir', '.git')),
             msg='.git file in submodule should be a file')
 
-        work_repo = Repo(parent_path, self.workspace_root,
-                         'none@example.org', 'User Name')
+        work_repo = self.repo_class(parent_path, self.workspace_root,
+                                    'none@example.org', 'User Name')
         self.assertTrue(
             os.path.isdir(os.path.join(self.workspace_root, 'subdir')),
             msg='Cloned repository has a submodule placeholder directory')
@@ -60,7 +66,7 @@ class TestMergerRepo(ZuulTestCase):
             os.path.join(self.workspace_root, 'subdir', '.git')),
             msg='Submodule is not initialized')
 
-        sub_repo = Repo(
+        sub_repo = self.repo_class(
             os.path.join(self.upstream_root, 'org/project2'),
             os.path.join(self.workspace_root, 'subdir'),
             'none@example.org', 'User Name')
@@ -77,3 +83,342 @@ class TestMergerRepo(ZuulTestCase):
             os.path.join(self.upstream_root, 'org/project2'),
             sub_repo.createRepoObject().remotes[0].url,
             message="Sub repository points to upstream project2")
+
+    def test_repo_handle(self):
+        "Test that the git.Repo is kept until it is invalidated"
+        url = os.path.join(self.upstream_root, 'org/project1')
+        work_repo = self.repo_class(url, self.workspace_root,
+                                    'none@example.org', 'User Name')
+        repo = work_repo.createRepoObject()
+        self.assertIs(repo, work_repo.createRepoObject())
+        work_repo.invalidate()
+        self.assertIsNot(repo, work_repo.createRepoObject())
+
+        # A corrupt repo is cloned again
+        repo = work_repo.createRepoObject()
+        os.unlink(os.path.join(repo.git_dir, 'HEAD'))
+        work_repo.invalidate()
+        self.assertTrue(work_repo.createRepoObject().head.is_valid())
+        self.assertTrue(work_repo.hasBranch('master'))
+
+        # So is one which has been removed
+        shutil.rmtree(self.workspace_root)
+        self.assertTrue(work_repo.createRepoObject().head.is_valid())
+        self.assertTrue(work_repo.hasBranch('master'))
+
+    def test_user_config(self):
+        "Test that the user config is only written when it changes"
+        url = os.path.join(self.upstream_root, 'org/project1')
+        work_repo = self.repo_class(url, self.workspace_root,
+                                    'none@example.org', 'User Name')
+        repo = work_repo.createRepoObject()
+        reader = repo.config_reader('repository')
+        self.assertEqual('none@example.org',
+                         reader.get_value('user', 'email'))
+        self.assertEqual('User Name', reader.get_value('user', 'name'))
+        config = os.path.join(repo.git_dir, 'config')
+        os.utime(config, (0, 0))
+        self.repo_class(url, self.workspace_root,
+                        'none@example.org', 'User Name')
+        self.assertEqual(0, os.stat(config).st_mtime)
+        self.repo_class(url, self.workspace_root,
+                        'zuul@example.org', 'User Name')
+        self.assertNotEqual(0, os.stat(config).st_mtime)
+        reader = repo.config_reader('repository')
+        self.assertEqual('zuul@example.org',
+                         reader.get_value('user', 'email'))
+
+
+class TestInProcessMergerRepo(TestMergerRepo):
+    repo_class = InProcessRepo
+
+    def test_ensure_cloned(self):
+        parent_path = os.path.join(self.upstream_root, 'org/project1')
+        work_repo = self.repo_class(parent_path, self.workspace_root,
+                                    'none@example.org', 'User Name')
+        self.assertTrue(os.path.isdir(os.path.join(self.workspace_root,
+                                                   'objects')),
+                        msg='Cloned repository is bare')
+        self.assertFalse(os.path.exists(os.path.join(self.workspace_root,
+                                                     'README')),
+                         msg='Cloned repository has no working tree')
+        repo = work_repo.createRepoObject()
+        self.assertEquals(parent_path, repo.remotes[0].url,
+                          message="Clone points to upstream project1")
+        self.assertEqual(git.Repo(parent_path).heads.master.commit,
+                         repo.remotes.origin.refs.master.commit)
+        self.assertEqual(repo.remotes.origin.refs.master.commit,
+                         work_repo.getBranchHead('master'))
+
+
+class TestMerger(ZuulTestCase):
+
+    log = logging.getLogger("zuul.test.merger")
+    backend = 'git'
+
+    def setUp(self):
+        super(TestMerger, self).setUp()
+        self.workspace_root = os.path.join(self.test_root, 'workspace')
+        self.merger = Merger(self.workspace_root, {}, 'none@example.org',
+                             'User Name', self.backend)
+        self.addCleanup(self.merger.closeRepos)
+
+    def _item(self, change, ref='Z',
+              mode=zuul.model.MERGER_MERGE_RESOLVE):
+        # Each item has its own build set, and so its own zuul ref
+        return dict(project=change.project,
+                    url=os.path.join(self.upstream_root, change.project),
+                    connection_name='gerrit',
+                    merge_mode=mode,
+                    refspec=change.patchsets[-1]['ref'],
+                    branch=change.branch,
+                    ref='%s%s' % (ref, change.number),
+                    number=change.number,
+                    patchset=change.latest_patchset)
+
+    def _files(self, project, commit):
+        repo = self.merger.getRepo(project, None).createRepoObject()
+        return sorted(b.path for b in repo.commit(commit).tree.traverse())
+
+    def test_merge_changes(self):
+        "Test that changes are merged on top of each other"
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        for mode in (zuul.model.MERGER_MERGE,
+                     zuul.model.MERGER_MERGE_RESOLVE):
+            items = [self._item(A, 'Z%s' % mode, mode),
+                     self._item(B, 'Z%s' % mode, mode)]
+            commit = self.merger.mergeChanges(items)
+            self.assertEqual(['README', 'master-1', 'master-2'],
+                             self._files('org/project1', commit))
+            repo = self.merger.getRepo('org/project1', None)
+            merge = repo.createRepoObject().commit(commit)
+            self.assertEqual(2, len(merge.parents))
+            self.assertEqual(B.patchsets[-1]['revision'],
+                             merge.parents[1].hexsha)
+            self.assertEqual(merge,
+                             repo.getCommitFromRef('master/Z%s2' % mode))
+            # The merge is found again rather than made twice
+            self.assertEqual(commit, self.merger.mergeChanges(items))
+
+    def test_merge_cache(self):
+        "Test that changes merged onto the same commit are merged once"
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        merged = []
+        merge_change = self.merger._mergeChange
+
+        def record(item, ref):
+            merged.append(item['ref'])
+            return merge_change(item, ref)
+        self.useFixture(fixtures.MonkeyPatch(
+            'zuul.merger.merger.Merger._mergeChange',
+            lambda merger, item, ref: record(item, ref)))
+
+        commit = self.merger.mergeChanges([self._item(A, 'X'),
+                                           self._item(B, 'X')])
+        self.assertEqual(['X1', 'X2'], merged)
+        # As after a gate reset, the same changes get new zuul refs
+        self.assertEqual(commit, self.merger.mergeChanges(
+            [self._item(A, 'Y'), self._item(B, 'Y')]))
+        self.assertEqual(['X1', 'X2'], merged)
+        repo = self.merger.getRepo('org/project1', None)
+        self.assertEqual(commit, repo.getCommitFromRef('master/Y2').hexsha)
+        self.assertEqual(repo.getCommitFromRef('master/X1'),
+                         repo.getCommitFromRef('master/Y1'))
+
+        # A new patchset is merged again, as is what is merged onto it
+        A.addPatchset()
+        self.assertNotEqual(commit, self.merger.mergeChanges(
+            [self._item(A, 'Z'), self._item(B, 'Z')]))
+        self.assertEqual(['X1', 'X2', 'Z1', 'Z2'], merged)
+
+    def test_merge_cache_eviction(self):
+        "Test that the least recently used merges are forgotten"
+        cache = MergeCache(2)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        self.assertEqual('1', cache.get('a'))
+        cache.put('c', '3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('1', cache.get('a'))
+        self.assertEqual('3', cache.get('c'))
+
+    def test_zuul_ref_lifetime(self):
+        "Test that old zuul refs are deleted"
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        self.merger.mergeChanges([self._item(A, 'X')])
+        repo = self.merger.getRepo('org/project1', None)
+        self.assertIsNotNone(repo.getCommitFromRef('master/X1'))
+
+        self.merger.zuul_ref_lifetime = 3600
+        self.merger.zuul_refs['org/project1']['master/X1'] -= 7200
+        self.merger.mergeChanges([self._item(A, 'Y'), self._item(B, 'Y')])
+        self.assertIsNone(repo.getCommitFromRef('master/X1'))
+        self.assertIsNotNone(repo.getCommitFromRef('master/Y1'))
+        self.assertIsNotNone(repo.getCommitFromRef('master/Y2'))
+        self.assertEqual(['master/Y1', 'master/Y2'],
+                         list(self.merger.zuul_refs['org/project1']))
+
+    def _commit(self, project, parent, ref, files):
+        path = os.path.join(self.upstream_root, project)
+        repo = git.Repo(path)
+        repo.head.reference = repo.commit(parent)
+        reset_repo_to_head(repo)
+        for name, content in files.items():
+            with open(os.path.join(path, name), 'w') as f:
+                f.write(content)
+            repo.index.add([name])
+        commit = repo.index.commit(ref)
+        git.Reference.create(repo, ref, commit, force=True)
+        repo.head.reference = 'master'
+        reset_repo_to_head(repo)
+        return commit
+
+    def test_merge_file_content(self):
+        "Test that changes to different lines of a file are merged"
+        lines = ['line %s\n' % x for x in range(10)]
+        base = self._commit('org/project1', 'master', 'refs/heads/master',
+                            {'numbers': ''.join(lines)})
+        self._commit('org/project1', base, 'refs/changes/99/1/1',
+                     {'numbers': ''.join(['one\n'] + lines[1:])})
+        self._commit('org/project1', base, 'refs/changes/99/2/1',
+                     {'numbers': ''.join(lines[:9] + ['ten\n'])})
+        url = os.path.join(self.upstream_root, 'org/project1')
+        items = []
+        for x in range(1, 3):
+            items.append(dict(project='org/project1', url=url,
+                              connection_name='gerrit',
+                              merge_mode=zuul.model.MERGER_MERGE_RESOLVE,
+                              refspec='refs/changes/99/%s/1' % x,
+                              branch='master', ref='Z%s' % x,
+                              number=x, patchset=1))
+        commit = self.merger.mergeChanges(items)
+        repo = self.merger.getRepo('org/project1', None).createRepoObject()
+        data = repo.commit(commit).tree['numbers'].data_stream.read()
+        self.assertEqual(''.join(['one\n'] + lines[1:9] + ['ten\n']),
+                         data.decode('utf-8'))
+
+    def test_merge_conflict(self):
+        "Test that changes to the same file conflict"
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        A.addPatchset(['conflict'])
+        B.addPatchset(['conflict'])
+        self.assertIsNone(self.merger.mergeChanges([self._item(A),
+                                                    self._item(B)]))
+        # The merger is still usable afterwards
+        commit = self.merger.mergeChanges([self._item(B, ref='Z2')])
+        self.assertEqual(['README', 'conflict'],
+                         self._files('org/project1', commit))
+
+    def test_cherry_pick(self):
+        "Test that changes are cherry-picked on top of each other"
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        mode = zuul.model.MERGER_CHERRY_PICK
+        commit = self.merger.mergeChanges([self._item(A, mode=mode),
+                                           self._item(B, mode=mode)])
+        self.assertEqual(['README', 'master-1', 'master-2'],
+                         self._files('org/project1', commit))
+        repo = self.merger.getRepo('org/project1', None)
+        pick = repo.createRepoObject().commit(commit)
+        change = repo.createRepoObject().commit(B.patchsets[-1]['revision'])
+        self.assertEqual(1, len(pick.parents))
+        self.assertEqual(change.message, pick.message)
+        self.assertEqual(change.author, pick.author)
+        self.assertEqual(change.authored_date, pick.authored_date)
+        self.assertEqual(['README', 'master-1'],
+                         self._files('org/project1', pick.parents[0]))
+
+    def test_git_ssh_per_repo(self):
+        "Test that GIT_SSH is given to the git commands of each repo"
+        self.merger._makeSSHWrapper('/dev/null', self.workspace_root,
+                                    'review')
+        env = self.merger._getGitEnv('review')
+        self.assertEqual(
+            os.path.join(self.workspace_root, '.ssh_wrapper_review'),
+            env['GIT_SSH'])
+        self.assertEqual({}, self.merger._getGitEnv('other'))
+
+        url = os.path.join(self.upstream_root, 'org/project1')
+        repo = self.merger.getRepo('org/project1', url, env)
+        git_env = repo.createRepoObject().git.environment()
+        self.assertEqual(env['GIT_SSH'], git_env['GIT_SSH'])
+        self.assertNotEqual(env['GIT_SSH'], os.environ.get('GIT_SSH'))
+
+    def test_git_ssh_changed(self):
+        "Test that a repo which is already open picks up a new GIT_SSH"
+        url = os.path.join(self.upstream_root, 'org/project1')
+        repo = self.merger.getRepo('org/project1', url)
+        handle = repo.createRepoObject()
+        self.assertNotIn('GIT_SSH', handle.git.environment())
+
+        env = {'GIT_SSH': '/tmp/ssh_wrapper'}
+        self.merger.getRepo('org/project1', url, env)
+        self.assertIs(handle, repo.createRepoObject())
+        self.assertEqual('/tmp/ssh_wrapper',
+                         handle.git.environment()['GIT_SSH'])
+
+        self.merger.getRepo('org/project1', url, {})
+        self.assertNotIn('GIT_SSH', handle.git.environment())
+
+    def test_repo_locks(self):
+        "Test that only jobs using the same repo wait for each other"
+        url1 = os.path.join(self.upstream_root, 'org/project1')
+        url2 = os.path.join(self.upstream_root, 'org/project2')
+        self.merger.getRepo('org/project1', url1)
+        self.merger.getRepo('org/project2', url2)
+        updated = []
+
+        def update(project, url):
+            self.merger.updateRepo(project, url)
+            updated.append(project)
+
+        lock = self.merger.getRepoLock('org/project1')
+        # The lock may be acquired again by the thread holding it
+        with lock:
+            with self.merger.getRepoLock('org/project1'):
+                pass
+            t1 = threading.Thread(target=update,
+                                  args=('org/project1', url1))
+            t2 = threading.Thread(target=update,
+                                  args=('org/project2', url2))
+            t1.start()
+            t2.start()
+            t2.join()
+            self.assertEqual(['org/project2'], updated)
+            self.assertTrue(t1.is_alive())
+        t1.join()
+        self.assertEqual(['org/project2', 'org/project1'], updated)
+
+
+class TestInProcessMerger(TestMerger):
+    backend = 'inprocess'
+
+    def test_merge_in_process(self):
+        "Test that changes are fetched at once and merged without git"
+        commands = []
+        execute = git.cmd.Git.execute
+
+        def record(git_self, command, *args, **kw):
+            commands.append(command[1])
+            return execute(git_self, command, *args, **kw)
+        self.useFixture(fixtures.MonkeyPatch('git.cmd.Git.execute', record))
+
+        A = self.fake_gerrit.addFakeChange('org/project1', 'master', 'A')
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        C = self.fake_gerrit.addFakeChange('org/project1', 'master', 'C')
+        url = os.path.join(self.upstream_root, 'org/project1')
+        self.merger.getRepo('org/project1', url)
+        del commands[:]
+        commit = self.merger.mergeChanges([self._item(A), self._item(B),
+                                           self._item(C)])
+        self.assertEqual(['README', 'master-1', 'master-2', 'master-3'],
+                         self._files('org/project1', commit))
+        self.assertNotIn('merge', commands)
+        self.assertNotIn('reset', commands)
+        self.assertNotIn('checkout', commands)
+        # One fetch to update the repo, one for all of the changes
+        self.assertEqual(2, commands.count('fetch'))
@@ -14,6 +14,8 @@
 
 import os
 import random
+import re
+import time
 
 import fixtures
 
@@ -79,6 +81,213 @@ class TestJob(BaseTestCase):
         self._assert_job_booleans_are_not_none(job)
 
 
+class TestPipelineJobs(BaseTestCase):
+
+    def _makeQueue(self, items, jobs):
+        pipeline = model.Pipeline('gate')
+        project = model.Project('project')
+        tree = pipeline.addProject(project)
+        for x in range(jobs):
+            job = model.Job('job%s' % x)
+            job._files = ['^dir%s/.*$' % (x % 10)]
+            job.files = [re.compile(f) for f in job._files]
+            job.skip_if_matcher = cm.MatchAny([cm.MatchAllFiles(
+                [cm.FileMatcher('^doc/.*$')])])
+            tree.addJob(job)
+        queue = model.ChangeQueue(pipeline)
+        queue.addProject(project)
+        for x in range(items):
+            change = model.Change(project)
+            change.number = x
+            change.patchset = 1
+            change.branch = 'master'
+            change.files = ['/COMMIT_MSG', 'dir%s/file' % (x % 10),
+                            'doc/README']
+            queue.enqueueChange(change)
+        return pipeline, queue
+
+    def _checkStatus(self, pipeline, queue):
+        for item in queue.queue:
+            pipeline.haveAllJobsStarted(item)
+            pipeline.areAllJobsComplete(item)
+            pipeline.didAllJobsSucceed(item)
+            pipeline.didAnyJobFail(item)
+            pipeline.isHoldingFollowingChanges(item)
+
+    def test_get_jobs_cached(self):
+        pipeline, queue = self._makeQueue(200, 50)
+        calls = []
+        orig_matches = model.Job.changeMatches
+
+        def changeMatches(job, change):
+            calls.append(job)
+            return orig_matches(job, change)
+        self.useFixture(fixtures.MonkeyPatch(
+            'zuul.model.Job.changeMatches', changeMatches))
+
+        jobs = [pipeline.getJobs(item) for item in queue.queue]
+        for x in range(5):
+            self._checkStatus(pipeline, queue)
+        # Each job is only matched against each change once.
+        self.assertEqual(len(calls), 200 * 50)
+        for item, item_jobs in zip(queue.queue, jobs):
+            self.assertIs(pipeline.getJobs(item), item_jobs)
+            self.assertEqual(len(item_jobs), 5)
+
+    def test_get_jobs_cache_invalidated(self):
+        pipeline, queue = self._makeQueue(1, 10)
+        item = queue.queue[0]
+        self.assertEqual([j.name for j in pipeline.getJobs(item)],
+                         ['job0'])
+        # The source replaces the file list when a change is updated
+        item.change.files = ['dir1/file']
+        self.assertEqual([j.name for j in pipeline.getJobs(item)],
+                         ['job1'])
+        # A reconfiguration creates a new job tree
+        tree = pipeline.addProject(item.change.project)
+        tree.addJob(model.Job('new-job'))
+        self.assertEqual([j.name for j in pipeline.getJobs(item)],
+                         ['new-job'])
+        item.live = False
+        self.assertEqual(pipeline.getJobs(item), [])
+
+    def _status(self, pipeline, item):
+        return (pipeline.haveAllJobsStarted(item),
+                pipeline.areAllJobsComplete(item),
+                pipeline.didAllJobsSucceed(item),
+                pipeline.didAnyJobFail(item))
+
+    def test_build_set_counters(self):
+        pipeline, queue = self._makeQueue(1, 0)
+        item = queue.queue[0]
+        tree = pipeline.getJobTree(item.change.project)
+        for name in ['voting1', 'voting2', 'nonvoting']:
+            tree.addJob(model.Job(name))
+        tree.getJobs()[2].voting = False
+        builds = {}
+        for job in pipeline.getJobs(item):
+            builds[job.name] = model.Build(job, job.name)
+            item.addBuild(builds[job.name])
+        build_set = item.current_build_set
+        self.assertEqual(self._status(pipeline, item),
+                         (False, False, False, False))
+        self.assertEqual(build_set.pending, 3)
+
+        for build in builds.values():
+            build.start_time = time.time()
+        self.assertEqual(self._status(pipeline, item),
+                         (True, False, False, False))
+
+        builds['nonvoting'].result = 'FAILURE'
+        builds['voting1'].result = 'SUCCESS'
+        self.assertEqual(self._status(pipeline, item),
+                         (True, False, False, False))
+        self.assertEqual(build_set.pending, 1)
+
+        # A retried build is removed and replaced by a new one
+        item.removeBuild(builds['voting2'])
+        builds['voting2'].result = None
+        retry = model.Build(builds['voting2'].job, 'retry')
+        item.addBuild(retry)
+        self.assertEqual(self._status(pipeline, item),
+                         (False, False, False, False))
+        retry.start_time = time.time()
+        retry.result = 'SUCCESS'
+        self.assertEqual(self._status(pipeline, item),
+                         (True, True, True, False))
+        self.assertEqual(build_set.pending, 0)
+
+        # Setting the result on a build which has been replaced does
+        # not affect the totals.
+        builds['voting2'].result = 'FAILURE'
+        self.assertEqual(self._status(pipeline, item),
+                         (True, True, True, False))
+
+        retry.result = 'FAILURE'
+        self.assertEqual(self._status(pipeline, item),
+                         (True, True, False, True))
+
+        # The totals follow changes to the item's job list
+        jobs = tree.getJobs()
+        tree = pipeline.addProject(item.change.project)
+        for job in jobs + [model.Job('new-job')]:
+            tree.addJob(job)
+        self.assertEqual(self._status(pipeline, item),
+                         (False, False, False, True))
+        self.assertEqual(build_set.pending, 1)
+
+    def test_holding_following_changes_linear(self):
+        pipeline, queue = self._makeQueue(20, 0)
+        tree = pipeline.getJobTree(queue.queue[0].change.project)
+        job = model.Job('hold')
+        job.hold_following_changes = True
+        tree.addJob(job)
+        for item in queue.queue:
+            build = model.Build(job, item.change.number)
+            item.addBuild(build)
+            build.result = 'SUCCESS'
+
+        calls = []
+        orig_get_jobs = model.Pipeline.getJobs
+
+        def getJobs(pipeline, item):
+            calls.append(item)
+            return orig_get_jobs(pipeline, item)
+        self.useFixture(fixtures.MonkeyPatch(
+            'zuul.model.Pipeline.getJobs', getJobs))
+
+        # Outside of a queue pass every item walks to the head
+        for item in queue.queue:
+            self.assertFalse(pipeline.isHoldingFollowingChanges(item))
+        self.assertEqual(len(calls), 20 * 21 / 2)
+
+        # During a pass each item is only examined once
+        calls[:] = []
+        queue.holding_cache = {}
+        for item in queue.queue:
+            self.assertFalse(pipeline.isHoldingFollowingChanges(item))
+        self.assertEqual(len(calls), 20)
+
+        # Resetting an item's builds is seen by the items behind it
+        queue.queue[10].resetAllBuilds()
+        for item in queue.queue:
+            self.assertEqual(pipeline.isHoldingFollowingChanges(item),
+                             item.change.number >= 10)
+        self.assertFalse(pipeline.isHoldingFollowingChanges(
+            queue.queue[9]))
+        queue.holding_cache = None
+
+    def test_status_json_cached(self):
+        pipeline, queue = self._makeQueue(3, 2)
+        item = queue.queue[1]
+        job = pipeline.getJobs(item)[0]
+        version = pipeline.status_version
+        status = item.formatStatusJSON()
+        self.assertIs(status, item.formatStatusJSON())
+        self.assertEqual(pipeline.status_version, version)
+
+        # Builds change the item's status
+        build = model.Build(job, 'uuid')
+        item.addBuild(build)
+        status = item.formatStatusJSON()
+        self.assertEqual(status['jobs'][0]['uuid'], 'uuid')
+        self.assertIs(status, item.formatStatusJSON())
+        # Items with running builds are always formatted afresh
+        build.start_time = time.time()
+        status = item.formatStatusJSON()
+        self.assertIsNot(status, item.formatStatusJSON())
+        build.end_time = time.time()
+        build.result = 'SUCCESS'
+        status = item.formatStatusJSON()
+        self.assertEqual(status['jobs'][0]['result'], 'SUCCESS')
+        self.assertIs(status, item.formatStatusJSON())
+
+        # As does a change to the items around it
+        queue.dequeueItem(queue.queue[0])
+        self.assertIsNone(item.formatStatusJSON()['item_ahead'])
+        self.assertGreater(pipeline.status_version, version)
+
+
 class TestJobTimeData(BaseTestCase):
     def setUp(self):
         super(TestJobTimeData, self).setUp()
@@ -150,3 +359,29 @@ class TestTimeDataBase(BaseTestCase):
         for x in range(10):
             self.db.update('job-name', 100, 'SUCCESS')
         self.assertEqual(self.db.getEstimatedTime('job-name'), 100)
+
+
+class TestEventFilter(BaseTestCase):
+
+    def test_combined_regexes(self):
+        ef = model.EventFilter(trigger=None,
+                               types=['comment-added'],
+                               branches=['master', 'stable/.*'],
+                               comments=[r'(?i)^\s*recheck', 'reverify'])
+        self.assertIsNotNone(ef.branches_re)
+        # An inline flag would apply to every alternative
+        self.assertIsNone(ef.comments_re)
+        change = model.Change(None)
+        event = model.TriggerEvent()
+        event.type = 'comment-added'
+        event.branch = 'stable/liberty'
+        event.comment = 'RECHECK'
+        self.assertTrue(ef.matches(event, change))
+        event.comment = 'REVERIFY'
+        self.assertFalse(ef.matches(event, change))
+        event.comment = 'reverify'
+        event.branch = 'feature/master'
+        self.assertFalse(ef.matches(event, change))
+        event.type = 'patchset-created'
+        event.branch = 'master'
+        self.assertFalse(ef.matches(event, change))
@@ -19,7 +19,9 @@ try:
 except ImportError:
     import mock
 
+import zuul.exceptions
 import zuul.reporter
+import zuul.reporter.dispatcher
 
 
 class TestSMTPReporter(testtools.TestCase):
@@ -103,3 +105,94 @@ class TestGithubReporter(testtools.TestCase):
         message = self.reporter._formatMergeMessage(self.change)
         self.assertEqual('\n\n'
                          'Reviewed-by: https://github.com/githubuser', message)
+
+
+class TestReportDispatcher(testtools.TestCase):
+    log = logging.getLogger("zuul.test_reporter")
+
+    def setUp(self):
+        super(TestReportDispatcher, self).setUp()
+        self.dispatcher = zuul.reporter.dispatcher.ReportDispatcher(
+            workers=2, timeout=10)
+        self.dispatcher.retry_delay = 0
+        self.addCleanup(self.dispatcher.stop)
+
+    def _makeReporter(self, report):
+        reporter = mock.MagicMock()
+        reporter.name = 'fake'
+        reporter.connection.connection_name = 'review'
+        reporter.report.side_effect = report
+        return reporter
+
+    def _makeItem(self, number):
+        item = mock.MagicMock()
+        item.change._id.return_value = '%s,1' % number
+        return item
+
+    def test_reports_in_order(self):
+        sent = []
+        reporter = self._makeReporter(
+            lambda source, pipeline, item: sent.append(item))
+        items = [self._makeItem(x % 3) for x in range(30)]
+        requests = [self.dispatcher.submit(reporter, None, None, item)
+                    for item in items]
+        self.assertEqual([], self.dispatcher.wait(requests))
+        self.assertTrue(self.dispatcher.isIdle())
+        for number in range(3):
+            change_items = [i for i in items
+                            if i.change._id() == '%s,1' % number]
+            self.assertEqual(change_items,
+                             [i for i in sent if i in change_items])
+
+    def test_report_retried(self):
+        failures = [zuul.exceptions.RequestNotSent('fail'),
+                    zuul.exceptions.RequestNotSent('fail')]
+
+        def report(source, pipeline, item):
+            if failures:
+                raise failures.pop()
+        reporter = self._makeReporter(report)
+        request = self.dispatcher.submit(reporter, None, None,
+                                         self._makeItem(1))
+        self.assertEqual([], self.dispatcher.wait([request]))
+        self.assertEqual(3, reporter.report.call_count)
+
+    def test_report_errors(self):
+        reporter = self._makeReporter(
+            lambda source, pipeline, item: 'error')
+        request = self.dispatcher.submit(reporter, None, None,
+                                         self._makeItem(1))
+        self.assertEqual(['error'], self.dispatcher.wait([request]))
+
+        reporter = self._makeReporter(
+            zuul.exceptions.RequestNotSent('fail'))
+        request = self.dispatcher.submit(reporter, None, None,
+                                         self._makeItem(1))
+        self.assertRaises(zuul.exceptions.RequestNotSent,
+                          self.dispatcher.wait, [request])
+        self.assertEqual(3, reporter.report.call_count)
+
+    def test_sent_report_not_retried(self):
+        # The report may have been posted before it failed
+        reporter = self._makeReporter(Exception('fail'))
+        request = self.dispatcher.submit(reporter, None, None,
+                                         self._makeItem(1))
+        self.assertRaises(Exception, self.dispatcher.wait, [request])
+        self.assertEqual(1, reporter.report.call_count)
+
+    def test_merge_failure_not_retried(self):
+        reporter = self._makeReporter(
+            zuul.exceptions.MergeFailure('conflict'))
+        request = self.dispatcher.submit(reporter, None, None,
+                                         self._makeItem(1))
+        self.assertRaises(zuul.exceptions.MergeFailure,
+                          self.dispatcher.wait, [request])
+        self.assertEqual(1, reporter.report.call_count)
+
+    def test_synchronous(self):
+        self.dispatcher.workers = 0
+        reporter = self._makeReporter(None)
+        request = self.dispatcher.submit(reporter, None, None,
+                                         self._makeItem(1))
+        self.assertTrue(request.isComplete())
+        self.assertEqual({}, self.dispatcher.pools)
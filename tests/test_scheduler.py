@@ -19,6 +19,7 @@ import logging
 import os
 import re
 import shutil
+import threading
 import time
 import yaml
 
@@ -27,6 +28,8 @@ from six.moves import urllib
 import testtools
 
 import zuul.change_matcher
+import zuul.model
+import zuul.connection.gerrit
 import zuul.scheduler
 import zuul.rpcclient
 import zuul.reporter.gerrit
@@ -34,6 +37,7 @@ import zuul.reporter.smtp
 
 from tests.base import (
     ZuulTestCase,
+    iterate_timeout,
     repack_repo,
 )
 
@@ -796,9 +800,9 @@ jobs:
         self.fake_gerrit.addEvent(B.addApproval('APRV', 1))
         self.waitUntilSettled()
 
-        self.log.debug("len %s" % self.fake_gerrit._change_cache.keys())
+        self.log.debug("len %s" % self.fake_gerrit.change_cache.keys())
         # there should still be changes in the cache
-        self.assertNotEqual(len(self.fake_gerrit._change_cache.keys()), 0)
+        self.assertNotEqual(len(self.fake_gerrit.change_cache.keys()), 0)
 
         self.worker.hold_jobs_in_build = False
         self.worker.release()
@@ -2417,6 +2421,50 @@ jobs:
         self.assertEqual(B.reported, 1)
         self.assertFalse('test-mutex' in self.sched.mutex.mutexes)
 
+    def test_mutex_count(self):
+        "Test job mutexes held by several jobs, granted in order"
+        self.config.set('zuul', 'layout_config',
+                        'tests/fixtures/layout-mutex-count.yaml')
+        self.sched.reconfigure(self.config)
+
+        self.worker.hold_jobs_in_build = True
+        changes = []
+        for name in ['A', 'B', 'C', 'D']:
+            change = self.fake_gerrit.addFakeChange('org/project', 'master',
+                                                    name)
+            self.fake_gerrit.addEvent(change.getPatchsetCreatedEvent(1))
+            self.waitUntilSettled()
+            changes.append(change)
+        A, B, C, D = changes
+
+        # Two jobs may hold the mutex, the others wait in order.
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual(self.builds[0].parameters['ZUUL_CHANGE'], '1')
+        self.assertEqual(self.builds[1].parameters['ZUUL_CHANGE'], '2')
+        self.assertEqual(len(self.sched.mutex.mutexes['test-mutex']), 2)
+        waiters = self.sched.mutex.waiters['test-mutex']
+        self.assertEqual([w.item.change.number for w in waiters],
+                         ['3', '4'])
+
+        self.builds[1].release()
+        self.waitUntilSettled()
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual(self.builds[0].parameters['ZUUL_CHANGE'], '1')
+        self.assertEqual(self.builds[1].parameters['ZUUL_CHANGE'], '3')
+        waiters = self.sched.mutex.waiters['test-mutex']
+        self.assertEqual([w.item.change.number for w in waiters], ['4'])
+        self.assertReportedStat('zuul.mutex.test-mutex.wait_time',
+                                kind='ms')
+
+        self.worker.hold_jobs_in_build = False
+        self.worker.release()
+        self.waitUntilSettled()
+        self.assertEqual(len(self.builds), 0)
+        for change in changes:
+            self.assertEqual(change.reported, 1)
+        self.assertFalse('test-mutex' in self.sched.mutex.mutexes)
+        self.assertFalse('test-mutex' in self.sched.mutex.waiters)
+
     def test_node_label(self):
         "Test that a job runs on a specific node label"
         self.worker.registerFunction('build:node-project-test1:debian')
@@ -4504,3 +4552,248 @@ For CI problems and help debugging, contact ci@example.org"""
         self.assertIn(
             '- docs-draft-test2 https://server/job/docs-draft-test2/1/',
             body[3])
+
+    def test_only_dirty_queues_processed(self):
+        "Test that a build result only causes its own queue to be processed"
+        self.sched.full_sweep_interval = 3600
+        self.worker.hold_jobs_in_build = True
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        A.addApproval('CRVW', 2)
+        self.fake_gerrit.addEvent(A.addApproval('APRV', 1))
+        B = self.fake_gerrit.addFakeChange('org/project1', 'master', 'B')
+        self.fake_gerrit.addEvent(B.getPatchsetCreatedEvent(1))
+        self.waitUntilSettled()
+        self.assertEqual(len(self.builds), 2)
+
+        check = self.sched.layout.pipelines['check']
+        processed = []
+        orig_process = check.manager._processOneItem
+
+        def processOneItem(item, nnfi):
+            processed.append(item)
+            return orig_process(item, nnfi)
+        check.manager._processOneItem = processOneItem
+
+        gate_build = [b for b in self.builds
+                      if b.parameters['ZUUL_PIPELINE'] == 'gate'][0]
+        self.release(gate_build)
+        self.waitUntilSettled()
+        self.assertEqual(processed, [])
+        self.assertReportedStat('zuul.pipeline.gate.processed_items',
+                                kind='c')
+
+        self.worker.hold_jobs_in_build = False
+        self.worker.release()
+        self.waitUntilSettled()
+        self.assertNotEqual(processed, [])
+        self.assertEqual(A.data['status'], 'MERGED')
+        self.assertEqual(B.reported, 1)
+
+    def _run_restored_changes(self, count):
+        # Each restored change is enqueued in both the dup1 and dup2
+        # pipelines, which report to gerrit.
+        self.worker.hold_jobs_in_build = True
+        changes = []
+        for x in range(count):
+            change = self.fake_gerrit.addFakeChange('org/project', 'master',
+                                                    'change %s' % x)
+            self.fake_gerrit.addEvent(change.getChangeRestoredEvent())
+            changes.append(change)
+        self.waitUntilSettled()
+        self.worker.hold_jobs_in_build = False
+        self.worker.release()
+        self.waitUntilSettled()
+        for change in changes:
+            self.assertEqual(len(change.messages), 2)
+
+    def test_pipeline_workers(self):
+        "Test that pipelines are processed in parallel with pipeline_workers"
+        # Send reports from the pipeline workers themselves
+        self.sched.report_dispatcher.workers = 0
+        lock = threading.Lock()
+        reporting = []
+        concurrency = []
+        overlapped = threading.Event()
+        hold = threading.Event()
+        orig_review = self.fake_gerrit.review
+
+        def review(*args, **kw):
+            with lock:
+                reporting.append(True)
+                concurrency.append(len(reporting))
+                if len(reporting) > 1:
+                    overlapped.set()
+            if hold.is_set():
+                # Keep reporting until the other pipeline reports too,
+                # which it can only do from another worker.
+                overlapped.wait(10)
+            with lock:
+                reporting.pop()
+            return orig_review(*args, **kw)
+        self.fake_gerrit.review = review
+
+        self._run_restored_changes(5)
+        self.assertEqual(max(concurrency), 1)
+
+        concurrency[:] = []
+        hold.set()
+        self.sched.pipeline_workers = 4
+        self._run_restored_changes(5)
+        self.assertTrue(overlapped.is_set())
+        # There are only two pipelines to process at once
+        self.assertEqual(max(concurrency), 2)
+        self.assertReportedStat('zuul.scheduler.pipeline_processing',
+                                kind='ms')
+        self.assertEqual(len(self.sched._pipeline_worker_threads), 4)
+
+    def test_reports_dispatched(self):
+        "Test that the scheduler doesn't wait for check reports"
+        gate = threading.Event()
+        orig_review = self.fake_gerrit.review
+
+        def review(*args, **kw):
+            gate.wait()
+            return orig_review(*args, **kw)
+        self.fake_gerrit.review = review
+
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        pipeline = self.sched.layout.pipelines['check']
+        for x in iterate_timeout(10, 'change to be dequeued'):
+            if (len(self.history) == 3 and
+                not pipeline.getAllItems()):
+                break
+        self.assertEqual(len(A.messages), 0)
+        self.assertFalse(self.sched.report_dispatcher.isIdle())
+
+        gate.set()
+        self.waitUntilSettled()
+        self.assertEqual(len(A.messages), 1)
+        self.assertEqual(A.reported, 1)
+        self.assertReportedStat('zuul.reporter.gerrit.queue_depth',
+                                kind='g')
+        self.assertReportedStat('zuul.reporter.gerrit.gerrit.latency',
+                                kind='ms')
+
+    def test_trigger_events_coalesced(self):
+        "Test that redundant trigger events are not processed"
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        A.addPatchset()
+        # Hold the scheduler so that the events wait in its queue
+        self.sched.run_handler_lock.acquire()
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(2))
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(2))
+        self.fake_gerrit.addEvent(A.getChangeCommentEvent(2))
+        self.fake_gerrit.addEvent(A.getChangeCommentEvent(2))
+        self.fake_gerrit.event_queue.join()
+        self.assertEqual(3, self.sched.trigger_event_queue.qsize())
+        self.sched.run_handler_lock.release()
+        self.waitUntilSettled()
+
+        # The first patchset was superseded by the second, and the
+        # duplicates were dropped.
+        self.assertEqual(3, self.sched.events_coalesced)
+        self.assertEqual(2, self.sched.events_processed)
+        self.assertEqual(3, len(self.history))
+        for build in self.history:
+            self.assertEqual('1,2', build.changes)
+        self.assertEqual(1, A.reported)
+        self.assertReportedStat('zuul.scheduler.events.coalesced',
+                                value='1|c')
+        self.assertReportedStat('zuul.scheduler.events.processed',
+                                value='1|c')
+
+    def test_trigger_events_no_dequeue_on_new_patchset(self):
+        "Test that superseded events reach pipelines keeping patchsets"
+        self.config.set('zuul', 'layout_config',
+                        'tests/fixtures/'
+                        'layout-no-dequeue-on-new-patchset.yaml')
+        self.sched.reconfigure(self.config)
+        self.registerJobs()
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        A.addPatchset()
+        # Hold the scheduler so that the events wait in its queue
+        self.sched.run_handler_lock.acquire()
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(2))
+        self.fake_gerrit.event_queue.join()
+        self.sched.run_handler_lock.release()
+        self.waitUntilSettled()
+
+        # The check pipeline only tested the second patchset, the
+        # every-patchset pipeline tested both.
+        self.assertEqual(0, self.sched.events_coalesced)
+        self.assertEqual(['1,2'],
+                         [b.changes for b in self.history
+                          if b.name == 'project-merge'])
+        self.assertEqual(['1,1', '1,2'],
+                         sorted([b.changes for b in self.history
+                                 if b.name == 'project-test1']))
+        self.assertEqual(1, A.reported)
+
+    def test_trigger_events_out_of_order(self):
+        "Test that events only supersede those for earlier patchsets"
+        events = []
+        for patchset in ('10', '9', '11'):
+            event = zuul.model.TriggerEvent()
+            event.type = 'patchset-created'
+            event.connection_name = 'gerrit'
+            event.project_name = 'org/project'
+            event.change_number = '1'
+            event.patch_number = patchset
+            self.assertFalse(self.sched._coalesceEvent(event))
+            events.append(event)
+        self.assertEqual([True, True, False],
+                         [e.superseded for e in events])
+        self.sched._pending_events.clear()
+
+    def test_event_journal_replay(self):
+        "Test that waiting trigger events are replayed from the journal"
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        A.addPatchset()
+        # Hold the scheduler so that the events wait in its queue
+        self.sched.run_handler_lock.acquire()
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(1))
+        self.fake_gerrit.addEvent(A.getPatchsetCreatedEvent(2))
+        self.fake_gerrit.event_queue.join()
+        self.assertEqual(2, self.sched.trigger_event_queue.qsize())
+
+        # Lose the queue as if the scheduler had been killed, and
+        # start over from the journal.
+        self.sched._closeEventJournal()
+        while not self.sched.trigger_event_queue.empty():
+            self.sched.trigger_event_queue.get()
+            self.sched.trigger_event_queue.task_done()
+        self.sched._pending_events.clear()
+        self.sched.resume()
+        self.assertEqual(2, self.sched.trigger_event_queue.qsize())
+        self.sched.run_handler_lock.release()
+        self.waitUntilSettled()
+
+        # The replayed events were coalesced again
+        self.assertEqual(1, self.sched.events_coalesced)
+        self.assertEqual(1, self.sched.events_processed)
+        self.assertEqual(1, A.reported)
+        self.assertEqual({}, self.sched.event_journal.pending)
+
+    def test_event_filter_index(self):
+        "Test that events are only matched against filters of their type"
+        A = self.fake_gerrit.addFakeChange('org/project', 'master', 'A')
+        A.addApproval('CRVW', 2)
+        data = A.addApproval('APRV', 1)
+        connector = zuul.connection.gerrit.GerritEventConnector(
+            self.fake_gerrit, 0)
+        event = connector._parseEvent(data)
+        index = self.sched.layout.event_filter_index
+        candidates = index.getFilters(event)
+        self.assertEqual(['gate', 'unused', 'conflict'],
+                         [p.name for p in self.sched.layout.pipelines.values()
+                          if p in candidates])
+        self.assertIs(candidates, index.getFilters(event))
+
+        self.fake_gerrit.addEvent(data)
+        self.waitUntilSettled()
+        self.assertEqual(self.getJobFromHistory('project-test1').result,
+                         'SUCCESS')
+        self.assertEqual(A.data['status'], 'MERGED')
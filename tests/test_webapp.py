@@ -15,9 +15,13 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import gzip
+import io
 import json
 
+from six.moves import http_client
 from six.moves import urllib
+import testtools
 import webob
 
 from tests.base import ZuulTestCase
@@ -86,6 +90,234 @@ class TestWebapp(ZuulTestCase):
         self.assertEqual(1, len(data), data)
         self.assertEqual("org/project1", data[0]['project'], data)
 
+    def test_webapp_status_gzip(self):
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        f = urllib.request.urlopen(req)
+        self.assertIsNone(f.info().getheader('Content-Encoding'))
+        data = f.read()
+
+        req.add_header('Accept-Encoding', 'gzip')
+        f = urllib.request.urlopen(req)
+        self.assertEqual('gzip', f.info().getheader('Content-Encoding'))
+        self.assertEqual(
+            data, gzip.GzipFile(fileobj=io.BytesIO(f.read())).read())
+
+    def test_webapp_gzip_etag(self):
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        f = urllib.request.urlopen(req)
+        etag = f.info().getheader('ETag')
+        self.assertEqual('Accept-Encoding', f.info().getheader('Vary'))
+
+        # The compressed status is a different entity
+        req.add_header('Accept-Encoding', 'gzip')
+        req.add_header('If-None-Match', etag)
+        f = urllib.request.urlopen(req)
+        self.assertEqual('gzip', f.info().getheader('Content-Encoding'))
+        gzip_etag = f.info().getheader('ETag')
+        self.assertNotEqual(etag, gzip_etag)
+
+        req.add_header('If-None-Match', gzip_etag)
+        with testtools.ExpectedException(urllib.error.HTTPError,
+                                         '.*304.*'):
+            urllib.request.urlopen(req)
+
+    def test_webapp_change_gzip(self):
+        req = urllib.request.Request(
+            "http://localhost:%s/status/change/1,1" % self.port)
+        f = urllib.request.urlopen(req)
+        self.assertEqual('Accept-Encoding', f.info().getheader('Vary'))
+        self.assertIsNone(f.info().getheader('Content-Encoding'))
+        data = f.read()
+
+        req.add_header('Accept-Encoding', 'gzip')
+        f = urllib.request.urlopen(req)
+        self.assertEqual('Accept-Encoding', f.info().getheader('Vary'))
+        self.assertEqual('gzip', f.info().getheader('Content-Encoding'))
+        self.assertEqual(
+            data, gzip.GzipFile(fileobj=io.BytesIO(f.read())).read())
+
+    def test_webapp_last_modified(self):
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        f = urllib.request.urlopen(req)
+        last_modified = f.info().getheader('Last-Modified')
+        self.assertIsNotNone(last_modified)
+
+        req.add_header('If-Modified-Since', last_modified)
+        with testtools.ExpectedException(urllib.error.HTTPError,
+                                         '.*304.*'):
+            urllib.request.urlopen(req)
+
+    def test_webapp_find_changes(self):
+        # can we get several changes at once
+        req = urllib.request.Request(
+            "http://localhost:%s/status/changes?ids=1,1&ids=2,1+3,1" %
+            self.port)
+        f = urllib.request.urlopen(req)
+        data = json.loads(f.read())
+
+        self.assertEqual(['1,1', '2,1', '3,1'], sorted(data.keys()))
+        self.assertEqual("org/project", data['1,1'][0]['project'])
+        self.assertEqual("org/project1", data['2,1'][0]['project'])
+        self.assertEqual([], data['3,1'])
+
+    def test_webapp_pipeline(self):
+        # can we get a single pipeline
+        req = urllib.request.Request(
+            "http://localhost:%s/status/pipeline/gate" % self.port)
+        f = urllib.request.urlopen(req)
+        data = json.loads(f.read())
+
+        self.assertEqual('gate', data['name'])
+        changes = [change['id']
+                   for queue in data['change_queues']
+                   for head in queue['heads']
+                   for change in head]
+        self.assertEqual(['1,1', '2,1'], sorted(changes))
+
+        req = urllib.request.Request(
+            "http://localhost:%s/status/pipeline/foo" % self.port)
+        self.assertRaises(urllib.error.HTTPError, urllib.request.urlopen, req)
+
+    def test_webapp_etag(self):
+        # Unchanged status gets a 304 response
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        f = urllib.request.urlopen(req)
+        etag = f.info().getheader('ETag')
+        self.assertIsNotNone(etag)
+        data = json.loads(f.read())
+
+        calls = []
+        orig_format = self.sched.formatStatusData
+
+        def formatStatusData():
+            calls.append(True)
+            return orig_format()
+        self.sched.formatStatusData = formatStatusData
+
+        req.add_header('If-None-Match', etag)
+        with testtools.ExpectedException(urllib.error.HTTPError,
+                                         '.*304.*'):
+            urllib.request.urlopen(req)
+        self.assertEqual(calls, [])
+
+        # A change to the status gets a new ETag
+        self.worker.release('.*-merge')
+        self.waitUntilSettled()
+        f = urllib.request.urlopen(req)
+        self.assertNotEqual(etag, f.info().getheader('ETag'))
+        self.assertNotEqual(data, json.loads(f.read()))
+
+    def _read_event(self, f):
+        event = {}
+        while True:
+            line = f.readline()
+            self.assertNotEqual(line, '', "Stream closed")
+            line = line.rstrip('\n')
+            if not line:
+                if event:
+                    return event
+                continue
+            if line.startswith(':'):
+                continue
+            field, value = line.split(': ', 1)
+            event[field] = value
+
+    def _open_stream(self, headers={}):
+        # urllib buffers reads, so use an unbuffered connection to read
+        # events as soon as they are sent.
+        conn = http_client.HTTPConnection('localhost', self.port,
+                                          timeout=30)
+        conn.request('GET', '/status/stream', headers=headers)
+        response = conn.getresponse()
+        self.assertTrue(response.getheader('Content-Type').startswith(
+            'text/event-stream'))
+        self.addCleanup(conn.close)
+        return response.fp
+
+    def _read_events_until(self, f, event_type):
+        events = []
+        while True:
+            event = self._read_event(f)
+            events.append(event)
+            if event['event'] == event_type:
+                return events
+
+    def test_webapp_stream(self):
+        f = self._open_stream()
+        event = self._read_event(f)
+        self.assertEqual('snapshot', event['event'])
+        data = json.loads(event['data'])
+        self.assertIn('pipelines', data)
+        last_id = event['id']
+
+        self.worker.release('project-merge')
+        self.waitUntilSettled()
+        events = self._read_events_until(f, 'build_completed')
+        data = json.loads(events[-1]['data'])
+        self.assertEqual('gate', data['pipeline'])
+        self.assertEqual('1,1', data['id'])
+        self.assertEqual('project-merge', data['job']['name'])
+        self.assertEqual('SUCCESS', data['job']['result'])
+
+        # Reconnecting picks up where we left off
+        f = self._open_stream({'Last-Event-ID': last_id})
+        event = self._read_event(f)
+        self.assertEqual(events[0], event)
+
+    def test_webapp_stream_dequeue(self):
+        f = self._open_stream()
+        self.assertEqual('snapshot', self._read_event(f)['event'])
+
+        self.worker.hold_jobs_in_build = False
+        self.worker.release()
+        self.waitUntilSettled()
+        dequeued = set()
+        while len(dequeued) < 2:
+            event = self._read_events_until(f, 'item_dequeued')[-1]
+            dequeued.add(json.loads(event['data'])['id'])
+        self.assertEqual(set(['1,1', '2,1']), dequeued)
+
+    def test_webapp_stream_limit(self):
+        self.webapp.max_streams = 1
+        f = self._open_stream()
+        self.assertEqual('snapshot', self._read_event(f)['event'])
+
+        # The other threads are left for the rest of the requests
+        req = urllib.request.Request(
+            "http://localhost:%s/status/stream" % self.port)
+        with testtools.ExpectedException(urllib.error.HTTPError,
+                                         '.*503.*'):
+            urllib.request.urlopen(req)
+        req = urllib.request.Request(
+            "http://localhost:%s/status" % self.port)
+        self.assertIn('pipelines', json.loads(urllib.request.urlopen(
+            req).read()))
+
+    def test_webapp_stream_diff_per_version(self):
+        self.webapp._refresh_status_cache()
+        diffs = []
+        orig_diff = self.webapp._diff_status
+
+        def _diff_status(old_items, new_items):
+            diffs.append(True)
+            return orig_diff(old_items, new_items)
+        self.webapp._diff_status = _diff_status
+
+        # Only the times of running builds have changed
+        self.webapp.cache = '{}'
+        self.webapp.cache_time = 0
+        self.webapp._refresh_status_cache()
+        self.assertEqual(diffs, [])
+
+        self.worker.release('project-merge')
+        self.waitUntilSettled()
+        self.webapp._refresh_status_cache()
+        self.assertEqual(diffs, [True])
+
     def test_webapp_custom_handler(self):
         def custom_handler(request):
             return webob.Response(body='ok')
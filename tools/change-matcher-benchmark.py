@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# This script measures how long it takes to decide which jobs run for
+# changes touching many files, with jobs carrying "files" and
+# "skip-if" rules.  The first pass over the changes has no remembered
+# results; the following passes are what the scheduler sees each time
+# it processes a pipeline again.  The results are checked against a
+# straightforward reimplementation of the matching which tries every
+# regex against every file.
+
+import argparse
+import random
+import re
+import time
+
+from zuul import change_matcher as cm
+from zuul import model
+
+
+def make_jobs(count, dirs):
+    jobs = []
+    for x in range(count):
+        job = model.Job('job-%s' % x)
+        job._files = ['^%s/.*$' % random.choice(dirs),
+                      r'^%s/.*\.py$' % random.choice(dirs)]
+        job.files = [re.compile(f) for f in job._files]
+        skip_files = ['^doc/.*$', r'^.*\.rst$',
+                      r'^%s/.*\.txt$' % random.choice(dirs)]
+        job.skip_if_matcher = cm.MatchAny([
+            cm.MatchAll([
+                cm.ProjectMatcher('^org/project$'),
+                cm.MatchAllFiles([cm.FileMatcher(f) for f in skip_files]),
+            ])
+        ])
+        # Keep the regexes for the naive matching
+        job.skip_files = [re.compile(f) for f in
+                          skip_files + ['^/COMMIT_MSG$']]
+        jobs.append(job)
+    return jobs
+
+
+def make_changes(count, files, dirs):
+    changes = []
+    for x in range(count):
+        change = model.Change('org/project')
+        change.branch = 'master'
+        change.files = ['/COMMIT_MSG'] + [
+            '%s/file%s.%s' % (random.choice(dirs), y,
+                              random.choice(['py', 'rst', 'txt']))
+            for y in range(files)]
+        changes.append(change)
+    return changes
+
+
+def naive_matches(job, change):
+    matches_file = False
+    for f in job.files:
+        for cf in change.files:
+            if f.match(cf):
+                matches_file = True
+    if not matches_file:
+        return False
+    if change.files == ['/COMMIT_MSG']:
+        return True
+    for cf in change.files:
+        matched = False
+        for regex in job.skip_files:
+            if regex.match(cf):
+                matched = True
+        if not matched:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark matching jobs to changes')
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--changes', type=int, default=2)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--passes', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(0)
+    dirs = ['doc'] + ['dir%s' % x for x in range(50)]
+    jobs = make_jobs(args.jobs, dirs)
+    changes = make_changes(args.changes, args.files, dirs)
+
+    start = time.time()
+    expected = [[naive_matches(job, change) for job in jobs]
+                for change in changes]
+    naive = time.time() - start
+
+    timings = []
+    for x in range(args.passes):
+        start = time.time()
+        results = [[job.changeMatches(change) for job in jobs]
+                   for change in changes]
+        timings.append(time.time() - start)
+        if results != expected:
+            raise Exception("The matchers disagree with the naive results")
+
+    print("%s jobs, %s changes of %s files" %
+          (args.jobs, args.changes, args.files))
+    print("naive pass:  %.3fs" % naive)
+    print("first pass:  %.3fs" % timings[0])
+    if len(timings) > 1:
+        print("later passes: %.6fs each" %
+              (sum(timings[1:]) / (len(timings) - 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# This script replays a recorded Gerrit event stream (the output of
+# "gerrit stream-events", one JSON event per line) against the event
+# filters of a layout, and compares the time it takes to match the
+# events against every filter of every pipeline with the time it takes
+# using the layout's event filter index.
+
+import argparse
+import json
+import logging
+import time
+
+from six.moves import configparser as ConfigParser
+
+import zuul.lib.connections
+import zuul.scheduler
+from zuul.connection.gerrit import GerritEventConnector
+from zuul import model
+
+
+def load_events(connection, path):
+    connector = GerritEventConnector(connection, 0)
+    events = []
+    for line in open(path):
+        line = line.strip()
+        if line:
+            events.append(connector._parseEvent(json.loads(line)))
+    return events
+
+
+def match_all(layout, event, change):
+    matched = []
+    for pipeline in layout.pipelines.values():
+        if ((event.change_number or event.ref) and event.connection_name !=
+            pipeline.source.connection.connection_name):
+            continue
+        if pipeline.manager.eventMatches(event, change):
+            matched.append(pipeline.name)
+    return matched
+
+
+def match_indexed(layout, event, change):
+    matched = []
+    candidates = layout.event_filter_index.getFilters(event)
+    for pipeline in layout.pipelines.values():
+        filters = candidates.get(pipeline)
+        if filters and pipeline.manager.eventMatches(event, change, filters):
+            matched.append(pipeline.name)
+    return matched
+
+
+def replay(layout, events, changes, match, repeat):
+    results = []
+    start = time.time()
+    for x in range(repeat):
+        results = [match(layout, event, change)
+                   for event, change in zip(events, changes)]
+    return time.time() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark matching events against a layout')
+    parser.add_argument('-c', dest='config', required=True,
+                        help='the zuul configuration file')
+    parser.add_argument('--layout',
+                        help='the layout (defaults to the one configured)')
+    parser.add_argument('--connection', default='gerrit',
+                        help='the connection the events came from')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='how many times to replay the events')
+    parser.add_argument('events', help='the recorded event stream')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    config = ConfigParser.ConfigParser()
+    config.read(args.config)
+    sched = zuul.scheduler.Scheduler(config, testonly=True)
+    connections = zuul.lib.connections.configure_connections(config)
+    sched.registerConnections(connections, None, load=False)
+    layout = sched.testConfig(
+        args.layout or config.get('zuul', 'layout_config'), connections)
+
+    events = load_events(connections[args.connection], args.events)
+    changes = []
+    for event in events:
+        project = layout.projects.get(event.project_name)
+        changes.append(model.Change(project))
+
+    linear, expected = replay(layout, events, changes, match_all,
+                              args.repeat)
+    indexed, results = replay(layout, events, changes, match_indexed,
+                              args.repeat)
+    if results != expected:
+        raise Exception("The index matched different pipelines")
+    count = len(events) * args.repeat
+    print("%s events, %s pipelines" % (len(events), len(layout.pipelines)))
+    print("every filter: %.3fs (%.1fus per event)" %
+          (linear, linear * 1000000 / count))
+    print("indexed:      %.3fs (%.1fus per event)" %
+          (indexed, indexed * 1000000 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# This script measures how long the scheduler spends working out which
+# jobs run for the items of a queue.  Each pass checks the status of
+# every item, as happens each time a pipeline is processed, which asks
+# for the jobs of each item several times.  The uncached passes filter
+# the job tree against the change every time, as was done before the
+# filtered jobs were kept on each item.
+
+import argparse
+import re
+import time
+
+from zuul import change_matcher as cm
+from zuul import model
+
+
+def make_queue(items, jobs):
+    pipeline = model.Pipeline('gate')
+    project = model.Project('project')
+    tree = pipeline.addProject(project)
+    for x in range(jobs):
+        job = model.Job('job%s' % x)
+        job._files = ['^dir%s/.*$' % (x % 10)]
+        job.files = [re.compile(f) for f in job._files]
+        job.skip_if_matcher = cm.MatchAny([cm.MatchAllFiles(
+            [cm.FileMatcher('^doc/.*$')])])
+        tree.addJob(job)
+    queue = model.ChangeQueue(pipeline)
+    queue.addProject(project)
+    for x in range(items):
+        change = model.Change(project)
+        change.number = x
+        change.patchset = 1
+        change.branch = 'master'
+        change.files = ['/COMMIT_MSG', 'dir%s/file' % (x % 10),
+                        'doc/README']
+        queue.enqueueChange(change)
+    return pipeline, queue
+
+
+def check_status(pipeline, queue):
+    for item in queue.queue:
+        pipeline.haveAllJobsStarted(item)
+        pipeline.areAllJobsComplete(item)
+        pipeline.didAllJobsSucceed(item)
+        pipeline.didAnyJobFail(item)
+        pipeline.isHoldingFollowingChanges(item)
+
+
+def disable_cache(pipeline):
+    get_jobs = pipeline.getJobs
+
+    def getJobs(item):
+        item._jobs_cache_key = None
+        return get_jobs(item)
+    pipeline.getJobs = getJobs
+
+
+def run(pipeline, queue, passes):
+    start = time.time()
+    for x in range(passes):
+        check_status(pipeline, queue)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark filtering the jobs of queue items')
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=50)
+    parser.add_argument('--passes', type=int, default=5)
+    args = parser.parse_args()
+
+    pipeline, queue = make_queue(args.items, args.jobs)
+    cached = run(pipeline, queue, args.passes)
+    pipeline, queue = make_queue(args.items, args.jobs)
+    disable_cache(pipeline)
+    uncached = run(pipeline, queue, args.passes)
+
+    print("%s items with %s jobs, %s passes" %
+          (args.items, args.jobs, args.passes))
+    print("uncached: %.3fs" % uncached)
+    print("cached:   %.3fs" % cached)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# This script counts the processes the merger starts for a merge job,
+# and how long the job takes, with each merge backend.  It makes an
+# upstream repo with a number of changes, each adding its own file,
+# and merges them all in one job, as the scheduler does for the last
+# change of a gate queue.  The first job clones the repo; each of the
+# following jobs merges the changes again under new zuul refs, as
+# happens when the gate queue is reset, which reuses the earlier merges
+# unless the merge cache is turned off.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import git
+import git.cmd
+
+from zuul.merger.merger import MergeCache, Merger, REPO_BACKENDS
+from zuul import model
+
+
+class SpawnCounter(object):
+    """Count the processes GitPython starts."""
+
+    def __init__(self):
+        self.count = 0
+        self.popen = git.cmd.Popen
+        git.cmd.Popen = self.spawn
+
+    def spawn(self, *args, **kw):
+        self.count += 1
+        return self.popen(*args, **kw)
+
+
+def make_upstream(path, changes):
+    repo = git.Repo.init(path)
+    writer = repo.config_writer()
+    writer.set_value('user', 'email', 'user@example.com')
+    writer.set_value('user', 'name', 'User Name')
+    writer.release()
+    with open(os.path.join(path, 'README'), 'w') as f:
+        f.write('README\n')
+    repo.index.add(['README'])
+    master = repo.index.commit('Initial commit')
+    refspecs = []
+    for x in range(changes):
+        repo.head.reference = master
+        repo.head.reset(index=True, working_tree=True)
+        name = 'change-%s' % x
+        with open(os.path.join(path, name), 'w') as f:
+            f.write('%s\n' % name)
+        repo.index.add([name])
+        commit = repo.index.commit(name)
+        refspec = 'refs/changes/%02d/%s/1' % (x % 100, x)
+        git.Reference.create(repo, refspec, commit)
+        refspecs.append(refspec)
+    repo.head.reference = repo.heads.master
+    repo.head.reset(index=True, working_tree=True)
+    return refspecs
+
+
+def make_items(url, refspecs, job):
+    items = []
+    for x, refspec in enumerate(refspecs):
+        items.append(dict(project='org/project', url=url,
+                          connection_name='gerrit',
+                          merge_mode=model.MERGER_MERGE_RESOLVE,
+                          refspec=refspec, branch='master',
+                          ref='Z%s-%s' % (job, x),
+                          number=x, patchset=1))
+    return items
+
+
+def run(backend, root, url, refspecs, jobs, counter, cache):
+    merger = Merger(os.path.join(root, backend), {}, 'zuul@example.com',
+                    'Zuul', backend)
+    if not cache:
+        merger.merge_cache = MergeCache(0)
+    results = []
+    for job in range(jobs + 1):
+        items = make_items(url, refspecs, job)
+        counter.count = 0
+        start = time.time()
+        commit = merger.mergeChanges(items)
+        results.append((counter.count, time.time() - start))
+        if not commit:
+            raise Exception("The changes did not merge")
+    merger.closeRepos()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Count the processes started by merge jobs')
+    parser.add_argument('--changes', type=int, default=10,
+                        help='how many changes each job merges')
+    parser.add_argument('--jobs', type=int, default=5,
+                        help='how many jobs to run after the first')
+    parser.add_argument('--backend', action='append',
+                        choices=sorted(REPO_BACKENDS),
+                        help='the merge backends to run (default: all)')
+    parser.add_argument('--no-merge-cache', dest='cache',
+                        action='store_false',
+                        help='merge the changes again in every job')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        url = os.path.join(root, 'upstream')
+        refspecs = make_upstream(url, args.changes)
+        counter = SpawnCounter()
+        print("%s changes per merge job" % args.changes)
+        for backend in args.backend or sorted(REPO_BACKENDS):
+            results = run(backend, root, url, refspecs, args.jobs, counter,
+                          args.cache)
+            spawns, elapsed = results[0]
+            print("%-10s first job:  %4s processes, %.3fs" %
+                  (backend, spawns, elapsed))
+            if len(results) > 1:
+                later = results[1:]
+                print("%-10s later jobs: %4.0f processes, %.3fs each" %
+                      (backend, sum(r[0] for r in later) / len(later),
+                       sum(r[1] for r in later) / len(later)))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# This script measures how many trigger events a scheduler handles a
+# second with one pipeline worker and with several.  It runs the
+# scheduler against the fakes the tests use: each event restores a
+# change, which is enqueued in the dup1 and dup2 pipelines of the test
+# layout, runs a job in each and is reported to the fake Gerrit.
+# Reports are sent from the pipeline workers, and are given a delay to
+# stand in for a slow Gerrit, which is what the workers let the
+# pipelines wait on in parallel; with short delays the merges done for
+# each change take most of the time.  Making the changes in the fake
+# Gerrit isn't timed.  Run it from the top of the source tree.
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+import testtools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tests.base import ZuulTestCase  # noqa
+
+
+class PipelineWorkersBenchmark(ZuulTestCase):
+    events = 50
+    workers = 1
+    report_delay = 0.0
+    # How long to wait for the reports, in seconds per event
+    timeout = 10
+
+    def test_events(self):
+        self.sched.pipeline_workers = self.workers
+        self.sched.report_dispatcher.workers = 0
+        lock = threading.Lock()
+        reported = []
+        done = threading.Event()
+        orig_review = self.fake_gerrit.review
+
+        def review(*args, **kw):
+            time.sleep(self.report_delay)
+            ret = orig_review(*args, **kw)
+            with lock:
+                reported.append(True)
+                # Each change is reported by dup1 and dup2
+                if len(reported) == self.events * 2:
+                    done.set()
+            return ret
+        self.fake_gerrit.review = review
+
+        changes = [self.fake_gerrit.addFakeChange('org/project', 'master',
+                                                  'change %s' % x)
+                   for x in range(self.events)]
+        start = time.time()
+        for change in changes:
+            self.fake_gerrit.addEvent(change.getChangeRestoredEvent())
+        if not done.wait(self.events * self.timeout):
+            raise Exception("Timeout waiting for %s reports" %
+                            (self.events * 2))
+        self.elapsed = time.time() - start
+        self.waitUntilSettled()
+
+
+def run(events, workers, report_delay):
+    test = PipelineWorkersBenchmark('test_events')
+    test.events = events
+    test.workers = workers
+    test.report_delay = report_delay
+    result = testtools.TestResult()
+    test.run(result)
+    for failed, error in result.errors + result.failures:
+        print(error)
+    if not result.wasSuccessful():
+        sys.exit(1)
+    return test.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark processing pipelines on worker threads')
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--report-delay', type=float, default=0.5,
+                        help='seconds each report to Gerrit takes')
+    parser.add_argument('--log-file', default=os.devnull,
+                        help='where to write the debug log of the runs')
+    args = parser.parse_args()
+    # The tests log everything to stderr.  Only send it elsewhere: with
+    # less logging, the fake Gearman worker now and then misses the
+    # jobs of a burst of builds, and the run never finishes.
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.FileHandler(args.log_file, 'w'))
+
+    print("%s events, %.3fs per report" % (args.events, args.report_delay))
+    for workers in (1, args.workers):
+        elapsed = run(args.events, workers, args.report_delay)
+        print("pipeline_workers=%s: %.3fs, %.1f events/s" %
+              (workers, elapsed, args.events / elapsed))
+
+
+if __name__ == '__main__':
+    main()
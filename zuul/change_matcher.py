@@ -18,18 +18,38 @@ configuration.
 """
 
 import re
+import weakref
+
+from zuul.lib.regex import combineRegexes
 
 
 class AbstractChangeMatcher(object):
 
+    # Whether to remember the result for each change.  Results are
+    # kept until the change's files are replaced (they don't change
+    # within a patchset), or the change is no longer used.
+    cache_results = False
+
     def __init__(self, regex):
         self._regex = regex
         self.regex = re.compile(regex)
+        self._results = weakref.WeakKeyDictionary()
 
     def matches(self, change):
         """Return a boolean indication of whether change matches
         implementation-specific criteria.
         """
+        if not self.cache_results:
+            return self._matches(change)
+        files = getattr(change, 'files', None)
+        cached = self._results.get(change)
+        if cached is not None and cached[0] is files:
+            return cached[1]
+        result = self._matches(change)
+        self._results[change] = (files, result)
+        return result
+
+    def _matches(self, change):
         raise NotImplementedError()
 
     def copy(self):
@@ -47,13 +67,13 @@ class AbstractChangeMatcher(object):
 
 class ProjectMatcher(AbstractChangeMatcher):
 
-    def matches(self, change):
+    def _matches(self, change):
         return self.regex.match(str(change.project))
 
 
 class BranchMatcher(AbstractChangeMatcher):
 
-    def matches(self, change):
+    def _matches(self, change):
         return (
             (hasattr(change, 'branch') and self.regex.match(change.branch)) or
             (hasattr(change, 'ref') and self.regex.match(change.ref))
@@ -62,7 +82,9 @@ class BranchMatcher(AbstractChangeMatcher):
 
 class FileMatcher(AbstractChangeMatcher):
 
-    def matches(self, change):
+    cache_results = True
+
+    def _matches(self, change):
         if not hasattr(change, 'files'):
             return False
         for file_ in change.files:
@@ -73,8 +95,11 @@ class FileMatcher(AbstractChangeMatcher):
 
 class AbstractMatcherCollection(AbstractChangeMatcher):
 
+    cache_results = True
+
     def __init__(self, matchers):
         self.matchers = matchers
+        self._results = weakref.WeakKeyDictionary()
 
     def __eq__(self, other):
         return str(self) == str(other)
@@ -90,7 +115,30 @@ class AbstractMatcherCollection(AbstractChangeMatcher):
         return self.__class__(self.matchers[:])
 
 
-class MatchAllFiles(AbstractMatcherCollection):
+class AbstractFileMatcherCollection(AbstractMatcherCollection):
+    """A collection of FileMatchers, whose regexes are combined into
+    one where possible so that each file is only matched once."""
+
+    def __init__(self, matchers):
+        super(AbstractFileMatcherCollection, self).__init__(matchers)
+        self.combined_regex = combineRegexes(
+            [regex.pattern for regex in self.regexes])
+
+    @property
+    def regexes(self):
+        for matcher in self.matchers:
+            yield matcher.regex
+
+    def matchesFile(self, file_):
+        if self.combined_regex is not None:
+            return self.combined_regex.match(file_) is not None
+        for regex in self.regexes:
+            if regex.match(file_):
+                return True
+        return False
+
+
+class MatchAllFiles(AbstractFileMatcherCollection):
 
     commit_regex = re.compile('^/COMMIT_MSG$')
 
@@ -100,25 +148,31 @@ class MatchAllFiles(AbstractMatcherCollection):
             yield matcher.regex
         yield self.commit_regex
 
-    def matches(self, change):
+    def _matches(self, change):
         if not (hasattr(change, 'files') and change.files):
             return False
         if len(change.files) == 1 and self.commit_regex.match(change.files[0]):
             return False
         for file_ in change.files:
-            matched_file = False
-            for regex in self.regexes:
-                if regex.match(file_):
-                    matched_file = True
-                    break
-            if not matched_file:
+            if not self.matchesFile(file_):
                 return False
         return True
 
 
+class MatchAnyFiles(AbstractFileMatcherCollection):
+
+    def _matches(self, change):
+        if not hasattr(change, 'files'):
+            return False
+        for file_ in change.files:
+            if self.matchesFile(file_):
+                return True
+        return False
+
+
 class MatchAll(AbstractMatcherCollection):
 
-    def matches(self, change):
+    def _matches(self, change):
         for matcher in self.matchers:
             if not matcher.matches(change):
                 return False
@@ -127,7 +181,7 @@ class MatchAll(AbstractMatcherCollection):
 
 class MatchAny(AbstractMatcherCollection):
 
-    def matches(self, change):
+    def _matches(self, change):
         for matcher in self.matchers:
             if matcher.matches(change):
                 return True
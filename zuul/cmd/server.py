@@ -193,9 +193,20 @@ class Server(zuul.cmd.ZuulApp):
         else:
             port = 8001
 
+        if self.config.has_option('webapp', 'threads'):
+            threads = self.config.getint('webapp', 'threads')
+        else:
+            threads = 10
+
+        if self.config.has_option('webapp', 'max_streams'):
+            max_streams = self.config.getint('webapp', 'max_streams')
+        else:
+            max_streams = 5
+
         webapp = zuul.webapp.WebApp(
             self.sched, port=port, cache_expiry=cache_expiry,
-            listen_address=listen_address)
+            listen_address=listen_address, threads=threads,
+            max_streams=max_streams)
         rpc = zuul.rpclistener.RPCListener(self.config, self.sched)
 
         self.configure_connections()
@@ -63,12 +63,14 @@ class BaseConnection(object):
     def registerUse(self, what, instance):
         self.attached_to[what].append(instance)
 
-    def maintainCache(self, relevant):
+    def maintainCache(self, relevant, prune=True):
         """Make cache contain relevant changes.
 
         This lets the user supply a list of change objects that are
         still in use.  Anything in our cache that isn't in the supplied
-        list should be safe to remove from the cache."""
+        list should be safe to remove from the cache.  Without prune,
+        only those which have expired, or which are over the size of
+        the cache, are removed."""
 
     def registerWebapp(self, webapp):
         self.webapp = webapp
@@ -13,31 +13,73 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import calendar
 import threading
 import select
 import json
+import sys
 import time
 from six.moves import queue as Queue
 import paramiko
 import logging
 import pprint
+import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
 import voluptuous as v
+import extras
 
 from zuul.connection import BaseConnection
+from zuul import exceptions
+from zuul.lib.changecache import ChangeCache
 from zuul.model import TriggerEvent
 
+statsd = extras.try_import('statsd.statsd')
+
+
+class GerritChangeRefresh(object):
+    """A refresh of a change in the cache, for an event."""
+
+    def __init__(self, number, patchset, after=None):
+        self.number = number
+        self.patchset = patchset
+        # A refresh of the same change which must finish first
+        self.after = after
+        self.started = False
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return '<GerritChangeRefresh %s,%s>' % (self.number, self.patchset)
+
 
 class GerritEventConnector(threading.Thread):
-    """Move events from Gerrit to the scheduler."""
+    """Move events from Gerrit to the scheduler.
+
+    The changes that events refer to are refreshed by a pool of
+    prefetch workers, so that a burst of events doesn't wait on one
+    query after another, and are delivered to the scheduler in the
+    order they were received by a delivery thread.  When several
+    events for the same change are waiting, it is only refreshed
+    once.
+    """
 
     log = logging.getLogger("zuul.GerritEventConnector")
     delay = 10.0
+    # How many events may be waiting to be delivered to the scheduler
+    prefetch_window = 100
 
-    def __init__(self, connection):
+    def __init__(self, connection, workers=4):
         super(GerritEventConnector, self).__init__()
         self.daemon = True
         self.connection = connection
+        self.workers = workers
+        self.coalesced = 0
         self._stopped = False
+        self._refresh_queue = Queue.Queue()
+        self._delivery_queue = Queue.Queue(self.prefetch_window)
+        self._refreshes = {}  # (number, patchset) -> GerritChangeRefresh
+        self._refresh_lock = threading.Lock()
+        self._threads = []
 
     def stop(self):
         self._stopped = True
@@ -46,6 +88,7 @@ class GerritEventConnector(threading.Thread):
     def _handleEvent(self):
         ts, data = self.connection.getEvent()
         if self._stopped:
+            self.connection.eventDone()
             return
         # Gerrit can produce inconsistent data immediately after an
         # event, So ensure that we do not deliver the event to Zuul
@@ -55,6 +98,26 @@ class GerritEventConnector(threading.Thread):
         # should always be a constant number of seconds behind Gerrit.
         now = time.time()
         time.sleep(max((ts + self.delay) - now, 0.0))
+        event = self._parseEvent(data)
+
+        refresh = None
+        if (event.change_number and
+            self.connection.sched.getProject(event.project_name)):
+            # Call _getChange for the side effect of updating the
+            # cache.  Note that this modifies Change objects outside
+            # the main thread.
+            # NOTE(jhesketh): Ideally we'd just remove the change from the
+            # cache to denote that it needs updating. However the change
+            # object is already used by Item's and hence BuildSet's etc. and
+            # we need to update those objects by reference so that they have
+            # the correct/new information and also avoid hitting gerrit
+            # multiple times.
+            if self.connection.attached_to['source']:
+                refresh = self._submitRefresh(event.change_number,
+                                              event.patch_number)
+        self._delivery_queue.put((event, refresh))
+
+    def _parseEvent(self, data):
         event = TriggerEvent()
         event.connection_name = self.connection.connection_name
         event.type = data.get('type')
@@ -97,38 +160,108 @@ class GerritEventConnector(threading.Thread):
             self.log.warning("Received unrecognized event type '%s' from Gerrit.\
                     Can not get account information." % event.type)
             event.account = None
+        return event
+
+    def _submitRefresh(self, number, patchset):
+        key = (number, patchset)
+        with self._refresh_lock:
+            previous = self._refreshes.get(key)
+            if previous and not previous.started:
+                # The change hasn't been queried since this event
+                # arrived, so the earlier refresh will do for both.
+                self.coalesced += 1
+                self.log.debug("Coalescing refresh of change %s,%s" % key)
+                self._incStat('prefetch.coalesced')
+                return previous
+            refresh = GerritChangeRefresh(number, patchset, after=previous)
+            self._refreshes[key] = refresh
+        if self.workers:
+            self._refresh_queue.put(refresh)
+        else:
+            self._refreshChange(refresh)
+        return refresh
+
+    def _incStat(self, key):
+        try:
+            if statsd:
+                # counters.zuul.connection.CONNECTION.prefetch.coalesced
+                statsd.incr('zuul.connection.%s.%s' %
+                            (self.connection.connection_name, key))
+        except:
+            self.log.exception("Exception reporting prefetch stats")
+
+    def _refreshChange(self, refresh):
+        with self._refresh_lock:
+            refresh.started = True
+        if refresh.after:
+            # Don't let an older query of the change finish last
+            refresh.after.done.wait()
+        try:
+            # We only need to do this once since the connection maintains
+            # the cache (which is shared between all the sources)
+            # NOTE(jhesketh): We may couple sources and connections again
+            # at which point this becomes more sensible.
+            self.connection.attached_to['source'][0]._getChange(
+                refresh.number, refresh.patchset, refresh=True)
+        except Exception:
+            refresh.exc_info = sys.exc_info()
+        finally:
+            with self._refresh_lock:
+                key = (refresh.number, refresh.patchset)
+                if self._refreshes.get(key) is refresh:
+                    del self._refreshes[key]
+            refresh.done.set()
+
+    def _runPrefetchWorker(self):
+        while True:
+            refresh = self._refresh_queue.get()
+            if refresh is None:
+                return
+            self._refreshChange(refresh)
 
-        if (event.change_number and
-            self.connection.sched.getProject(event.project_name)):
-            # Call _getChange for the side effect of updating the
-            # cache.  Note that this modifies Change objects outside
-            # the main thread.
-            # NOTE(jhesketh): Ideally we'd just remove the change from the
-            # cache to denote that it needs updating. However the change
-            # object is already used by Item's and hence BuildSet's etc. and
-            # we need to update those objects by reference so that they have
-            # the correct/new information and also avoid hitting gerrit
-            # multiple times.
-            if self.connection.attached_to['source']:
-                self.connection.attached_to['source'][0]._getChange(
-                    event.change_number, event.patch_number, refresh=True)
-                # We only need to do this once since the connection maintains
-                # the cache (which is shared between all the sources)
-                # NOTE(jhesketh): We may couple sources and connections again
-                # at which point this becomes more sensible.
-        self.connection.sched.addEvent(event)
-
-    def run(self):
+    def _runDelivery(self):
         while True:
-            if self._stopped:
+            event, refresh = self._delivery_queue.get()
+            if event is None:
                 return
             try:
-                self._handleEvent()
+                if refresh:
+                    refresh.done.wait()
+                    if refresh.exc_info:
+                        self.log.error("Exception refreshing %s:" % refresh,
+                                       exc_info=refresh.exc_info)
+                        continue
+                self.connection.sched.addEvent(event)
             except:
                 self.log.exception("Exception moving Gerrit event:")
             finally:
                 self.connection.eventDone()
 
+    def _startThread(self, name, target):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def run(self):
+        name = self.connection.connection_name
+        for x in range(self.workers):
+            self._startThread('GerritPrefetchWorker-%s-%s' % (name, x),
+                              self._runPrefetchWorker)
+        self._startThread('GerritEventDelivery-%s' % name, self._runDelivery)
+        while not self._stopped:
+            try:
+                self._handleEvent()
+            except:
+                self.log.exception("Exception moving Gerrit event:")
+                self.connection.eventDone()
+        # Events which were already received are delivered first
+        self._delivery_queue.put((None, None))
+        for x in range(self.workers):
+            self._refresh_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
 
 class GerritWatcher(threading.Thread):
     log = logging.getLogger("gerrit.GerritWatcher")
@@ -206,9 +339,431 @@ class GerritWatcher(threading.Thread):
         self._stopped = True
 
 
+class GerritSSHPool(object):
+    """Run commands on Gerrit over a shared SSH connection.
+
+    Up to ``size`` commands run at once, each on its own channel of the
+    connection; further commands wait for a channel to become free.
+    """
+    log = logging.getLogger("zuul.GerritSSHPool")
+
+    def __init__(self, connection, size):
+        self.connection = connection
+        self.size = size
+        self.client = None
+        self.in_use = 0
+        self.lock = threading.Lock()
+        self.semaphore = threading.Semaphore(size)
+
+    def _open(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        client.connect(self.connection.server,
+                       username=self.connection.user,
+                       port=self.connection.port,
+                       key_filename=self.connection.keyfile)
+        return client
+
+    def _getClient(self, broken=None):
+        # Reconnect if there is no client yet, or if the one which
+        # failed is still the current one (another thread may already
+        # have replaced it).
+        with self.lock:
+            if self.client is None or self.client is broken:
+                if self.client is not None:
+                    self.client.close()
+                self.client = None
+                self.client = self._open()
+            return self.client
+
+    def acquire(self):
+        if not self.semaphore.acquire(False):
+            self._incStat('ssh.saturated')
+            self.semaphore.acquire()
+        with self.lock:
+            self.in_use += 1
+            in_use = self.in_use
+        self._gaugeStat('ssh.channels_in_use', in_use)
+
+    def release(self):
+        with self.lock:
+            self.in_use -= 1
+        self.semaphore.release()
+
+    def run(self, command, stdin_data=None):
+        self.acquire()
+        try:
+            return self.execute(command, stdin_data)
+        finally:
+            self.release()
+
+    def _openChannel(self):
+        # Until the command is sent on the channel Gerrit hasn't seen
+        # it, so failures up to here can be retried by the caller.
+        try:
+            client = self._getClient()
+            try:
+                return client.get_transport().open_session()
+            except Exception:
+                client = self._getClient(broken=client)
+                return client.get_transport().open_session()
+        except Exception as e:
+            raise exceptions.RequestNotSent(
+                "Unable to open an SSH channel to Gerrit: %s" % e)
+
+    def execute(self, command, stdin_data=None):
+        """Run a command; the caller must hold a channel."""
+        start = time.time()
+        channel = self._openChannel()
+        self.log.debug("SSH command:\n%s" % command)
+        channel.exec_command(command)
+        stdin = channel.makefile('wb')
+        stdout = channel.makefile('r')
+        stderr = channel.makefile_stderr('r')
+
+        if stdin_data:
+            stdin.write(stdin_data)
+
+        out = stdout.read()
+        self.log.debug("SSH received stdout:\n%s" % out)
+
+        ret = stdout.channel.recv_exit_status()
+        self.log.debug("SSH exit status: %s" % ret)
+
+        err = stderr.read()
+        self.log.debug("SSH received stderr:\n%s" % err)
+        self._timingStat('ssh.latency', start)
+        if ret:
+            raise Exception("Gerrit error executing %s" % command)
+        return (out, err)
+
+    def close(self):
+        with self.lock:
+            if self.client:
+                self.client.close()
+            self.client = None
+
+    def _incStat(self, key):
+        try:
+            if statsd:
+                # counters.zuul.connection.CONNECTION.ssh.saturated
+                statsd.incr('zuul.connection.%s.%s' %
+                            (self.connection.connection_name, key))
+        except:
+            self.log.exception("Exception reporting SSH stats")
+
+    def _gaugeStat(self, key, value):
+        try:
+            if statsd:
+                # gauges.zuul.connection.CONNECTION.ssh.channels_in_use
+                statsd.gauge('zuul.connection.%s.%s' %
+                             (self.connection.connection_name, key), value)
+        except:
+            self.log.exception("Exception reporting SSH stats")
+
+    def _timingStat(self, key, start):
+        try:
+            if statsd:
+                # timers.zuul.connection.CONNECTION.ssh.latency
+                statsd.timing('zuul.connection.%s.%s' %
+                              (self.connection.connection_name, key),
+                              int((time.time() - start) * 1000))
+        except:
+            self.log.exception("Exception reporting SSH stats")
+
+
+class GerritReview(object):
+    """A review of a change waiting to be sent to Gerrit."""
+
+    def __init__(self, project, change, message, action):
+        self.project = project
+        self.change = change
+        self.message = message
+        self.action = action
+        # Reviews with the same key can be sent in one command
+        self.key = (project, message, tuple(sorted(action.items())))
+        self.err = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class GerritHTTPClient(object):
+    """Query and review changes through Gerrit's REST API.
+
+    Requests share a pool of keep-alive HTTP connections.  The results
+    are returned in the same form as the output of the SSH commands.
+    """
+    log = logging.getLogger("zuul.GerritHTTPClient")
+    # Just what GerritSource uses to update a change
+    query_options = ['ALL_REVISIONS', 'ALL_FILES', 'CURRENT_COMMIT',
+                     'DETAILED_LABELS', 'DETAILED_ACCOUNTS', 'SUBMITTABLE']
+    simple_query_options = ['CURRENT_REVISION', 'CURRENT_COMMIT']
+    # Review options which are separate REST calls rather than labels
+    change_actions = ['abandon', 'restore', 'submit']
+
+    def __init__(self, connection, baseurl, user, password=None,
+                 auth_type='digest', pool_size=4, timeout=30):
+        self.connection = connection
+        self.baseurl = baseurl
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if password:
+            if auth_type == 'basic':
+                self.session.auth = requests.auth.HTTPBasicAuth(
+                    user, password)
+            else:
+                self.session.auth = requests.auth.HTTPDigestAuth(
+                    user, password)
+            # Authenticated requests go under /a/
+            self.url = baseurl + '/a'
+        else:
+            self.url = baseurl
+
+    def _request(self, method, path, **kw):
+        start = time.time()
+        self.log.debug("HTTP %s %s %s" % (method, path, kw))
+        try:
+            r = self.session.request(method, self.url + path,
+                                     timeout=self.timeout, **kw)
+        except requests.exceptions.ConnectionError as e:
+            # Only a failure to connect means Gerrit never saw the
+            # request; anything later may have been acted on.
+            reason = getattr(e.args[0] if e.args else None, 'reason', None)
+            if (isinstance(e, requests.exceptions.ConnectTimeout) or
+                isinstance(reason, NewConnectionError)):
+                raise exceptions.RequestNotSent(
+                    "Unable to connect to Gerrit: %s" % e)
+            raise
+        self.log.debug("HTTP received %s:\n%s" % (r.status_code, r.text))
+        try:
+            if statsd:
+                # timers.zuul.connection.CONNECTION.http.latency
+                statsd.timing('zuul.connection.%s.http.latency' %
+                              self.connection.connection_name,
+                              int((time.time() - start) * 1000))
+        except:
+            self.log.exception("Exception reporting HTTP stats")
+        r.raise_for_status()
+        return r
+
+    def _json(self, method, path, **kw):
+        text = self._request(method, path, **kw).text
+        # Strip the prefix Gerrit uses to prevent XSSI
+        if text.startswith(")]}'"):
+            text = text[4:]
+        if not text.strip():
+            return None
+        return json.loads(text)
+
+    def _queryParams(self, queries, options, start=None):
+        params = [('q', q) for q in queries]
+        params += [('o', o) for o in options]
+        if start:
+            params.append(('S', start))
+        return params
+
+    def query(self, query):
+        changes = self.queryChanges(query)
+        if not changes:
+            return False
+        return changes[0]
+
+    def queryChanges(self, query):
+        changes = self._json('GET', '/changes/',
+                             params=self._queryParams([query],
+                                                      self.query_options))
+        ret = []
+        for change in changes or []:
+            related = None
+            if change['status'] == 'NEW':
+                related = self._json(
+                    'GET', '/changes/%s/revisions/current/related' %
+                    change['_number'])['changes']
+            ret.append(self._formatChange(change, related))
+        self.log.debug("Received data from Gerrit query: \n%s" %
+                       (pprint.pformat(ret)))
+        return ret
+
+    def simpleQuery(self, query):
+        return self.simpleQueries([query])[0]
+
+    def simpleQueries(self, queries):
+        """Run several queries in one request; return a list of the
+        results of each."""
+        data = self._json('GET', '/changes/',
+                          params=self._queryParams(
+                              queries, self.simple_query_options))
+        if len(queries) == 1:
+            data = [data]
+        results = []
+        for query, changes in zip(queries, data):
+            # Gerrit marks the last change when there are more
+            while changes and changes[-1].get('_more_changes'):
+                changes += self._json('GET', '/changes/',
+                                      params=self._queryParams(
+                                          [query],
+                                          self.simple_query_options,
+                                          start=len(changes)))
+            results.append([self._formatChange(c) for c in changes])
+        return results
+
+    def review(self, project, change, message, action={}):
+        number, patchset = change.split(',')
+        review = {'labels': {}}
+        if message:
+            review['message'] = message
+        for key, val in action.items():
+            if key in self.change_actions:
+                continue
+            if key == 'label':
+                label, val = val.split('=')
+            else:
+                # --code-review is the Code-Review label
+                label = '-'.join([p.capitalize() for p in key.split('-')])
+            review['labels'][label] = int(val)
+        self._json('POST', '/changes/%s/revisions/%s/review' %
+                   (number, patchset), json=review)
+        for key in self.change_actions:
+            if action.get(key):
+                try:
+                    self._json('POST', '/changes/%s/%s' % (number, key),
+                               json={})
+                except exceptions.RequestNotSent as e:
+                    # The review has been posted, so sending the
+                    # report again would post it twice.
+                    raise Exception("Unable to %s change %s: %s" %
+                                    (key, change, e))
+        return ''
+
+    def uploadPack(self, project):
+        data = self._request('GET', '/%s/info/refs' % project,
+                             params={'service': 'git-upload-pack'}).content
+        # Skip the "# service=git-upload-pack" line and the flush
+        # after it so that this looks like the output of
+        # git-upload-pack.
+        if data.startswith('001e# service='):
+            data = data[len('001e# service=git-upload-pack\n'):]
+            if data.startswith('0000'):
+                data = data[4:]
+        return data
+
+    def _formatTime(self, stamp):
+        # Gerrit's timestamps are UTC, such as
+        # "2013-02-01 09:59:32.126000000"
+        return calendar.timegm(time.strptime(stamp[:19],
+                                             '%Y-%m-%d %H:%M:%S'))
+
+    def _formatAccount(self, account):
+        return dict([(k, account[k]) for k in ('name', 'email', 'username')
+                     if k in account])
+
+    def _formatRef(self, number, patchset):
+        return 'refs/changes/%02d/%s/%s' % (number % 100, number, patchset)
+
+    def _formatChange(self, change, related=None):
+        number = change['_number']
+        data = {'id': change['change_id'],
+                'number': str(number),
+                'project': change['project'],
+                'branch': change['branch'],
+                'subject': change.get('subject'),
+                'status': change['status'],
+                'open': change['status'] in ('NEW', 'DRAFT'),
+                'owner': self._formatAccount(change.get('owner', {})),
+                'url': '%s/%s' % (self.baseurl, number)}
+        current = change.get('current_revision')
+        patchsets = []
+        parents = []
+        for revision, rev in change.get('revisions', {}).items():
+            ps = {'number': str(rev['_number']),
+                  'ref': rev['ref'],
+                  'revision': revision}
+            if 'files' in rev:
+                # The SSH query includes the commit message as a file
+                ps['files'] = [{'file': '/COMMIT_MSG'}]
+                ps['files'] += [{'file': f} for f in sorted(rev['files'])]
+            patchsets.append(ps)
+            if revision == current:
+                data['currentPatchSet'] = ps
+                commit = rev.get('commit', {})
+                if 'message' in commit:
+                    data['commitMessage'] = commit['message']
+                parents = [p['commit'] for p in commit.get('parents', [])]
+        patchsets.sort(key=lambda ps: int(ps['number']))
+        data['patchSets'] = patchsets
+        if 'labels' in change:
+            if current:
+                data['currentPatchSet']['approvals'] = \
+                    self._formatApprovals(change['labels'])
+            data['submitRecords'] = self._formatSubmitRecords(change)
+        if related:
+            self._formatRelated(data, related, parents)
+        return data
+
+    def _formatApprovals(self, labels):
+        approvals = []
+        for label, info in labels.items():
+            for vote in info.get('all', []):
+                if not vote.get('value'):
+                    continue
+                approval = {'type': label,
+                            'description': label,
+                            'value': str(vote['value']),
+                            'by': self._formatAccount(vote)}
+                if 'date' in vote:
+                    approval['grantedOn'] = self._formatTime(vote['date'])
+                approvals.append(approval)
+        return approvals
+
+    def _formatSubmitRecords(self, change):
+        if change['status'] not in ('NEW', 'DRAFT'):
+            return [{'status': 'CLOSED'}]
+        if change.get('submittable'):
+            return [{'status': 'OK'}]
+        labels = []
+        for label, info in change['labels'].items():
+            if info.get('approved'):
+                status = 'OK'
+            elif info.get('rejected'):
+                status = 'REJECT'
+            elif info.get('optional'):
+                status = 'MAY'
+            else:
+                status = 'NEED'
+            labels.append({'label': label, 'status': status})
+        return [{'status': 'NOT_READY', 'labels': labels}]
+
+    def _formatRelated(self, data, related, parents):
+        # The changes related to this one by git history; the parent
+        # of this change's current revision is the change it depends
+        # on, and the changes whose parent is that revision need it.
+        revision = data['currentPatchSet']['revision']
+        for other in related:
+            commit = other['commit']
+            number = other['_change_number']
+            patchset = other['_revision_number']
+            record = {'id': other['change_id'],
+                      'number': str(number),
+                      'ref': self._formatRef(number, patchset),
+                      'revision': commit['commit']}
+            if commit['commit'] in parents:
+                record['isCurrentPatchSet'] = (
+                    patchset == other.get('_current_revision_number'))
+                data.setdefault('dependsOn', []).append(record)
+            elif revision in [p['commit'] for p in commit['parents']]:
+                data.setdefault('neededBy', []).append(record)
+
+
 class GerritConnection(BaseConnection):
     driver_name = 'gerrit'
     log = logging.getLogger("connection.gerrit")
+    # The most changes to review in one command
+    review_batch_size = 20
 
     def __init__(self, connection_name, connection_config):
         super(GerritConnection, self).__init__(connection_name,
@@ -226,36 +781,31 @@ class GerritConnection(BaseConnection):
         self.keyfile = self.connection_config.get('sshkey', None)
         self.watcher_thread = None
         self.event_queue = None
-        self.client = None
+        self.ssh_pool = GerritSSHPool(
+            self, int(self.connection_config.get('ssh_channels', 4)))
+        self._pending_reviews = {}  # key -> [GerritReview]
+        self._review_lock = threading.Lock()
 
         self.baseurl = self.connection_config.get('baseurl',
                                                   'https://%s' % self.server)
-
-        self._change_cache = {}
+        self.http = None
+        if self.connection_config.get('backend', 'ssh') == 'http':
+            self.http = GerritHTTPClient(
+                self, self.baseurl.rstrip('/'), self.user,
+                password=self.connection_config.get('password'),
+                auth_type=self.connection_config.get('auth_type', 'digest'),
+                pool_size=int(self.connection_config.get('http_pool_size',
+                                                         4)))
+
+        self.change_cache = ChangeCache(
+            self.connection_name,
+            max_size=int(self.connection_config.get('change_cache_size',
+                                                    10000)),
+            ttl=int(self.connection_config.get('change_cache_ttl', 3600)))
         self.gerrit_event_connector = None
 
-    def getCachedChange(self, key):
-        if key in self._change_cache:
-            return self._change_cache.get(key)
-        return None
-
-    def updateChangeCache(self, key, value):
-        self._change_cache[key] = value
-
-    def deleteCachedChange(self, key):
-        if key in self._change_cache:
-            del self._change_cache[key]
-
-    def maintainCache(self, relevant):
-        # This lets the user supply a list of change objects that are
-        # still in use.  Anything in our cache that isn't in the supplied
-        # list should be safe to remove from the cache.
-        remove = []
-        for key, change in self._change_cache.items():
-            if change not in relevant:
-                remove.append(key)
-        for key in remove:
-            del self._change_cache[key]
+    def maintainCache(self, relevant, prune=True):
+        self.change_cache.maintain(relevant, prune)
 
     def addEvent(self, data):
         return self.event_queue.put((time.time(), data))
@@ -267,19 +817,94 @@ class GerritConnection(BaseConnection):
         self.event_queue.task_done()
 
     def review(self, project, change, message, action={}):
-        cmd = 'gerrit review --project %s' % project
-        if message:
-            cmd += ' --message "%s"' % message
-        for key, val in action.items():
+        if self.http:
+            return self.http.review(project, change, message, action)
+        # Reviews which are waiting for an SSH channel are collected,
+        # and whichever caller gets a channel first sends all of the
+        # ones with the same project, message and action in a single
+        # command.  Gerrit doesn't say which change of a failed batch
+        # was the problem, so a failed batch is resent a review at a
+        # time.  Only reviews which are safe to send twice are batched:
+        # a message or vote would be posted again on the changes Gerrit
+        # had already reviewed, and a change could be submitted twice.
+        review = GerritReview(project, change, message, action)
+        batchable = not (message or action.get('submit') or
+                         [v for v in action.values() if v is not True])
+        if batchable:
+            with self._review_lock:
+                self._pending_reviews.setdefault(review.key,
+                                                 []).append(review)
+        self.ssh_pool.acquire()
+        try:
+            if batchable:
+                with self._review_lock:
+                    batch = self._takeReviews(review)
+            else:
+                batch = [review]
+            if batch:
+                self._sendReviews(batch)
+        finally:
+            self.ssh_pool.release()
+        review.done.wait()
+        if review.exception:
+            raise review.exception
+        return review.err
+
+    def _takeReviews(self, review):
+        """Return the pending reviews to send along with review, or
+        None if another caller has already sent it."""
+        pending = self._pending_reviews.get(review.key, [])
+        if review not in pending:
+            return None
+        pending.remove(review)
+        batch = [review] + pending[:self.review_batch_size - 1]
+        del pending[:self.review_batch_size - 1]
+        if not pending:
+            del self._pending_reviews[review.key]
+        return batch
+
+    def _reviewCommand(self, reviews):
+        review = reviews[0]
+        cmd = 'gerrit review --project %s' % review.project
+        if review.message:
+            cmd += ' --message "%s"' % review.message
+        for key, val in review.action.items():
             if val is True:
                 cmd += ' --%s' % key
             else:
                 cmd += ' --%s %s' % (key, val)
-        cmd += ' %s' % change
-        out, err = self._ssh(cmd)
-        return err
+        cmd += ' %s' % ' '.join([r.change for r in reviews])
+        return cmd
+
+    def _sendReviews(self, reviews):
+        if len(reviews) > 1:
+            self.log.debug("Sending %s reviews in one command" %
+                           len(reviews))
+            try:
+                out, err = self.ssh_pool.execute(
+                    self._reviewCommand(reviews))
+            except Exception:
+                # Gerrit doesn't say which of the changes failed, so
+                # send them again one at a time to find out.
+                self.log.exception("Unable to send %s reviews in one "
+                                   "command, sending them one at a time:" %
+                                   len(reviews))
+            else:
+                for r in reviews:
+                    r.err = err
+                    r.done.set()
+                return
+        for r in reviews:
+            try:
+                out, r.err = self.ssh_pool.execute(self._reviewCommand([r]))
+            except Exception as e:
+                r.exception = e
+            finally:
+                r.done.set()
 
     def query(self, query):
+        if self.http:
+            return self.http.query(query)
         args = '--all-approvals --comments --commit-message'
         args += ' --current-patch-set --dependencies --files'
         args += ' --patch-sets --submit-records'
@@ -298,7 +923,37 @@ class GerritConnection(BaseConnection):
                        (pprint.pformat(data)))
         return data
 
+    def queryChanges(self, numbers):
+        """Query several changes at once; return the data for each of
+        those found, in the same form as query()."""
+        query = ' OR '.join(['change:%s' % n for n in numbers])
+        if self.http:
+            return self.http.queryChanges(query)
+        args = '--all-approvals --comments --commit-message'
+        args += ' --current-patch-set --dependencies --files'
+        args += ' --patch-sets --submit-records'
+        cmd = 'gerrit query --format json %s %s' % (
+            args, query)
+        out, err = self._ssh(cmd)
+        # The last line holds the statistics
+        data = [json.loads(line) for line in out.split('\n')
+                if line.startswith('{')]
+        data = [d for d in data if d.get('type') != 'stats']
+        self.log.debug("Received data from Gerrit query: \n%s" %
+                       (pprint.pformat(data)))
+        return data
+
+    def simpleQueries(self, queries):
+        """Run several queries and return a list of the results of
+        each; over HTTP they are sent in a single request."""
+        if self.http:
+            return self.http.simpleQueries(queries)
+        return [self.simpleQuery(query) for query in queries]
+
     def simpleQuery(self, query):
+        if self.http:
+            return self.http.simpleQuery(query)
+
         def _query_chunk(query):
             args = '--commit-message --current-patch-set'
 
@@ -349,45 +1004,14 @@ class GerritConnection(BaseConnection):
         return alldata
 
     def _uploadPack(self, project):
+        if self.http:
+            return self.http.uploadPack(project)
         cmd = "git-upload-pack %s" % project
         out, err = self._ssh(cmd, "0000")
         return out
 
-    def _open(self):
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        client.connect(self.server,
-                       username=self.user,
-                       port=self.port,
-                       key_filename=self.keyfile)
-        self.client = client
-
     def _ssh(self, command, stdin_data=None):
-        if not self.client:
-            self._open()
-
-        try:
-            self.log.debug("SSH command:\n%s" % command)
-            stdin, stdout, stderr = self.client.exec_command(command)
-        except:
-            self._open()
-            stdin, stdout, stderr = self.client.exec_command(command)
-
-        if stdin_data:
-            stdin.write(stdin_data)
-
-        out = stdout.read()
-        self.log.debug("SSH received stdout:\n%s" % out)
-
-        ret = stdout.channel.recv_exit_status()
-        self.log.debug("SSH exit status: %s" % ret)
-
-        err = stderr.read()
-        self.log.debug("SSH received stderr:\n%s" % err)
-        if ret:
-            raise Exception("Gerrit error executing %s" % command)
-        return (out, err)
+        return self.ssh_pool.run(command, stdin_data)
 
     def getInfoRefs(self, project):
         try:
@@ -443,6 +1067,7 @@ class GerritConnection(BaseConnection):
         self.log.debug("Stopping Gerrit Conncetion/Watchers")
         self._stop_watcher_thread()
         self._stop_event_connector()
+        self.ssh_pool.close()
 
     def _stop_watcher_thread(self):
         if self.watcher_thread:
@@ -465,7 +1090,9 @@ class GerritConnection(BaseConnection):
             self.gerrit_event_connector.join()
 
     def _start_event_connector(self):
-        self.gerrit_event_connector = GerritEventConnector(self)
+        self.gerrit_event_connector = GerritEventConnector(
+            self, int(self.connection_config.get('event_prefetch_workers',
+                                                 4)))
         self.gerrit_event_connector.start()
 
 
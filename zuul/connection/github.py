@@ -25,6 +25,7 @@ from github3.exceptions import MethodNotAllowed
 
 from zuul.connection import BaseConnection
 from zuul.exceptions import MergeFailure
+from zuul.lib.changecache import ChangeCache
 from zuul.model import GithubTriggerEvent
 
 
@@ -249,7 +250,11 @@ class GithubConnection(BaseConnection):
         super(GithubConnection, self).__init__(
             connection_name, connection_config)
         self.github = None
-        self._change_cache = {}
+        self.change_cache = ChangeCache(
+            self.connection_name,
+            max_size=int(self.connection_config.get('change_cache_size',
+                                                    10000)),
+            ttl=int(self.connection_config.get('change_cache_ttl', 3600)))
         self._git_ssh = bool(self.connection_config.get('sshkey', None))
 
     def onLoad(self):
@@ -273,10 +278,8 @@ class GithubConnection(BaseConnection):
                 "No Github credentials found in zuul configuration, cannot "
                 "authenticate.")
 
-    def maintainCache(self, relevant):
-        for key, change in self._change_cache.items():
-            if change not in relevant:
-                del self._change_cache[key]
+    def maintainCache(self, relevant, prune=True):
+        self.change_cache.maintain(relevant, prune)
 
     def getGitUrl(self, project):
         if self._git_ssh:
@@ -33,3 +33,9 @@ class RevNotFound(Exception):
 
 class MergeFailure(Exception):
     pass
+
+
+class RequestNotSent(Exception):
+    """A request which failed before it reached the remote server, and
+    so may safely be sent again."""
+    pass
@@ -116,6 +116,11 @@ class LayoutSchema(object):
            }
     jobs = [job]
 
+    mutex = {v.Required('name'): str,
+             'count': v.All(int, v.Range(min=1)),
+             }
+    mutexes = [mutex]
+
     job_name = v.Schema(v.Match("^\S+$"))
 
     def validateJob(self, value, path=[]):
@@ -277,6 +282,7 @@ class LayoutSchema(object):
         schema = v.Schema({'includes': self.includes,
                            v.Required('pipelines'): [self.pipeline],
                            'jobs': self.jobs,
+                           'mutexes': self.mutexes,
                            'project-templates': project_templates,
                            v.Required('projects'): projects,
                            })
@@ -337,6 +343,8 @@ class LayoutValidator(object):
         self.checkDuplicateNames(data['pipelines'], ['pipelines'])
         if 'jobs' in data:
             self.checkDuplicateNames(data['jobs'], ['jobs'])
+        if 'mutexes' in data:
+            self.checkDuplicateNames(data['mutexes'], ['mutexes'])
         self.checkDuplicateNames(data['projects'], ['projects'])
         if 'project-templates' in data:
             self.checkDuplicateNames(
@@ -0,0 +1,138 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import threading
+import time
+
+import extras
+
+statsd = extras.try_import('statsd.statsd')
+
+
+class ChangeCache(object):
+    """A bounded cache of the change objects of a connection.
+
+    Changes are evicted least recently used first, and those which
+    haven't been used for ttl seconds are expired by maintain().  Since
+    queue items refer to the cached change objects (which are updated
+    in place when events arrive), a change is never evicted while it
+    is in use: maintain() is given the changes referenced by queue
+    items, and each call starts a new generation; changes used since
+    the last call are kept too, because they may have been enqueued
+    since then.  So the cache may hold more than max_size changes until
+    the next call.
+    """
+    log = logging.getLogger("zuul.ChangeCache")
+
+    def __init__(self, name, max_size=10000, ttl=3600):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> [change, last used time, generation last used]
+        self._entries = collections.OrderedDict()
+        self._relevant = set()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._reported = (0, 0, 0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        with self.lock:
+            return list(self._entries.keys())
+
+    def get(self, key):
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[1] = time.time()
+            entry[2] = self.generation
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, change):
+        with self.lock:
+            self._entries.pop(key, None)
+            self._entries[key] = [change, time.time(), self.generation]
+            if len(self._entries) > self.max_size:
+                self._evict(len(self._entries) - self.max_size)
+
+    def delete(self, key):
+        with self.lock:
+            self._entries.pop(key, None)
+
+    def _isEvictable(self, entry):
+        change, used, generation = entry
+        return (generation < self.generation and
+                change not in self._relevant)
+
+    def _evict(self, count):
+        # The entries are in order of use, oldest first
+        for key, entry in list(self._entries.items()):
+            if count <= 0:
+                break
+            if self._isEvictable(entry):
+                del self._entries[key]
+                self.evictions += 1
+                count -= 1
+
+    def maintain(self, relevant, prune=False):
+        """Expire changes which haven't been used for ttl seconds, and
+        evict any over max_size, other than the relevant ones (those
+        referenced by queue items).  Starts a new generation.
+
+        With prune, every change which isn't relevant is removed."""
+        with self.lock:
+            self._relevant = set(relevant)
+            self.generation += 1
+            expired = time.time() - self.ttl
+            for key, entry in list(self._entries.items()):
+                if not prune and entry[1] >= expired:
+                    # Everything after this was used more recently
+                    break
+                if self._isEvictable(entry):
+                    del self._entries[key]
+                    self.evictions += 1
+            if len(self._entries) > self.max_size:
+                self._evict(len(self._entries) - self.max_size)
+            size = len(self._entries)
+            counts = (self.hits, self.misses, self.evictions)
+            reported, self._reported = self._reported, counts
+        self.log.debug("Change cache for %s holds %s changes "
+                       "(%s hits, %s misses, %s evictions)" %
+                       ((self.name, size) + counts))
+        try:
+            if statsd:
+                # gauges.zuul.connection.CONNECTION.cache.size
+                # counters.zuul.connection.CONNECTION.cache.hit
+                # counters.zuul.connection.CONNECTION.cache.miss
+                # counters.zuul.connection.CONNECTION.cache.evicted
+                key = 'zuul.connection.%s.cache' % self.name
+                statsd.gauge(key + '.size', size)
+                for stat, new, old in zip(['hit', 'miss', 'evicted'],
+                                          counts, reported):
+                    if new > old:
+                        statsd.incr('%s.%s' % (key, stat), new - old)
+        except:
+            self.log.exception("Exception reporting change cache stats")
@@ -0,0 +1,156 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+# Each record is a header followed by a payload.  An added event has
+# the pickled event as its payload, a processed event has none.
+HEADER = struct.Struct('!cQII')
+ADDED = b'A'
+DONE = b'D'
+
+
+class EventJournal(object):
+    """An append-only journal of the trigger events waiting to be
+    processed.
+
+    Events are written to the journal as they are queued, and marked
+    done once they have been processed, so the events which were
+    waiting can be replayed after the scheduler stops, however it
+    stops.  Once enough of the journal is about events which are done,
+    it is compacted by rewriting it with only the waiting events.
+    """
+    log = logging.getLogger("zuul.EventJournal")
+
+    # How many done events there may be in the journal before it is
+    # compacted (it is also only compacted once there are more done
+    # events than waiting ones).
+    compact_threshold = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Sequence number -> pickled event, for the waiting events
+        self.pending = {}
+        self.done = 0
+        self.sequence = 0
+        self.file = None
+
+    def open(self):
+        """Open the journal, returning (sequence number, event) for
+        the events which were waiting when it was last written, oldest
+        first."""
+        with self.lock:
+            events = self._replay()
+            self._compact()
+        return events
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self._compact()
+                self.file.close()
+                self.file = None
+
+    def append(self, event):
+        """Record that an event is waiting, and return its sequence
+        number in the journal."""
+        payload = pickle.dumps(event, 2)
+        with self.lock:
+            self.sequence += 1
+            self._write(ADDED, self.sequence, payload)
+            self.pending[self.sequence] = payload
+            return self.sequence
+
+    def remove(self, sequence):
+        """Record that an event has been processed."""
+        with self.lock:
+            if self.pending.pop(sequence, None) is None:
+                return
+            self._write(DONE, sequence, b'')
+            self.done += 1
+            if (self.done >= self.compact_threshold and
+                self.done > len(self.pending)):
+                self._compact()
+
+    def _write(self, kind, sequence, payload):
+        header = HEADER.pack(kind, sequence, len(payload),
+                             zlib.crc32(payload) & 0xffffffff)
+        self.file.write(header + payload)
+        # Flushing is enough for the events to outlive the process;
+        # the operating system writes them out in its own time.
+        self.file.flush()
+
+    def _read(self, f):
+        while True:
+            offset = f.tell()
+            header = f.read(HEADER.size)
+            if not header:
+                return
+            if len(header) < HEADER.size:
+                break
+            kind, sequence, length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if (len(payload) < length or kind not in (ADDED, DONE) or
+                zlib.crc32(payload) & 0xffffffff != crc):
+                break
+            yield kind, sequence, payload
+        # The process stopped partway through writing this record
+        self.log.warning("Ignoring the end of the event journal %s after "
+                         "offset %s, which is incomplete" %
+                         (self.path, offset))
+
+    def _replay(self):
+        self.pending = {}
+        self.done = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for kind, sequence, payload in self._read(f):
+                    self.sequence = max(self.sequence, sequence)
+                    if kind == ADDED:
+                        self.pending[sequence] = payload
+                    else:
+                        self.pending.pop(sequence, None)
+        events = []
+        for sequence in sorted(self.pending):
+            try:
+                events.append((sequence,
+                               pickle.loads(self.pending[sequence])))
+            except Exception:
+                self.log.exception("Unable to load event %s from the "
+                                   "event journal" % (sequence,))
+                del self.pending[sequence]
+        self.log.debug("Replayed %s events from the event journal" %
+                       len(events))
+        return events
+
+    def _compact(self):
+        # Write the waiting events to a new journal, and only replace
+        # the old one once that is safely on disk.
+        self.log.debug("Compacting the event journal to %s events" %
+                       len(self.pending))
+        if self.file:
+            self.file.close()
+        tmp_path = self.path + '.tmp'
+        self.file = open(tmp_path, 'wb')
+        for sequence in sorted(self.pending):
+            self._write(ADDED, sequence, self.pending[sequence])
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(tmp_path, self.path)
+        self.file = open(self.path, 'ab')
+        self.done = 0
@@ -0,0 +1,34 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+
+# Inline flags apply to the whole of a pattern, and group references
+# are numbered (or named) across it, so patterns using them can't be
+# combined with others.
+UNSAFE_RE = re.compile(r'\(\?[aiLmsux]|\\[1-9]|\(\?P=')
+
+
+def combineRegexes(patterns):
+    """Compile regexes into one which matches (or searches) wherever
+    any of them would, or return None if they can't be combined."""
+    if not patterns:
+        return None
+    if len(patterns) == 1:
+        return re.compile(patterns[0])
+    for pattern in patterns:
+        if UNSAFE_RE.search(pattern):
+            return None
+    try:
+        return re.compile('|'.join(['(?:%s)' % p for p in patterns]))
+    except re.error:
+        return None
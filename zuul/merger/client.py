@@ -98,9 +98,11 @@ class MergeClient(object):
         self.submitJob('merger:merge', data, build_set, precedence)
 
     def updateRepo(self, project, url, build_set,
-                   precedence=zuul.model.PRECEDENCE_NORMAL):
+                   precedence=zuul.model.PRECEDENCE_NORMAL,
+                   connection_name=None):
         data = dict(project=project,
-                    url=url)
+                    url=url,
+                    connection_name=connection_name)
         self.submitJob('merger:update', data, build_set, precedence)
 
     def onBuildCompleted(self, job):
@@ -13,11 +13,19 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import git
+import gitdb
+import io
 import os
 import logging
+import shutil
+import tempfile
+import threading
+import time
 
 import zuul.model
+from zuul.merger import treemerge
 
 
 def reset_repo_to_head(repo):
@@ -43,48 +51,104 @@ class ZuulReference(git.Reference):
 class Repo(object):
     log = logging.getLogger("zuul.Repo")
 
-    def __init__(self, remote, local, email, username):
+    def __init__(self, remote, local, email, username, env=None):
         self.remote_url = remote
         self.local_path = local
         self.email = email
         self.username = username
+        # The environment git commands on this repo are run with
+        self.env = env or {}
         self._initialized = False
+        # The git.Repo used for everything done with this repo, which
+        # is kept until it is invalidated
+        self._repo = None
         try:
             self._ensure_cloned()
         except:
             self.log.exception("Unable to initialize repo for %s" % remote)
 
+    def _isCloned(self):
+        return os.path.exists(os.path.join(self.local_path, '.git'))
+
+    def _clone(self):
+        git.Repo.clone_from(self.remote_url, self.local_path, env=self.env)
+
     def _ensure_cloned(self):
-        repo_is_cloned = os.path.exists(os.path.join(self.local_path, '.git'))
+        repo_is_cloned = self._isCloned()
         if self._initialized and repo_is_cloned:
             return
+        if repo_is_cloned:
+            try:
+                git.Repo(self.local_path)
+            except git.exc.InvalidGitRepositoryError:
+                self.log.warning("Removing corrupt repository %s" %
+                                 self.local_path)
+                shutil.rmtree(self.local_path)
+                repo_is_cloned = False
         # If the repo does not exist, clone the repo.
         if not repo_is_cloned:
             self.log.debug("Cloning from %s to %s" % (self.remote_url,
                                                       self.local_path))
-            git.Repo.clone_from(self.remote_url, self.local_path)
-        repo = git.Repo(self.local_path)
+            self._clone()
+        self._configureUser(git.Repo(self.local_path))
+        self._initialized = True
+
+    def _configureUser(self, repo):
+        # Only write the config when it changes, rather than each time
+        # the merger starts.
+        values = {}
         if self.email:
-            repo.config_writer().set_value('user', 'email',
-                                           self.email)
+            values['email'] = self.email
         if self.username:
-            repo.config_writer().set_value('user', 'name',
-                                           self.username)
-        repo.config_writer().write()
-        self._initialized = True
+            values['name'] = self.username
+        reader = repo.config_reader('repository')
+        changed = [(option, value) for option, value in values.items()
+                   if reader.get_value('user', option, '') != value]
+        if changed:
+            writer = repo.config_writer()
+            for option, value in changed:
+                writer.set_value('user', option, value)
+            writer.release()
 
     def isInitialized(self):
         return self._initialized
 
     def createRepoObject(self):
+        # The repo is only checked again once the handle has been
+        # invalidated, or if the repo has been removed.
+        if self._repo is not None and os.path.isdir(self._repo.git_dir):
+            return self._repo
         try:
             self._ensure_cloned()
-            repo = git.Repo(self.local_path)
+            self._repo = self._openRepo()
         except:
             self.log.exception("Unable to initialize repo for %s" %
                                self.local_path)
+            raise
+        return self._repo
+
+    def _openRepo(self):
+        repo = git.Repo(self.local_path)
+        repo.git.update_environment(**self.env)
         return repo
 
+    def setEnv(self, env):
+        if env == self.env:
+            return
+        # Variables which are no longer set are removed from the
+        # handle's environment by giving them as None.
+        changed = dict([(key, None) for key in self.env])
+        changed.update(env)
+        self.env = env
+        if self._repo is not None:
+            self._repo.git.update_environment(**changed)
+
+    def invalidate(self):
+        """Forget the handle on the repo, so that the repo is checked,
+        and cloned again if need be, the next time it is used."""
+        self._repo = None
+        self._initialized = False
+
     def reset(self):
         self.log.debug("Resetting repository %s" % self.local_path)
         self.update()
@@ -98,9 +162,12 @@ class Repo(object):
         # try reset to remote HEAD (usually origin/master)
         # If it fails, pick the first reference
         try:
-            repo.head.reference = origin.refs['HEAD']
+            head = origin.refs['HEAD']
         except IndexError:
-            repo.head.reference = origin.refs[0]
+            head = origin.refs[0]
+        # Detach HEAD, since git refuses to fetch into the branch HEAD
+        # refers to, and a reused merge leaves HEAD as it is here.
+        repo.head.reference = head.commit
         reset_repo_to_head(repo)
         repo.git.clean('-x', '-f', '-d')
 
@@ -154,6 +221,10 @@ class Repo(object):
         repo.git.merge(*args)
         return repo.head.commit
 
+    def prefetch(self, refs):
+        # Changes are fetched as they are merged
+        pass
+
     def fetch(self, ref):
         repo = self.createRepoObject()
         # The git.remote.fetch method may read in git progress info and
@@ -170,6 +241,21 @@ class Repo(object):
         repo = self.createRepoObject()
         repo.git.fetch(repository, refspec)
 
+    def getCommit(self, hexsha):
+        """Return the commit with the given sha, or None if the repo
+        does not have it (any more)."""
+        repo = self.createRepoObject()
+        try:
+            return repo.commit(hexsha)
+        except Exception:
+            return None
+
+    def deleteZuulRefs(self, refs):
+        repo = self.createRepoObject()
+        self.log.debug("Deleting %s zuul refs on %s" % (len(refs), repo))
+        for ref in refs:
+            ZuulReference.delete(repo, ref)
+
     def createZuulRef(self, ref, commit='HEAD'):
         repo = self.createRepoObject()
         self.log.debug("CreateZuulRef %s at %s on %s" % (ref, commit, repo))
@@ -196,11 +282,242 @@ class Repo(object):
         origin.fetch(tags=True)
 
 
+class InProcessRepo(Repo):
+    """A bare repo in which changes are merged without a working tree.
+
+    Merges and cherry-picks are worked out on the trees of the commits
+    involved, and the resulting trees and commits are written to the
+    object database directly, so apart from fetching, git is only run
+    to merge the content of files which were changed on both sides.
+    The changes to merge are fetched together beforehand.
+    """
+    log = logging.getLogger("zuul.InProcessRepo")
+
+    def __init__(self, remote, local, email, username, env=None):
+        # Ref -> hexsha of the commits fetched for the current merge
+        self._fetched = {}
+        # The sha of the commit the next change is merged onto
+        self._head = None
+        super(InProcessRepo, self).__init__(remote, local, email, username,
+                                            env)
+
+    def _isCloned(self):
+        # Repos cloned for the git backend may be used as they are
+        return (os.path.exists(os.path.join(self.local_path, 'objects')) or
+                super(InProcessRepo, self)._isCloned())
+
+    def _clone(self):
+        # A bare clone has no remote-tracking branches, so set up the
+        # remote as a clone would.
+        repo = git.Repo.init(self.local_path, bare=True)
+        repo.git.update_environment(**self.env)
+        origin = repo.create_remote('origin', self.remote_url)
+        origin.fetch()
+        self._resetBranches(repo)
+
+    def _openRepo(self):
+        # Read objects in this process rather than with git cat-file
+        repo = git.Repo(self.local_path, odbt=git.GitDB)
+        repo.git.update_environment(**self.env)
+        return repo
+
+    def createRepoObject(self):
+        repo = super(InProcessRepo, self).createRepoObject()
+        # Pick up the packs git has written since the repo was opened
+        repo.odb.update_cache()
+        return repo
+
+    def _resetBranches(self, repo):
+        origin = repo.remotes.origin
+        for ref in origin.refs:
+            if ref.remote_head == 'HEAD':
+                continue
+            repo.create_head(ref.remote_head, ref, force=True)
+
+    def reset(self):
+        # There is no working tree to reset, only the branches
+        self.log.debug("Resetting branches of repository %s" %
+                       self.local_path)
+        self.update()
+        self._resetBranches(self.createRepoObject())
+
+    def checkout(self, ref):
+        repo = self.createRepoObject()
+        commit = repo.commit(ref)
+        self._head = commit.hexsha
+        return commit
+
+    def prefetch(self, refs):
+        # Only the refs of the changes about to be merged are kept
+        self._fetched = {}
+        self._fetchRefs(refs)
+
+    def _fetchRefs(self, refs):
+        refs = [r for r in set(refs) if r and r not in self._fetched]
+        if not refs:
+            return
+        repo = self.createRepoObject()
+        self.log.debug("Fetching %s" % (refs,))
+        repo.git.fetch('origin', *refs)
+        path = os.path.join(repo.git_dir, 'FETCH_HEAD')
+        with open(path) as f:
+            lines = f.readlines()
+        if len(lines) != len(refs):
+            # Git lists the refs in the order they were asked for, so
+            # it's not clear which is which.
+            self.log.warning("Fetched %s refs instead of %s" %
+                             (len(lines), len(refs)))
+            return
+        for ref, line in zip(refs, lines):
+            self._fetched[ref] = line.split()[0]
+
+    def _getFetched(self, repo, ref):
+        if ref not in self._fetched:
+            self._fetchRefs([ref])
+        if ref not in self._fetched:
+            self.fetch(ref)
+            return repo.commit('FETCH_HEAD')
+        return repo.commit(self._fetched[ref])
+
+    def _mergeFile(self, repo, base, ours, theirs, path):
+        # Merge the content of a file with "git merge-file", which
+        # works on files outside of any working tree.
+        self.log.debug("Merging the content of %s" % path)
+        tmp_dir = tempfile.mkdtemp(prefix='zuul-merge-')
+        try:
+            paths = []
+            for name, binsha in (('ours', ours), ('base', base),
+                                 ('theirs', theirs)):
+                paths.append(os.path.join(tmp_dir, name))
+                with open(paths[-1], 'wb') as f:
+                    if binsha:
+                        f.write(repo.odb.stream(binsha).read())
+            try:
+                repo.git.merge_file('-q', *paths)
+            except git.GitCommandError:
+                # Either the changes conflict or the file is binary
+                raise treemerge.MergeConflict(path)
+            with open(paths[0], 'rb') as f:
+                data = f.read()
+        finally:
+            shutil.rmtree(tmp_dir)
+        return repo.odb.store(gitdb.IStream(git.Blob.type, len(data),
+                                            io.BytesIO(data))).binsha
+
+    def _mergeTrees(self, repo, base, ours, theirs):
+        def merge_file(base, ours, theirs, path):
+            return self._mergeFile(repo, base, ours, theirs, path)
+        return git.Tree(repo, treemerge.merge_trees(repo.odb, base, ours,
+                                                    theirs, merge_file))
+
+    def merge(self, ref, strategy=None):
+        # Both the default and the resolve strategies are done the same
+        # way, apart from there being more than one merge base, when
+        # the resolve strategy picks one rather than merging them.
+        repo = self.createRepoObject()
+        head = repo.commit(self._head)
+        theirs = self._getFetched(repo, ref)
+        self.log.debug("Merging %s onto %s" % (ref, head))
+        bases = treemerge.merge_bases(head, theirs)
+        if not bases:
+            raise treemerge.MergeConflict("%s has no history in common "
+                                          "with %s" % (ref, head))
+        if strategy == 'resolve':
+            bases = bases[:1]
+        if bases == [theirs]:
+            commit = head
+        elif bases == [head]:
+            commit = theirs
+        else:
+            base = treemerge.merge_base_tree(repo.odb, bases)
+            tree = self._mergeTrees(repo, base, head.tree.binsha,
+                                    theirs.tree.binsha)
+            message = "Merge '%s' of %s" % (ref, self.remote_url)
+            commit = git.Commit.create_from_tree(repo, tree, message,
+                                                 [head, theirs])
+        self._head = commit.hexsha
+        return commit
+
+    def cherryPick(self, ref):
+        repo = self.createRepoObject()
+        head = repo.commit(self._head)
+        theirs = self._getFetched(repo, ref)
+        self.log.debug("Cherry-picking %s onto %s" % (ref, head))
+        if len(theirs.parents) != 1:
+            raise treemerge.MergeConflict("%s is not a single change" % ref)
+        tree = self._mergeTrees(repo, theirs.parents[0].tree.binsha,
+                                head.tree.binsha, theirs.tree.binsha)
+        if tree.binsha == head.tree.binsha:
+            # As git cherry-pick does, refuse to make an empty commit
+            raise treemerge.MergeConflict("%s is already in %s" %
+                                          (ref, head))
+        author_date = '%s %s' % (
+            theirs.authored_date,
+            git.objects.util.altz_to_utctz_str(theirs.author_tz_offset))
+        commit = git.Commit.create_from_tree(
+            repo, tree, theirs.message, [head], author=theirs.author,
+            author_date=author_date)
+        self._head = commit.hexsha
+        return commit
+
+
+class MergeCache(object):
+    """The commits made by merging changes, so that merging the same
+    change onto the same commit again reuses the commit made the first
+    time.  Once there are more than size, the least recently used are
+    forgotten."""
+
+    def __init__(self, size):
+        self.size = size
+        # Key -> hexsha, least recently used first
+        self.commits = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            hexsha = self.commits.pop(key, None)
+            if hexsha is not None:
+                self.commits[key] = hexsha
+            return hexsha
+
+    def put(self, key, hexsha):
+        with self.lock:
+            self.commits.pop(key, None)
+            self.commits[key] = hexsha
+            while len(self.commits) > self.size:
+                self.commits.popitem(last=False)
+
+    def remove(self, key):
+        with self.lock:
+            self.commits.pop(key, None)
+
+
+# The ways of merging changes, selected by the merge_backend option
+REPO_BACKENDS = {
+    'git': Repo,
+    'inprocess': InProcessRepo,
+}
+
+
 class Merger(object):
     log = logging.getLogger("zuul.Merger")
 
-    def __init__(self, working_root, connections, email, username):
+    # How many merges to remember
+    merge_cache_size = 10000
+
+    def __init__(self, working_root, connections, email, username,
+                 backend='git', zuul_ref_lifetime=0):
         self.repos = {}
+        self.repo_class = REPO_BACKENDS[backend]
+        self.merge_cache = MergeCache(self.merge_cache_size)
+        # How many seconds to keep the zuul refs this merger makes
+        # (0 to keep them)
+        self.zuul_ref_lifetime = zuul_ref_lifetime
+        # Project name -> zuul ref -> when it was made, oldest first
+        self.zuul_refs = {}
+        # Project name -> lock held while using its repo
+        self.repo_locks = {}
+        self.lock = threading.Lock()
         self.working_root = working_root
         if not os.path.exists(working_root):
             os.makedirs(working_root)
@@ -223,32 +540,59 @@ class Merger(object):
         fd.close()
         os.chmod(name, 0o755)
 
-    def addProject(self, project, url):
+    def getRepoLock(self, project):
+        # Jobs may run in parallel, but only one at a time may use the
+        # working tree of a repo.  The lock may be acquired again by
+        # the thread holding it.
+        with self.lock:
+            lock = self.repo_locks.get(project)
+            if not lock:
+                lock = threading.RLock()
+                self.repo_locks[project] = lock
+            return lock
+
+    def addProject(self, project, url, env=None):
         repo = None
         try:
             path = os.path.join(self.working_root, project)
-            repo = Repo(url, path, self.email, self.username)
-
-            self.repos[project] = repo
+            with self.getRepoLock(project):
+                repo = self.repo_class(url, path, self.email,
+                                       self.username, env)
+                self.repos[project] = repo
         except Exception:
             self.log.exception("Unable to add project %s" % project)
         return repo
 
-    def getRepo(self, project, url):
-        if project in self.repos:
-            return self.repos[project]
-        if not url:
-            raise Exception("Unable to set up repo for project %s"
-                            " without a url" % (project,))
-        return self.addProject(project, url)
-
-    def updateRepo(self, project, url):
-        repo = self.getRepo(project, url)
-        try:
-            self.log.info("Updating local repository %s", project)
-            repo.update()
-        except Exception:
-            self.log.exception("Unable to update %s", project)
+    def closeRepos(self):
+        # Let go of the repos' handles, and the git processes they keep
+        with self.lock:
+            for repo in self.repos.values():
+                repo.invalidate()
+
+    def getRepo(self, project, url, env=None):
+        with self.getRepoLock(project):
+            if project in self.repos:
+                repo = self.repos[project]
+                if env is not None:
+                    repo.setEnv(env)
+                return repo
+            if not url:
+                raise Exception("Unable to set up repo for project %s"
+                                " without a url" % (project,))
+            return self.addProject(project, url, env)
+
+    def updateRepo(self, project, url, connection_name=None):
+        env = None
+        if connection_name:
+            env = self._getGitEnv(connection_name)
+        with self.getRepoLock(project):
+            repo = self.getRepo(project, url, env)
+            try:
+                self.log.info("Updating local repository %s", project)
+                repo.update()
+            except Exception:
+                self.log.exception("Unable to update %s", project)
+                repo.invalidate()
 
     def _mergeChange(self, item, ref):
         repo = self.getRepo(item['project'], item['url'])
@@ -256,6 +600,7 @@ class Merger(object):
             repo.checkout(ref)
         except Exception:
             self.log.exception("Unable to checkout %s" % ref)
+            repo.invalidate()
             return None
 
         try:
@@ -268,31 +613,34 @@ class Merger(object):
                 commit = repo.cherryPick(item['refspec'])
             else:
                 raise Exception("Unsupported merge mode: %s" % mode)
-        except git.GitCommandError:
+        except (git.GitCommandError, treemerge.MergeConflict):
             # Log git exceptions at debug level because they are
             # usually benign merge conflicts
             self.log.debug("Unable to merge %s" % item, exc_info=True)
             return None
         except Exception:
             self.log.exception("Exception while merging a change:")
+            repo.invalidate()
             return None
 
         return commit
 
-    def _setGitSsh(self, connection_name):
+    def _getGitEnv(self, connection_name):
+        # The environment is given to each git command rather than set
+        # for the whole process, since jobs for projects on different
+        # connections may run at the same time.
         wrapper_name = '.ssh_wrapper_%s' % connection_name
         name = os.path.join(self.working_root, wrapper_name)
         if os.path.isfile(name):
-            os.environ['GIT_SSH'] = name
-        elif 'GIT_SSH' in os.environ:
-            del os.environ['GIT_SSH']
+            return {'GIT_SSH': name}
+        return {}
 
     def _mergeItem(self, item, recent):
         self.log.debug("Processing refspec %s for project %s / %s ref %s" %
                        (item['refspec'], item['project'], item['branch'],
                         item['ref']))
-        self._setGitSsh(item['connection_name'])
-        repo = self.getRepo(item['project'], item['url'])
+        env = self._getGitEnv(item['connection_name'])
+        repo = self.getRepo(item['project'], item['url'], env)
         key = (item['project'], item['branch'])
         # See if we have a commit for this change already in this repo
         zuul_ref = item['branch'] + '/' + item['ref']
@@ -315,14 +663,23 @@ class Merger(object):
                 repo.reset()
             except Exception:
                 self.log.exception("Unable to reset repo %s" % repo)
+                repo.invalidate()
                 return None
             base = repo.getBranchHead(item['branch'])
         else:
             self.log.debug("Found base commit %s for %s" % (base, key,))
-        # Merge the change
-        commit = self._mergeChange(item, base)
-        if not commit:
-            return None
+        # Merge the change, unless it has been merged onto this commit
+        # before
+        cache_key = self._getCacheKey(item, base)
+        commit = self._getCachedMerge(repo, cache_key)
+        if commit:
+            self.log.debug("Reusing commit %s for %s" % (commit, zuul_ref))
+        else:
+            commit = self._mergeChange(item, base)
+            if not commit:
+                return None
+            if cache_key:
+                self.merge_cache.put(cache_key, commit.hexsha)
         # Store this commit as the most recent for this project-branch
         recent[key] = commit
         # Set the Zuul ref for this item to point to the most recent
@@ -333,6 +690,7 @@ class Merger(object):
                 repo = self.getRepo(project, None)
                 zuul_ref = branch + '/' + item['ref']
                 repo.createZuulRef(zuul_ref, mrc)
+                self._addZuulRef(project, zuul_ref)
             except Exception:
                 self.log.exception("Unable to set zuul ref %s for "
                                    "item %s" % (zuul_ref, item))
@@ -340,8 +698,88 @@ class Merger(object):
         return commit
 
     def mergeChanges(self, items):
+        # Hold the repos of every project involved for the whole merge,
+        # taking them in order so that merges of overlapping sets of
+        # projects can not deadlock.
+        projects = sorted(set([item['project'] for item in items]))
+        locks = [self.getRepoLock(project) for project in projects]
+        for lock in locks:
+            lock.acquire()
+        try:
+            commit = self._mergeChanges(items)
+            for project in projects:
+                self._expireZuulRefs(project)
+            return commit
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _getCacheKey(self, item, base):
+        # Only a change's refspec and patchset together say what is
+        # merged; a branch may be merged as its refspec moves.
+        if not item.get('patchset'):
+            return None
+        return (item['project'], item['branch'], base.hexsha,
+                item['refspec'], item['patchset'], item['merge_mode'])
+
+    def _getCachedMerge(self, repo, key):
+        hexsha = key and self.merge_cache.get(key)
+        if not hexsha:
+            return None
+        commit = repo.getCommit(hexsha)
+        if not commit:
+            # Git has removed it since
+            self.merge_cache.remove(key)
+        return commit
+
+    def _addZuulRef(self, project, ref):
+        refs = self.zuul_refs.setdefault(project, collections.OrderedDict())
+        refs.pop(ref, None)
+        refs[ref] = time.time()
+
+    def _expireZuulRefs(self, project):
+        # Delete the zuul refs made more than zuul_ref_lifetime ago, so
+        # that git may remove the commits nothing else refers to.
+        refs = self.zuul_refs.get(project)
+        if not (refs and self.zuul_ref_lifetime):
+            return
+        expired = []
+        oldest = time.time() - self.zuul_ref_lifetime
+        while refs:
+            ref, created = next(iter(refs.items()))
+            if created > oldest:
+                break
+            refs.popitem(last=False)
+            expired.append(ref)
+        if not expired:
+            return
+        try:
+            self.getRepo(project, None).deleteZuulRefs(expired)
+        except Exception:
+            self.log.exception("Unable to delete zuul refs of %s" % project)
+
+    def _prefetch(self, items):
+        # Fetch the changes of each project at once, rather than one at
+        # a time as they are merged.
+        refs = {}
+        for item in items:
+            if item.get('refspec'):
+                refs.setdefault(item['project'], []).append(item['refspec'])
+        for project, project_refs in refs.items():
+            item = [i for i in items if i['project'] == project][0]
+            try:
+                env = self._getGitEnv(item['connection_name'])
+                repo = self.getRepo(project, item['url'], env)
+                repo.prefetch(project_refs)
+            except Exception:
+                # They are fetched again when merged
+                self.log.debug("Unable to fetch %s for %s" %
+                               (project_refs, project), exc_info=True)
+
+    def _mergeChanges(self, items):
         recent = {}
         commit = None
+        self._prefetch(items)
         for item in items:
             if item.get("number") and item.get("patchset"):
                 self.log.debug("Merging for change %s,%s." %
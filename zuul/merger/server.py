@@ -44,8 +44,27 @@ class MergeServer(object):
         else:
             merge_name = None
 
+        # How many jobs to run at once; jobs using the same repos
+        # still wait for each other.
+        if self.config.has_option('merger', 'workers'):
+            self.workers = self.config.getint('merger', 'workers')
+        else:
+            self.workers = 1
+
+        if self.config.has_option('merger', 'merge_backend'):
+            merge_backend = self.config.get('merger', 'merge_backend')
+        else:
+            merge_backend = 'git'
+
+        if self.config.has_option('merger', 'zuul_ref_lifetime'):
+            zuul_ref_lifetime = self.config.getint('merger',
+                                                   'zuul_ref_lifetime')
+        else:
+            zuul_ref_lifetime = 0
+
         self.merger = merger.Merger(merge_root, connections, merge_email,
-                                    merge_name)
+                                    merge_name, merge_backend,
+                                    zuul_ref_lifetime)
 
     def start(self):
         self._running = True
@@ -60,10 +79,14 @@ class MergeServer(object):
         self.worker.waitForServer()
         self.log.debug("Registering")
         self.register()
-        self.log.debug("Starting worker")
-        self.thread = threading.Thread(target=self.run)
-        self.thread.daemon = True
-        self.thread.start()
+        self.log.debug("Starting %s workers" % self.workers)
+        self.threads = []
+        for x in range(max(self.workers, 1)):
+            thread = threading.Thread(target=self.run,
+                                      name='merger-worker-%s' % x)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
 
     def register(self):
         self.worker.registerFunction("merger:merge")
@@ -76,7 +99,9 @@ class MergeServer(object):
         self.log.debug("Stopped")
 
     def join(self):
-        self.thread.join()
+        for thread in self.threads:
+            thread.join()
+        self.merger.closeRepos()
 
     def run(self):
         self.log.debug("Starting merge listener")
@@ -109,7 +134,8 @@ class MergeServer(object):
 
     def update(self, job):
         args = json.loads(job.arguments)
-        self.merger.updateRepo(args['project'], args['url'])
+        self.merger.updateRepo(args['project'], args['url'],
+                               args.get('connection_name'))
         result = dict(updated=True,
                       zuul_url=self.zuul_url)
         job.sendWorkComplete(json.dumps(result))
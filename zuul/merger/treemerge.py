@@ -0,0 +1,203 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Three-way merges of git trees, worked out on the objects in a repo's
+# object database rather than in a working tree, much as "git
+# merge-tree" does.  Merging the content of a file which was changed
+# differently on both sides is left to a function supplied by the
+# caller.
+
+import heapq
+import io
+
+from git.objects.fun import tree_entries_from_data, tree_to_stream
+from gitdb.base import IStream
+from gitdb.typ import str_tree_type
+
+TREE_MODE = 0o40000
+FILE_MODES = (0o100644, 0o100755)
+
+
+class MergeConflict(Exception):
+    """The merge needs more than combining whole files and trees."""
+
+
+def is_tree(entry):
+    return entry[1] == TREE_MODE
+
+
+def read_tree(odb, binsha):
+    entries = tree_entries_from_data(odb.stream(binsha).read())
+    return dict((name, (sha, mode)) for sha, mode, name in entries)
+
+
+def write_tree(odb, entries):
+    def key(item):
+        # Git sorts trees as though their names ended with a slash
+        name, entry = item
+        if is_tree(entry):
+            return name + '/'
+        return name
+    stream = io.BytesIO()
+    tree_to_stream([(sha, mode, name) for name, (sha, mode)
+                    in sorted(entries.items(), key=key)], stream.write)
+    data = stream.getvalue()
+    return odb.store(IStream(str_tree_type, len(data),
+                             io.BytesIO(data))).binsha
+
+
+def is_file(entry):
+    return entry[1] in FILE_MODES
+
+
+def _merge_value(base, ours, theirs):
+    if ours == theirs or base == theirs:
+        return ours
+    if base == ours:
+        return theirs
+    raise MergeConflict()
+
+
+def _merge_entry(odb, base, ours, theirs, path, merge_file):
+    if ours == theirs:
+        return ours
+    if base == ours:
+        return theirs
+    if base == theirs:
+        return ours
+    if ours and theirs and is_tree(ours) and is_tree(theirs):
+        if base and is_tree(base):
+            base_sha = base[0]
+        else:
+            base_sha = None
+        entries = _merge_trees(odb, base_sha, ours[0], theirs[0], path,
+                               merge_file)
+        if not entries:
+            return None
+        return (write_tree(odb, entries), TREE_MODE)
+    if (merge_file and ours and theirs and is_file(ours) and
+        is_file(theirs) and (not base or is_file(base))):
+        # The file was changed on both sides (or added on both sides
+        # if there is no base)
+        base_sha, base_mode = base or (None, None)
+        try:
+            mode = _merge_value(base_mode, ours[1], theirs[1])
+        except MergeConflict:
+            raise MergeConflict(path)
+        return (merge_file(base_sha, ours[0], theirs[0], path), mode)
+    raise MergeConflict(path)
+
+
+def _merge_trees(odb, base, ours, theirs, path, merge_file):
+    if base:
+        base_entries = read_tree(odb, base)
+    else:
+        base_entries = {}
+    our_entries = read_tree(odb, ours)
+    their_entries = read_tree(odb, theirs)
+    merged = {}
+    names = set(base_entries) | set(our_entries) | set(their_entries)
+    if path:
+        path += '/'
+    for name in names:
+        entry = _merge_entry(odb, base_entries.get(name),
+                             our_entries.get(name), their_entries.get(name),
+                             path + name, merge_file)
+        if entry:
+            merged[name] = entry
+    return merged
+
+
+def merge_trees(odb, base, ours, theirs, merge_file=None):
+    """Merge the trees with the given binary shas, writing any new
+    trees to the object database, and return the sha of the merged
+    tree.
+
+    Files which differ on both sides are merged by calling
+    merge_file(base, ours, theirs, path) with the binary shas of the
+    blobs (base is None if the file was added on both sides), which
+    returns the sha of the merged blob or raises MergeConflict.
+    Without merge_file, and for anything other than regular files,
+    raise MergeConflict."""
+    if ours == theirs or base == theirs:
+        return ours
+    if base == ours:
+        return theirs
+    return write_tree(odb, _merge_trees(odb, base, ours, theirs, '',
+                                        merge_file))
+
+
+def merge_base_tree(odb, bases, merge_file=None):
+    """Return the binary sha of the tree to use as the base of a
+    merge, given the best common ancestors of the commits merged (see
+    merge_bases), or None if there are none.  Like git's recursive
+    merge, when there is more than one, the base is the merge of them
+    all."""
+    if not bases:
+        return None
+    tree = bases[0].tree.binsha
+    for other in bases[1:]:
+        base = merge_base_tree(odb, merge_bases(bases[0], other),
+                               merge_file)
+        tree = merge_trees(odb, base, tree, other.tree.binsha, merge_file)
+    return tree
+
+
+def merge_bases(one, two):
+    """Return the best common ancestors of two commits."""
+    if one.binsha == two.binsha:
+        return [one]
+    # This is git's paint_down_to_common: walk back from both commits,
+    # newest first, marking which of them each commit is reachable
+    # from, until only commits older than a common ancestor are left.
+    parent1, parent2, stale = 1, 2, 4
+    flags = {one.binsha: parent1, two.binsha: parent2}
+    commits = {one.binsha: one, two.binsha: two}
+    queue = [(-one.committed_date, one.binsha),
+             (-two.committed_date, two.binsha)]
+    heapq.heapify(queue)
+    results = []
+    while any(not flags[binsha] & stale for _, binsha in queue):
+        _, binsha = heapq.heappop(queue)
+        commit = commits[binsha]
+        commit_flags = flags[binsha]
+        if commit_flags == parent1 | parent2:
+            results.append(commit)
+            commit_flags |= stale
+            flags[binsha] = commit_flags
+        for parent in commit.parents:
+            parent_flags = flags.get(parent.binsha, 0)
+            if parent_flags & commit_flags == commit_flags:
+                continue
+            flags[parent.binsha] = parent_flags | commit_flags
+            commits[parent.binsha] = parent
+            heapq.heappush(queue, (-parent.committed_date, parent.binsha))
+    # Commits made in the same second may be walked out of order, and
+    # then some of the results are ancestors of others.
+    return [r for r in results
+            if not any(_is_ancestor(r, other)
+                       for other in results if other is not r)]
+
+
+def _is_ancestor(ancestor, commit):
+    seen = set()
+    queue = [commit]
+    while queue:
+        commit = queue.pop()
+        if commit.binsha == ancestor.binsha:
+            return True
+        if (commit.binsha in seen or
+            commit.committed_date < ancestor.committed_date):
+            continue
+        seen.add(commit.binsha)
+        queue.extend(commit.parents)
+    return False
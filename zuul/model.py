@@ -16,10 +16,14 @@ import copy
 import os
 import re
 import struct
+import threading
 import time
 from uuid import uuid4
 import extras
 
+from zuul import change_matcher
+from zuul.lib.regex import combineRegexes
+
 OrderedDict = extras.try_imports(['collections.OrderedDict',
                                   'ordereddict.OrderedDict'])
 
@@ -98,6 +102,9 @@ class Pipeline(object):
         self.window_decrease_type = None
         self.window_decrease_factor = None
         self.report_empty = None
+        # Incremented whenever anything in this pipeline's status JSON
+        # changes.
+        self.status_version = 0
 
     def __repr__(self):
         return '<Pipeline %s>' % self.name
@@ -129,6 +136,18 @@ class Pipeline(object):
     def removeQueue(self, queue):
         self.queues.remove(queue)
 
+    def setDirty(self):
+        # Force every queue in the pipeline to be processed on the
+        # next scheduler pass.
+        for queue in self.queues:
+            queue.dirty = True
+
+    def isDirty(self):
+        for queue in self.queues:
+            if queue.dirty:
+                return True
+        return False
+
     def getJobTree(self, project):
         tree = self.job_trees.get(project)
         return tree
@@ -139,7 +158,23 @@ class Pipeline(object):
         tree = self.getJobTree(item.change.project)
         if not tree:
             return []
-        return item.change.filterJobs(tree.getJobs())
+        # Filtering the job tree against the change is expensive
+        # (branch, file and skip-if regexes for every job), and the
+        # answer only changes when the layout is reconfigured or the
+        # change is updated, so it is cached on the item.  The key
+        # holds references rather than ids so that a replaced object
+        # can never be mistaken for the one it replaced.
+        change = item.change
+        key = (tree,
+               getattr(change, 'branch', None),
+               getattr(change, 'ref', None),
+               getattr(change, 'files', None))
+        cached_key = item._jobs_cache_key
+        if not (cached_key and
+                all(a is b for a, b in zip(cached_key, key))):
+            item._jobs_cache = list(change.filterJobs(tree.getJobs()))
+            item._jobs_cache_key = key
+        return item._jobs_cache
 
     def _findJobsToRun(self, job_trees, item, mutex):
         torun = []
@@ -178,30 +213,24 @@ class Pipeline(object):
             return []
         return self._findJobsToRun(tree.job_trees, item, mutex)
 
+    def _getBuildSet(self, item):
+        # Return the current build set with its counters tallied
+        # against this item's jobs.
+        build_set = item.current_build_set
+        build_set.setJobs(self.getJobs(item))
+        return build_set
+
     def haveAllJobsStarted(self, item):
-        for job in self.getJobs(item):
-            build = item.current_build_set.getBuild(job.name)
-            if not build or not build.start_time:
-                return False
-        return True
+        build_set = self._getBuildSet(item)
+        return build_set.started == build_set.total
 
     def areAllJobsComplete(self, item):
-        for job in self.getJobs(item):
-            build = item.current_build_set.getBuild(job.name)
-            if not build or not build.result:
-                return False
-        return True
+        build_set = self._getBuildSet(item)
+        return build_set.completed == build_set.total
 
     def didAllJobsSucceed(self, item):
-        for job in self.getJobs(item):
-            if not job.voting:
-                continue
-            build = item.current_build_set.getBuild(job.name)
-            if not build:
-                return False
-            if build.result != 'SUCCESS':
-                return False
-        return True
+        build_set = self._getBuildSet(item)
+        return build_set.voting_succeeded == build_set.voting_total
 
     def didMergerSucceed(self, item):
         if item.current_build_set.unable_to_merge:
@@ -209,17 +238,10 @@ class Pipeline(object):
         return True
 
     def didAnyJobFail(self, item):
-        for job in self.getJobs(item):
-            if not job.voting:
-                continue
-            build = item.current_build_set.getBuild(job.name)
-            if build and build.result and (build.result != 'SUCCESS'):
-                return True
-        return False
+        build_set = self._getBuildSet(item)
+        return build_set.voting_failed > 0
 
-    def isHoldingFollowingChanges(self, item):
-        if not item.live:
-            return False
+    def _isItemHoldingFollowingChanges(self, item):
         for job in self.getJobs(item):
             if not job.hold_following_changes:
                 continue
@@ -228,10 +250,37 @@ class Pipeline(object):
                 return True
             if build.result != 'SUCCESS':
                 return True
+        return False
 
-        if not item.item_ahead:
-            return False
-        return self.isHoldingFollowingChanges(item.item_ahead)
+    def isHoldingFollowingChanges(self, item):
+        # An item holds the changes behind it if it, or any live item
+        # ahead of it, has a hold job which has not yet succeeded.
+        # While the queue is being processed the answers are memoized
+        # on it, so each item is only examined once per pass.
+        holding_cache = None
+        if item.queue:
+            holding_cache = item.queue.holding_cache
+        if holding_cache is None:
+            holding_cache = {}
+        # Walk up to the nearest item whose answer we already know (or
+        # which doesn't depend on the items ahead), then fill in the
+        # answers on the way back down.
+        chain = []
+        while item and item not in holding_cache:
+            chain.append(item)
+            if not item.live:
+                break
+            item = item.item_ahead
+        holding = False
+        if item in holding_cache:
+            holding = holding_cache[item]
+        for item in reversed(chain):
+            if not item.live:
+                holding = False
+            elif not holding:
+                holding = self._isItemHoldingFollowingChanges(item)
+            holding_cache[item] = holding
+        return holding
 
     def setResult(self, item, build):
         if build.retry:
@@ -290,10 +339,12 @@ class Pipeline(object):
                     if j_changes:
                         j_queue['heads'].append(j_changes)
                     j_changes = []
-                j_changes.append(e.formatJSON(url_pattern))
+                j_changes.append(e.formatStatusJSON(url_pattern))
                 if (len(j_changes) > 1 and
                         (j_changes[-2]['remaining_time'] is not None) and
                         (j_changes[-1]['remaining_time'] is not None)):
+                    # Don't modify the item's cached copy
+                    j_changes[-1] = dict(j_changes[-1])
                     j_changes[-1]['remaining_time'] = max(
                         j_changes[-2]['remaining_time'],
                         j_changes[-1]['remaining_time'])
@@ -324,6 +375,12 @@ class ChangeQueue(object):
         self.window_increase_factor = window_increase_factor
         self.window_decrease_type = window_decrease_type
         self.window_decrease_factor = window_decrease_factor
+        # Whether something has happened to this queue (or an item in
+        # it) since the scheduler last processed it.
+        self.dirty = True
+        # Memo of Pipeline.isHoldingFollowingChanges for each item,
+        # only kept while the scheduler is processing the queue.
+        self.holding_cache = None
 
     def __repr__(self):
         return '<ChangeQueue %s: %s>' % (self.pipeline.name, self.name)
@@ -356,15 +413,33 @@ class ChangeQueue(object):
         item.enqueue_time = time.time()
         return item
 
+    def resetHoldingCache(self):
+        if self.holding_cache is not None:
+            self.holding_cache = {}
+
+    def _bumpStatusVersions(self, item):
+        # The status of an item includes the items either side of it.
+        item.bumpStatusVersion()
+        if item.item_ahead:
+            item.item_ahead.bumpStatusVersion()
+        for item_behind in item.items_behind:
+            item_behind.bumpStatusVersion()
+
     def enqueueItem(self, item):
+        self.dirty = True
+        self.resetHoldingCache()
         item.pipeline = self.pipeline
         item.queue = self
         if self.queue:
             item.item_ahead = self.queue[-1]
             item.item_ahead.items_behind.append(item)
         self.queue.append(item)
+        self._bumpStatusVersions(item)
 
     def dequeueItem(self, item):
+        self.dirty = True
+        self.resetHoldingCache()
+        self._bumpStatusVersions(item)
         if item in self.queue:
             self.queue.remove(item)
         if item.item_ahead:
@@ -376,10 +451,14 @@ class ChangeQueue(object):
         item.item_ahead = None
         item.items_behind = []
         item.dequeue_time = time.time()
+        self._bumpStatusVersions(item)
 
     def moveItem(self, item, item_ahead):
         if item.item_ahead == item_ahead:
             return False
+        self.dirty = True
+        self.resetHoldingCache()
+        self._bumpStatusVersions(item)
         # Remove from current location
         if item.item_ahead:
             item.item_ahead.items_behind.remove(item)
@@ -392,6 +471,7 @@ class ChangeQueue(object):
         item.items_behind = []
         if item.item_ahead:
             item.item_ahead.items_behind.append(item)
+        self._bumpStatusVersions(item)
         return True
 
     def mergeChangeQueue(self, other):
@@ -412,6 +492,7 @@ class ChangeQueue(object):
                 self.window += self.window_increase_factor
             elif self.window_increase_type == 'exponential':
                 self.window *= self.window_increase_factor
+            self.pipeline.status_version += 1
 
     def decreaseWindowSize(self):
         if self.window:
@@ -423,6 +504,7 @@ class ChangeQueue(object):
                 self.window = max(
                     self.window_floor,
                     int(self.window / self.window_decrease_factor))
+            self.pipeline.status_version += 1
 
 
 class Project(object):
@@ -465,6 +547,8 @@ class Job(object):
         self._branches = []
         self.files = []
         self._files = []
+        # The files regexes as a matcher, and the list it was made from
+        self._files_matcher = None
         self.skip_if_matcher = None
         self.swift = {}
 
@@ -512,6 +596,14 @@ class Job(object):
         if other.voting is not None:
             self.voting = other.voting
 
+    def _getFilesMatcher(self):
+        if (self._files_matcher is None or
+            self._files_matcher[0] is not self.files):
+            matcher = change_matcher.MatchAnyFiles(
+                [change_matcher.FileMatcher(f.pattern) for f in self.files])
+            self._files_matcher = (self.files, matcher)
+        return self._files_matcher[1]
+
     def changeMatches(self, change):
         matches_branch = False
         for branch in self.branches:
@@ -522,13 +614,7 @@ class Job(object):
         if self.branches and not matches_branch:
             return False
 
-        matches_file = False
-        for f in self.files:
-            if hasattr(change, 'files'):
-                for cf in change.files:
-                    if f.match(cf):
-                        matches_file = True
-        if self.files and not matches_file:
+        if self.files and not self._getFilesMatcher().matches(change):
             return False
 
         if self.skip_if_matcher and self.skip_if_matcher.matches(change):
@@ -578,10 +664,10 @@ class Build(object):
         self.uuid = uuid
         self.url = None
         self.number = None
-        self.result = None
+        self._result = None
         self.build_set = None
         self.launch_time = time.time()
-        self.start_time = None
+        self._start_time = None
         self.end_time = None
         self.estimated_time = None
         self.pipeline = None
@@ -596,6 +682,31 @@ class Build(object):
         return ('<Build %s of %s on %s>' %
                 (self.uuid, self.job.name, self.worker))
 
+    # The build set keeps running totals of its builds' states, so
+    # it needs to know when they change.
+
+    @property
+    def result(self):
+        return self._result
+
+    @result.setter
+    def result(self, result):
+        if self.build_set:
+            self.build_set.updateBuild(self, result=result)
+        else:
+            self._result = result
+
+    @property
+    def start_time(self):
+        return self._start_time
+
+    @start_time.setter
+    def start_time(self, start_time):
+        if self.build_set:
+            self.build_set.updateBuild(self, start_time=start_time)
+        else:
+            self._start_time = start_time
+
 
 class Worker(object):
     """A model of the worker running a job"""
@@ -647,6 +758,19 @@ class BuildSet(object):
         self.unable_to_merge = False
         self.failing_reasons = []
         self.merge_state = self.NEW
+        # Running totals of the states of the builds for the jobs set
+        # with setJobs(), so that the pipeline can tell whether all
+        # jobs have started, completed or succeeded without examining
+        # every build.  Build results are set from other threads.
+        self._tally_lock = threading.Lock()
+        self.jobs = None
+        self._voting = {}  # job name -> voting
+        self.total = 0
+        self.voting_total = 0
+        self.started = 0
+        self.completed = 0
+        self.voting_succeeded = 0
+        self.voting_failed = 0
 
     def __repr__(self):
         return '<BuildSet item: %s #builds: %s merge state: %s>' % (
@@ -670,12 +794,68 @@ class BuildSet(object):
         return self.states_map.get(
             state_num, 'UNKNOWN (%s)' % state_num)
 
+    @property
+    def pending(self):
+        return self.total - self.completed
+
+    def setJobs(self, jobs):
+        if jobs is self.jobs:
+            return
+        with self._tally_lock:
+            self.jobs = jobs
+            self._voting = dict([(job.name, job.voting) for job in jobs])
+            self.total = len(self._voting)
+            self.voting_total = len([v for v in self._voting.values() if v])
+            self.started = 0
+            self.completed = 0
+            self.voting_succeeded = 0
+            self.voting_failed = 0
+            for build in self.builds.values():
+                self._tally(build, 1)
+
+    def _tally(self, build, sign):
+        name = build.job.name
+        if name not in self._voting:
+            return
+        if build._start_time:
+            self.started += sign
+        if build._result:
+            self.completed += sign
+        if self._voting[name]:
+            if build._result == 'SUCCESS':
+                self.voting_succeeded += sign
+            elif build._result:
+                self.voting_failed += sign
+
+    def updateBuild(self, build, **kw):
+        with self._tally_lock:
+            counted = self.builds.get(build.job.name) is build
+            if counted:
+                self._tally(build, -1)
+            if 'result' in kw:
+                build._result = kw['result']
+            if 'start_time' in kw:
+                build._start_time = kw['start_time']
+            if counted:
+                self._tally(build, 1)
+        if counted:
+            self.item.bumpStatusVersion()
+
     def addBuild(self, build):
-        self.builds[build.job.name] = build
-        build.build_set = self
+        with self._tally_lock:
+            old_build = self.builds.get(build.job.name)
+            if old_build:
+                self._tally(old_build, -1)
+            self.builds[build.job.name] = build
+            build.build_set = self
+            self._tally(build, 1)
+        self.item.bumpStatusVersion()
 
     def removeBuild(self, build):
-        del self.builds[build.job.name]
+        with self._tally_lock:
+            self._tally(self.builds[build.job.name], -1)
+            del self.builds[build.job.name]
+        self.item.bumpStatusVersion()
 
     def getBuild(self, job_name):
         return self.builds.get(job_name)
@@ -704,6 +884,14 @@ class QueueItem(object):
         self.reported = False
         self.active = False  # Whether an item is within an active window
         self.live = True  # Whether an item is intended to be processed at all
+        # The jobs for this item, as computed by Pipeline.getJobs
+        self._jobs_cache = None
+        self._jobs_cache_key = None
+        # Incremented whenever anything in this item's status JSON
+        # changes, so that the formatted JSON can be cached.
+        self.status_version = 0
+        self._status_json = None
+        self._status_json_key = None
 
     def __repr__(self):
         if self.pipeline:
@@ -713,6 +901,18 @@ class QueueItem(object):
         return '<QueueItem 0x%x for %s in %s>' % (
             id(self), self.change, pipeline)
 
+    def setDirty(self):
+        # Items are processed a whole queue at a time, since the
+        # outcome for an item depends on the items ahead of it.
+        if self.queue:
+            self.queue.dirty = True
+        self.bumpStatusVersion()
+
+    def bumpStatusVersion(self):
+        self.status_version += 1
+        if self.pipeline:
+            self.pipeline.status_version += 1
+
     def resetAllBuilds(self):
         old = self.current_build_set
         self.current_build_set.result = 'CANCELED'
@@ -720,6 +920,9 @@ class QueueItem(object):
         old.next_build_set = self.current_build_set
         self.current_build_set.previous_build_set = old
         self.build_sets.append(self.current_build_set)
+        if self.queue:
+            self.queue.resetHoldingCache()
+        self.bumpStatusVersion()
 
     def addBuild(self, build):
         self.current_build_set.addBuild(build)
@@ -758,6 +961,26 @@ class QueueItem(object):
             url = build.url or job.name
         return (result, url)
 
+    def formatStatusJSON(self, url_pattern=None):
+        # Like formatJSON, but reuses the result until the item's
+        # status version changes.  The elapsed and remaining times of
+        # running builds change all the time, so items with running
+        # builds are always formatted afresh.  The result must not be
+        # modified.
+        key = (self.status_version, url_pattern)
+        if self._status_json_key != key:
+            # Read the version before formatting, so that a change
+            # made while formatting is picked up next time.
+            ret = self.formatJSON(url_pattern)
+            running = False
+            for job in ret['jobs']:
+                if job['start_time'] and not job['end_time']:
+                    running = True
+                    break
+            self._status_json = ret
+            self._status_json_key = None if running else key
+        return self._status_json
+
     def formatJSON(self, url_pattern=None):
         changeish = self.change
         ret = {}
@@ -1079,6 +1302,18 @@ class TriggerEvent(object):
         # For events that arrive with a destination pipeline (eg, from
         # an admin command, etc):
         self.forced_pipeline = None
+        # Set when a later event makes this one redundant
+        self.superseded = False
+        # Where the event is in the scheduler's event journal
+        self.journal_id = None
+
+    def isDuplicate(self, other):
+        if type(self) is not type(other):
+            return False
+        # Where the events are kept is not part of what they are
+        mine = dict(vars(self), journal_id=None)
+        theirs = dict(vars(other), journal_id=None)
+        return mine == theirs
 
     def __repr__(self):
         ret = '<TriggerEvent %s %s' % (self.type, self.project_name)
@@ -1228,6 +1463,14 @@ class EventFilter(BaseFilter):
         self.emails = [re.compile(x) for x in emails]
         self.usernames = [re.compile(x) for x in usernames]
         self.pipelines = [re.compile(x) for x in pipelines]
+        # Each list of regexes combined into one, where possible
+        self.types_re = combineRegexes(types)
+        self.branches_re = combineRegexes(branches)
+        self.refs_re = combineRegexes(refs)
+        self.comments_re = combineRegexes(comments)
+        self.emails_re = combineRegexes(emails)
+        self.usernames_re = combineRegexes(usernames)
+        self.pipelines_re = combineRegexes(pipelines)
         self.event_approvals = event_approvals
         self.timespecs = timespecs
         self.labels = labels
@@ -1269,38 +1512,41 @@ class EventFilter(BaseFilter):
 
         return ret
 
-    def matches(self, event, change):
+    def _matchAny(self, combined, regexes, value, search=False):
+        if combined is not None:
+            if search:
+                return combined.search(value) is not None
+            return combined.match(value) is not None
+        for regex in regexes:
+            if search:
+                if regex.search(value):
+                    return True
+            elif regex.match(value):
+                return True
+        return False
+
+    def matchesType(self, event_type):
         # event types are ORed
-        matches_type = False
-        for etype in self.types:
-            if etype.match(event.type):
-                matches_type = True
-        if self.types and not matches_type:
+        return (not self.types or
+                self._matchAny(self.types_re, self.types, event_type))
+
+    def matches(self, event, change):
+        if not self.matchesType(event.type):
             return False
 
         # pipelines are ORed
-        matches_pipeline = False
-        for epipe in self.pipelines:
-            if epipe.match(event.pipeline_name):
-                matches_pipeline = True
-        if self.pipelines and not matches_pipeline:
+        if self.pipelines and not self._matchAny(
+                self.pipelines_re, self.pipelines, event.pipeline_name):
             return False
 
         # branches are ORed
-        matches_branch = False
-        for branch in self.branches:
-            if branch.match(event.branch):
-                matches_branch = True
-        if self.branches and not matches_branch:
+        if self.branches and not self._matchAny(
+                self.branches_re, self.branches, event.branch):
             return False
 
         # refs are ORed
-        matches_ref = False
-        if event.ref is not None:
-            for ref in self.refs:
-                if ref.match(event.ref):
-                    matches_ref = True
-        if self.refs and not matches_ref:
+        if self.refs and (event.ref is None or not self._matchAny(
+                self.refs_re, self.refs, event.ref)):
             return False
         if self.ignore_deletes and event.newrev == EMPTY_GIT_REF:
             # If the updated ref has an empty git sha (all 0s),
@@ -1308,12 +1554,9 @@ class EventFilter(BaseFilter):
             return False
 
         # comments are ORed
-        matches_comment_re = False
-        for comment_re in self.comments:
-            if (event.comment is not None and
-                comment_re.search(event.comment)):
-                matches_comment_re = True
-        if self.comments and not matches_comment_re:
+        if self.comments and (event.comment is None or not self._matchAny(
+                self.comments_re, self.comments, event.comment,
+                search=True)):
             return False
 
         # We better have an account provided by Gerrit to do
@@ -1321,22 +1564,17 @@ class EventFilter(BaseFilter):
         if event.account is not None:
             account_email = event.account.get('email')
             # emails are ORed
-            matches_email_re = False
-            for email_re in self.emails:
-                if (account_email is not None and
-                        email_re.search(account_email)):
-                    matches_email_re = True
-            if self.emails and not matches_email_re:
+            if self.emails and (account_email is None or not self._matchAny(
+                    self.emails_re, self.emails, account_email,
+                    search=True)):
                 return False
 
             # usernames are ORed
             account_username = event.account.get('username')
-            matches_username_re = False
-            for username_re in self.usernames:
-                if (account_username is not None and
-                    username_re.search(account_username)):
-                    matches_username_re = True
-            if self.usernames and not matches_username_re:
+            if self.usernames and (
+                    account_username is None or not self._matchAny(
+                        self.usernames_re, self.usernames, account_username,
+                        search=True)):
                 return False
 
         # approvals are ANDed
@@ -1418,12 +1656,52 @@ class ChangeishFilter(BaseFilter):
         return True
 
 
+class EventFilterIndex(object):
+    """The event filters of a layout's pipelines, indexed by the
+    connection and type of the events they could match.
+
+    Event types are regexes, so the filters for each connection and
+    type are found the first time an event of that type arrives, and
+    remembered for the life of the layout.
+    """
+
+    def __init__(self, layout):
+        self.layout = layout
+        self._index = {}
+
+    def getFilters(self, event):
+        """Return a dict of each pipeline with filters which could match
+        the event, to a list of those filters."""
+        # The scheduler only considers events for changes and refs in
+        # the pipelines with the same connection.
+        connection_name = None
+        if event.change_number or event.ref:
+            connection_name = event.connection_name
+        key = (connection_name, event.type)
+        candidates = self._index.get(key)
+        if candidates is None:
+            candidates = {}
+            for pipeline in self.layout.pipelines.values():
+                if (connection_name and connection_name !=
+                    pipeline.source.connection.connection_name):
+                    continue
+                filters = [ef for ef in pipeline.manager.event_filters
+                           if ef.matchesType(event.type)]
+                if filters:
+                    candidates[pipeline] = filters
+            self._index[key] = candidates
+        return candidates
+
+
 class Layout(object):
     def __init__(self):
         self.projects = {}
         self.pipelines = OrderedDict()
         self.jobs = {}
         self.metajobs = []
+        # Mutex name -> how many jobs may hold it at once
+        self.mutexes = {}
+        self.event_filter_index = EventFilterIndex(self)
 
     def getJob(self, name):
         if name in self.jobs:
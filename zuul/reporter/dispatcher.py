@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+import time
+
+from six.moves import queue as Queue
+
+import extras
+
+from zuul import exceptions
+
+statsd = extras.try_import('statsd.statsd')
+
+
+class ReportRequest(object):
+    """A report waiting to be (or being) sent by a reporter."""
+
+    def __init__(self, reporter, source, pipeline, item):
+        self.reporter = reporter
+        self.source = source
+        self.pipeline = pipeline
+        self.item = item
+        self.submit_time = time.time()
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return '<ReportRequest %s for %s>' % (self.reporter, self.item)
+
+    def complete(self, result=None, exception=None):
+        self.result = result
+        self.exception = exception
+        self._done.set()
+
+    def isComplete(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class ReportWorker(threading.Thread):
+    """Sends the reports on its queue, in order."""
+    log = logging.getLogger("zuul.ReportWorker")
+
+    def __init__(self, dispatcher, name, queue_size):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.dispatcher = dispatcher
+        self.queue = Queue.Queue(queue_size)
+
+    def run(self):
+        while True:
+            request = self.queue.get()
+            try:
+                if request is None:
+                    return
+                self.dispatcher.sendReport(request)
+            except Exception:
+                self.log.exception("Exception sending report %s:" %
+                                   (request,))
+            finally:
+                self.queue.task_done()
+
+
+class ReportDispatcher(object):
+    """Sends reports on worker threads so that the scheduler doesn't
+    have to wait for them.
+
+    Each connection has its own pool of workers, each with a bounded
+    queue.  All of the reports for a change go to the same worker, so
+    they are sent in the order they were made.  When a worker's queue
+    is full, submitting a report blocks until there is room (or the
+    timeout passes, when the report fails).  Reports which fail before
+    reaching the remote server are retried.
+
+    With no workers, reports are sent immediately by the caller.
+    """
+    log = logging.getLogger("zuul.ReportDispatcher")
+    # How many reports may wait for each worker
+    queue_size = 100
+    # How many times to retry a report which was never sent, and
+    # how long to wait (doubling each time) before the first retry
+    retries = 2
+    retry_delay = 1
+
+    def __init__(self, workers=1, timeout=300):
+        self.workers = workers
+        self.timeout = timeout
+        self.pools = {}  # connection name -> [ReportWorker]
+        self.lock = threading.Lock()
+        self._stopped = False
+
+    def _getConnectionName(self, reporter):
+        connection = reporter.connection
+        return getattr(connection, 'connection_name', None) or reporter.name
+
+    def _getWorker(self, connection_name, item):
+        with self.lock:
+            pool = self.pools.get(connection_name)
+            if pool is None:
+                pool = []
+                for x in range(self.workers):
+                    worker = ReportWorker(
+                        self, 'ReportWorker-%s-%s' % (connection_name, x),
+                        self.queue_size)
+                    worker.start()
+                    pool.append(worker)
+                self.pools[connection_name] = pool
+        return pool[hash(item.change._id()) % len(pool)]
+
+    def submit(self, reporter, source, pipeline, item):
+        request = ReportRequest(reporter, source, pipeline, item)
+        if not self.workers or self._stopped:
+            self.sendReport(request)
+            return request
+        connection_name = self._getConnectionName(reporter)
+        worker = self._getWorker(connection_name, item)
+        try:
+            worker.queue.put(request, timeout=self.timeout)
+        except Queue.Full:
+            self.log.error("Unable to queue report %s, the queue for %s "
+                           "is full" % (request, connection_name))
+            request.complete(result="Report queue is full")
+        try:
+            if statsd:
+                # gauges.zuul.reporter.CONNECTION.queue_depth
+                statsd.gauge('zuul.reporter.%s.queue_depth' %
+                             connection_name, worker.queue.qsize())
+        except:
+            self.log.exception("Exception reporting report queue stats")
+        return request
+
+    def sendReport(self, request):
+        reporter = request.reporter
+        attempt = 0
+        while True:
+            try:
+                result = reporter.report(request.source, request.pipeline,
+                                         request.item)
+                request.complete(result=result)
+                break
+            except Exception as e:
+                # Reports aren't idempotent (a comment or vote may
+                # already have been posted when a later step fails),
+                # so only retry those which never left Zuul.
+                if (attempt >= self.retries or
+                    not isinstance(e, exceptions.RequestNotSent)):
+                    self.log.exception("Exception sending report %s:" %
+                                       (request,))
+                    request.complete(exception=e)
+                    break
+                self.log.exception("Exception sending report %s, "
+                                   "retrying:" % (request,))
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+        if request.result:
+            self.log.error("Report %s received: %s" %
+                           (request, request.result))
+        try:
+            if statsd:
+                # timers.zuul.reporter.CONNECTION.REPORTER.latency
+                key = 'zuul.reporter.%s.%s.latency' % (
+                    self._getConnectionName(reporter), reporter.name)
+                statsd.timing(key, int((time.time() -
+                                        request.submit_time) * 1000))
+        except:
+            self.log.exception("Exception reporting report stats")
+
+    def wait(self, requests):
+        """Wait for the requests to complete, and return the results of
+        those which failed.  Raises the exception from a request which
+        raised one."""
+        errors = []
+        deadline = time.time() + self.timeout
+        for request in requests:
+            if not request.wait(max(deadline - time.time(), 0)):
+                self.log.error("Timed out waiting for report %s" %
+                               (request,))
+                errors.append("Timed out waiting for report")
+                continue
+            if request.exception:
+                raise request.exception
+            if request.result:
+                errors.append(request.result)
+        return errors
+
+    def join(self):
+        """Wait until every queued report has been sent."""
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            for worker in pool:
+                worker.queue.join()
+
+    def isIdle(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            for worker in pool:
+                if worker.queue.unfinished_tasks:
+                    return False
+        return True
+
+    def stop(self):
+        # Workers finish sending what is already queued first
+        with self.lock:
+            self._stopped = True
+            pools = list(self.pools.values())
+            self.pools = {}
+        for pool in pools:
+            for worker in pool:
+                worker.queue.put(None)
+        for pool in pools:
+            for worker in pool:
+                worker.join()
@@ -36,6 +36,8 @@ from zuul.model import Pipeline, Project, ChangeQueue
 from zuul.model import ChangeishFilter, NullChange
 from zuul import change_matcher, exceptions
 from zuul import version as zuul_version
+from zuul.lib.eventjournal import EventJournal
+from zuul.reporter.dispatcher import ReportDispatcher
 
 statsd = extras.try_import('statsd.statsd')
 
@@ -63,65 +65,203 @@ def deep_format(obj, paramdict):
 
 
 class MutexHandler(object):
+    """Grant named mutexes to the jobs of queue items.
+
+    A mutex may be held by up to its configured count of jobs at once.
+    Jobs which can not have it wait in the order in which they first
+    asked for it, and when it is released only the items at the head
+    of the wait queue are marked dirty so they can try again.
+    """
     log = logging.getLogger("zuul.MutexHandler")
 
+    # How long (in seconds) a waiter which has been woken up is allowed
+    # to keep its place before other jobs may take the mutex ahead of
+    # it.  A waiter may stop asking for the mutex without ever being
+    # dequeued (for instance, if the item ahead of it is holding
+    # following changes), and it must not keep everyone else waiting.
+    wakeup_grace = 60
+
     def __init__(self):
+        # Mutex name -> list of (item, job name) holding it; a name is
+        # only present while the mutex is held.
         self.mutexes = {}
+        # Mutex name -> list of MutexWaiter, oldest first
+        self.waiters = {}
+        # Mutex name -> how many jobs may hold it at once
+        self.counts = {}
+        # Pipelines may be processed in parallel
+        self.lock = threading.Lock()
+
+    def reconfigure(self, layout):
+        with self.lock:
+            self.counts = dict(layout.mutexes)
+            # Jobs may have lost their mutex in the new layout
+            for mutex_name, waiters in list(self.waiters.items()):
+                for waiter in waiters[:]:
+                    job = layout.jobs.get(waiter.job_name)
+                    if not job or job.mutex != mutex_name:
+                        self._removeWaiter(mutex_name, waiter)
+
+    def getCount(self, mutex_name):
+        return self.counts.get(mutex_name, 1)
 
     def acquire(self, item, job):
         if not job.mutex:
             return True
+        with self.lock:
+            return self._acquireIfFree(item, job)
+
+    def _acquireIfFree(self, item, job):
         mutex_name = job.mutex
-        m = self.mutexes.get(mutex_name)
-        if not m:
-            # The mutex is not held, acquire it
-            self._acquire(mutex_name, item, job.name)
-            return True
-        held_item, held_job_name = m
-        if held_item is item and held_job_name == job.name:
+        holders = self.mutexes.get(mutex_name, [])
+        if (item, job.name) in holders:
             # This item already holds the mutex
             return True
-        held_build = held_item.current_build_set.getBuild(held_job_name)
-        if held_build and held_build.result:
-            # The build that held the mutex is complete, release it
-            # and let the new item have it.
-            self.log.error("Held mutex %s being released because "
-                           "the build that holds it is complete" %
-                           (mutex_name,))
-            self._release(mutex_name, item, job.name)
+        for held_item, held_job_name in holders[:]:
+            held_build = held_item.current_build_set.getBuild(held_job_name)
+            if held_build and held_build.result:
+                # The build that held the mutex is complete, release it
+                # and let the new item have it.
+                self.log.error("Held mutex %s being released because "
+                               "the build that holds it is complete" %
+                               (mutex_name,))
+                self._release(mutex_name, held_item, held_job_name)
+                self._wake(mutex_name)
+        holders = self.mutexes.get(mutex_name, [])
+        free = self.getCount(mutex_name) - len(holders)
+        waiter = None
+        ahead = 0
+        for w in self._getWaiters(mutex_name):
+            if w.item is item and w.job_name == job.name:
+                waiter = w
+                break
+            if self._isWaiting(w):
+                ahead += 1
+        if free > ahead:
+            # There is room for this job once the jobs which have been
+            # waiting longer have the mutex.
+            if waiter:
+                self._removeWaiter(mutex_name, waiter)
+                self._reportWait(mutex_name, waiter)
             self._acquire(mutex_name, item, job.name)
             return True
+        if not waiter:
+            self.log.debug("Job %s of item %s waiting for mutex %s" %
+                           (job.name, item, mutex_name))
+            self.waiters.setdefault(mutex_name, []).append(
+                MutexWaiter(item, job.name))
+            self._reportWaiters(mutex_name)
+        else:
+            waiter.woken = None
         return False
 
     def release(self, item, job):
         if not job.mutex:
             return
+        with self.lock:
+            self._releaseIfHeld(item, job)
+
+    def _releaseIfHeld(self, item, job):
         mutex_name = job.mutex
-        m = self.mutexes.get(mutex_name)
-        if not m:
+        holders = self.mutexes.get(mutex_name)
+        if not holders:
             # The mutex is not held, nothing to do
             self.log.error("Mutex can not be released for %s "
                            "because the mutex is not held" %
                            (item,))
             return
-        held_item, held_job_name = m
-        if held_item is item and held_job_name == job.name:
+        if (item, job.name) in holders:
             # This item holds the mutex
             self._release(mutex_name, item, job.name)
+            self._wake(mutex_name)
             return
         self.log.error("Mutex can not be released for %s "
                        "which does not hold it" %
                        (item,))
 
+    def _getWaiters(self, mutex_name):
+        # Forget about waiters whose items are no longer able to run
+        # the job.
+        waiters = self.waiters.get(mutex_name, [])
+        for waiter in waiters[:]:
+            item = waiter.item
+            if (item.dequeue_time or not item.live or
+                item.current_build_set.getBuild(waiter.job_name)):
+                self._removeWaiter(mutex_name, waiter)
+        return self.waiters.get(mutex_name, [])
+
+    def _isWaiting(self, waiter):
+        # Whether a waiter keeps its place ahead of later jobs
+        if not waiter.item.active:
+            return False
+        if waiter.woken and time.time() - waiter.woken > self.wakeup_grace:
+            return False
+        return True
+
+    def _wake(self, mutex_name):
+        holders = self.mutexes.get(mutex_name, [])
+        free = self.getCount(mutex_name) - len(holders)
+        for waiter in self._getWaiters(mutex_name):
+            if free <= 0:
+                break
+            if not self._isWaiting(waiter):
+                continue
+            self.log.debug("Waking job %s of item %s waiting for mutex %s" %
+                           (waiter.job_name, waiter.item, mutex_name))
+            if not waiter.woken:
+                waiter.woken = time.time()
+            waiter.item.setDirty()
+            free -= 1
+
+    def _removeWaiter(self, mutex_name, waiter):
+        waiters = self.waiters[mutex_name]
+        waiters.remove(waiter)
+        if not waiters:
+            del self.waiters[mutex_name]
+        self._reportWaiters(mutex_name)
+
+    def _reportWait(self, mutex_name, waiter):
+        if not statsd:
+            return
+        try:
+            # timers.zuul.mutex.NAME.wait_time
+            dt = int((time.time() - waiter.since) * 1000)
+            statsd.timing('zuul.mutex.%s.wait_time' % mutex_name, dt)
+        except Exception:
+            self.log.exception("Exception reporting mutex stats")
+
+    def _reportWaiters(self, mutex_name):
+        if not statsd:
+            return
+        try:
+            # stats.gauges.zuul.mutex.NAME.waiting
+            statsd.gauge('zuul.mutex.%s.waiting' % mutex_name,
+                         len(self.waiters.get(mutex_name, [])))
+        except Exception:
+            self.log.exception("Exception reporting mutex stats")
+
     def _acquire(self, mutex_name, item, job_name):
         self.log.debug("Job %s of item %s acquiring mutex %s" %
                        (job_name, item, mutex_name))
-        self.mutexes[mutex_name] = (item, job_name)
+        self.mutexes.setdefault(mutex_name, []).append((item, job_name))
 
     def _release(self, mutex_name, item, job_name):
         self.log.debug("Job %s of item %s releasing mutex %s" %
                        (job_name, item, mutex_name))
-        del self.mutexes[mutex_name]
+        holders = self.mutexes[mutex_name]
+        holders.remove((item, job_name))
+        if not holders:
+            del self.mutexes[mutex_name]
+
+
+class MutexWaiter(object):
+    """A job of a queue item waiting for a mutex"""
+    def __init__(self, item, job_name):
+        self.item = item
+        self.job_name = job_name
+        self.since = time.time()
+        # When the waiter was last told the mutex is free
+        self.woken = None
 
 
 class ManagementEvent(object):
@@ -234,8 +374,44 @@ def toList(item):
     return [item]
 
 
+class PipelineWorker(threading.Thread):
+    """Processes the pipelines which the scheduler puts on its queue,
+    one at a time."""
+    log = logging.getLogger("zuul.PipelineWorker")
+
+    def __init__(self, sched, queue, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.sched = sched
+        self.queue = queue
+
+    def run(self):
+        while True:
+            work = self.queue.get()
+            try:
+                if work is None:
+                    return
+                pipeline, full = work
+                self.sched._processPipeline(pipeline, full)
+            except Exception:
+                self.log.exception("Exception processing pipeline %s:" %
+                                   (pipeline,))
+                self.sched._pipeline_worker_failed = True
+            finally:
+                self.queue.task_done()
+
+
 class Scheduler(threading.Thread):
     log = logging.getLogger("zuul.Scheduler")
+    # Only queues which have been marked dirty by an event are
+    # processed on each pass of the run loop; at most this often (in
+    # seconds) every queue is processed regardless, as a safety net.
+    full_sweep_interval = 60
+    # How many threads to process pipelines on; with more than one,
+    # separate pipelines are processed in parallel.
+    pipeline_workers = 1
+    # How often (in seconds) to maintain the connections' change caches
+    cache_maintenance_interval = 300
 
     def __init__(self, config, testonly=False):
         threading.Thread.__init__(self)
@@ -249,6 +425,9 @@ class Scheduler(threading.Thread):
         self.launcher = None
         self.merger = None
         self.mutex = MutexHandler()
+        self._pipeline_queue = Queue.Queue()
+        self._pipeline_worker_threads = []
+        self._pipeline_worker_failed = False
         self.connections = dict()
         # Despite triggers being part of the pipeline, there is one trigger set
         # per scheduler. The pipeline handles the trigger filters but since
@@ -259,6 +438,15 @@ class Scheduler(threading.Thread):
         self.config = config
 
         self.trigger_event_queue = Queue.Queue()
+        # Trigger events waiting in the queue, by what they refer to
+        self._pending_events = {}
+        self._pending_events_lock = threading.Lock()
+        self.events_coalesced = 0
+        self.events_processed = 0
+        # Trigger events are written to the journal from when the
+        # scheduler resumes until it exits.
+        self.event_journal = None
+        self._event_journal_lock = threading.Lock()
         self.result_event_queue = Queue.Queue()
         self.management_event_queue = Queue.Queue()
         self.layout = model.Layout()
@@ -269,6 +457,19 @@ class Scheduler(threading.Thread):
 
         self.zuul_version = zuul_version.version_info.release_string()
         self.last_reconfigured = None
+        self.last_full_sweep = 0
+        self.last_cache_maintenance = time.time()
+        if self.config.has_option('zuul', 'pipeline_workers'):
+            self.pipeline_workers = self.config.getint('zuul',
+                                                       'pipeline_workers')
+        report_workers = 1
+        if self.config.has_option('zuul', 'report_workers'):
+            report_workers = self.config.getint('zuul', 'report_workers')
+        report_timeout = 300
+        if self.config.has_option('zuul', 'report_timeout'):
+            report_timeout = self.config.getint('zuul', 'report_timeout')
+        self.report_dispatcher = ReportDispatcher(report_workers,
+                                                  report_timeout)
 
         # A set of reporter configuration keys to action mapping
         self._reporter_actions = {
@@ -281,6 +482,7 @@ class Scheduler(threading.Thread):
 
     def stop(self):
         self._stopped = True
+        self.report_dispatcher.stop()
         self._unloadDrivers()
         self.stopConnections()
         self.wake_event.set()
@@ -520,6 +722,9 @@ class Scheduler(threading.Thread):
             )
             project_templates[project_template.get('name')] = tpl
 
+        for config_mutex in data.get('mutexes', []):
+            layout.mutexes[config_mutex['name']] = config_mutex.get('count', 1)
+
         for config_job in data.get('jobs', []):
             job = layout.getJob(config_job['name'])
             # Be careful to only set attributes explicitly present on
@@ -685,10 +890,73 @@ class Scheduler(threading.Thread):
                 statsd.incr('gerrit.event.%s' % event.type)
         except:
             self.log.exception("Exception reporting event stats")
-        self.trigger_event_queue.put(event)
+        if self._coalesceEvent(event):
+            return
+        with self._event_journal_lock:
+            self._journalEvent(event)
+            self.trigger_event_queue.put(event)
         self.wake_event.set()
         self.log.debug("Done adding trigger event: %s" % event)
 
+    def _getEventKey(self, event):
+        return (event.connection_name, event.project_name,
+                event.change_number or event.ref)
+
+    def _coalesceEvent(self, event):
+        """Make the trigger events waiting in the queue which this event
+        makes redundant be skipped, and return whether the event itself
+        is redundant.
+
+        An event which is the same as the last one waiting for its
+        change is dropped, since processing it would have no further
+        effect.  A later patchset of a change supersedes the
+        patchset-created events waiting for its earlier ones: items for
+        those patchsets would be removed as soon as this event is
+        processed, so a superseded event is only given to pipelines
+        which don't dequeue on a new patchset.  Events arriving out of
+        order, as when they are replayed from the journal, don't
+        supersede later patchsets.
+        Comment and approval events are only dropped as duplicates, so
+        each distinct one is still processed.
+        """
+        key = self._getEventKey(event)
+        with self._pending_events_lock:
+            pending = self._pending_events.setdefault(key, [])
+            if pending and pending[-1].isDuplicate(event):
+                self.log.debug("Dropping duplicate trigger event %s" % event)
+                self._countEvent('coalesced')
+                return True
+            if event.change_number and event.isPatchsetCreated():
+                for other in pending:
+                    if (other.isPatchsetCreated() and not other.superseded and
+                            self._isLaterPatchset(event, other)):
+                        self.log.debug("Trigger event %s is superseded by %s" %
+                                       (other, event))
+                        other.superseded = True
+            pending.append(event)
+        return False
+
+    def _isLaterPatchset(self, event, other):
+        try:
+            return int(event.patch_number) > int(other.patch_number)
+        except (TypeError, ValueError):
+            # Patchsets which aren't numbered, such as the head shas of
+            # GitHub pull requests, are taken to come in order.
+            return event.patch_number != other.patch_number
+
+    def _countEvent(self, kind):
+        if kind == 'coalesced':
+            self.events_coalesced += 1
+        else:
+            self.events_processed += 1
+        try:
+            if statsd:
+                # counters.zuul.scheduler.events.coalesced
+                # counters.zuul.scheduler.events.processed
+                statsd.incr('zuul.scheduler.events.%s' % kind)
+        except:
+            self.log.exception("Exception reporting event stats")
+
     def onBuildStarted(self, build):
         self.log.debug("Adding start event for build: %s" % build)
         build.start_time = time.time()
@@ -780,45 +1048,51 @@ class Scheduler(threading.Thread):
         self.wake_event.set()
         self.log.debug("Waiting for exit")
 
-    def _get_queue_pickle_file(self):
+    def _get_state_dir(self):
         if self.config.has_option('zuul', 'state_dir'):
-            state_dir = os.path.expanduser(self.config.get('zuul',
-                                                           'state_dir'))
-        else:
-            state_dir = '/var/lib/zuul'
-        return os.path.join(state_dir, 'queue.pickle')
+            return os.path.expanduser(self.config.get('zuul', 'state_dir'))
+        return '/var/lib/zuul'
+
+    def _get_queue_pickle_file(self):
+        return os.path.join(self._get_state_dir(), 'queue.pickle')
+
+    def _get_event_journal_file(self):
+        return os.path.join(self._get_state_dir(), 'events.journal')
 
     def _get_time_database_dir(self):
-        if self.config.has_option('zuul', 'state_dir'):
-            state_dir = os.path.expanduser(self.config.get('zuul',
-                                                           'state_dir'))
-        else:
-            state_dir = '/var/lib/zuul'
-        d = os.path.join(state_dir, 'times')
+        d = os.path.join(self._get_state_dir(), 'times')
         if not os.path.exists(d):
             os.mkdir(d)
         return d
 
-    def _save_queue(self):
-        pickle_file = self._get_queue_pickle_file()
-        events = []
-        while not self.trigger_event_queue.empty():
-            events.append(self.trigger_event_queue.get())
-        self.log.debug("Queue length is %s" % len(events))
-        if events:
-            self.log.debug("Saving queue")
-            pickle.dump(events, open(pickle_file, 'wb'))
+    def _journalEvent(self, event):
+        if not self.event_journal:
+            return
+        try:
+            event.journal_id = self.event_journal.append(event)
+        except Exception:
+            self.log.exception("Unable to write trigger event %s to the "
+                               "event journal" % (event,))
+
+    def _journalEventDone(self, event):
+        if not (self.event_journal and event.journal_id):
+            return
+        try:
+            self.event_journal.remove(event.journal_id)
+        except Exception:
+            self.log.exception("Unable to mark trigger event %s done in "
+                               "the event journal" % (event,))
 
     def _load_queue(self):
+        # Events saved by versions which did not have the journal
         pickle_file = self._get_queue_pickle_file()
         if os.path.exists(pickle_file):
             self.log.debug("Loading queue")
             events = pickle.load(open(pickle_file, 'rb'))
             self.log.debug("Queue length is %s" % len(events))
-            for event in events:
-                self.trigger_event_queue.put(event)
-        else:
-            self.log.debug("No queue file found")
+            return events
+        self.log.debug("No queue file found")
+        return []
 
     def _delete_queue(self):
         pickle_file = self._get_queue_pickle_file()
@@ -826,22 +1100,62 @@ class Scheduler(threading.Thread):
             self.log.debug("Deleting saved queue")
             os.unlink(pickle_file)
 
-    def resume(self):
-        try:
-            self._load_queue()
-        except:
-            self.log.exception("Unable to load queue")
+    def _openEventJournal(self):
+        journal = EventJournal(self._get_event_journal_file())
+        replayed = journal.open()
+        self.log.debug("Replaying %s trigger events from the event journal" %
+                       len(replayed))
+        with self._event_journal_lock:
+            # Events which arrived since the scheduler started are
+            # processed after the ones which were already waiting.
+            arrived = []
+            while not self.trigger_event_queue.empty():
+                arrived.append(self.trigger_event_queue.get())
+                self.trigger_event_queue.task_done()
+            self.event_journal = journal
+            for journal_id, event in replayed:
+                event.journal_id = journal_id
+                if self._coalesceEvent(event):
+                    self._journalEventDone(event)
+                else:
+                    self.trigger_event_queue.put(event)
+            try:
+                saved = self._load_queue()
+            except Exception:
+                self.log.exception("Unable to load queue")
+                saved = []
+            for event in saved:
+                if not self._coalesceEvent(event):
+                    self._journalEvent(event)
+                    self.trigger_event_queue.put(event)
+            for event in arrived:
+                self._journalEvent(event)
+                self.trigger_event_queue.put(event)
         try:
             self._delete_queue()
-        except:
+        except Exception:
             self.log.exception("Unable to delete saved queue")
+
+    def _closeEventJournal(self):
+        with self._event_journal_lock:
+            if self.event_journal:
+                self.log.debug("Closing the event journal, queue length "
+                               "is %s" % self.trigger_event_queue.qsize())
+                self.event_journal.close()
+                self.event_journal = None
+
+    def resume(self):
+        try:
+            self._openEventJournal()
+        except Exception:
+            self.log.exception("Unable to open the event journal")
         self.log.debug("Resuming queue processing")
         self.wake_event.set()
 
     def _doPauseEvent(self):
         if self._exit:
             self.log.debug("Exiting")
-            self._save_queue()
+            self._closeEventJournal()
             os._exit(0)
 
     def _doReconfigureEvent(self, event):
@@ -907,6 +1221,9 @@ class Scheduler(threading.Thread):
                             "Exception while canceling build %s "
                             "for change %s" % (build, item.change))
             self.layout = layout
+            self.mutex.reconfigure(layout)
+            # Process everything in the new layout on the next pass.
+            self.last_full_sweep = 0
             self.maintainConnectionCache()
             for trigger in self.triggers.values():
                 trigger.postConfig()
@@ -1007,6 +1324,7 @@ class Scheduler(threading.Thread):
             self.wake_event.clear()
             if self._stopped:
                 self.log.debug("Run handler stopping")
+                self._stopPipelineWorkers()
                 return
             self.log.debug("Run handler awake")
             self.run_handler_lock.acquire()
@@ -1026,18 +1344,80 @@ class Scheduler(threading.Thread):
                 if self._pause and self._areAllBuildsComplete():
                     self._doPauseEvent()
 
-                for pipeline in self.layout.pipelines.values():
-                    while pipeline.manager.processQueue():
-                        pass
+                self.process_pipelines()
+
+                if (time.time() - self.last_cache_maintenance >
+                    self.cache_maintenance_interval):
+                    self.maintainConnectionCache(prune=False)
 
             except Exception:
                 self.log.exception("Exception in run handler:")
-                # There may still be more events to process
+                # There may still be more events to process, and we
+                # don't know which queues were left half-processed.
+                self.last_full_sweep = 0
                 self.wake_event.set()
             finally:
                 self.run_handler_lock.release()
 
-    def maintainConnectionCache(self):
+    def process_pipelines(self):
+        now = time.time()
+        full = (now - self.last_full_sweep) > self.full_sweep_interval
+        if full:
+            self.log.debug("Performing a full sweep of all pipelines")
+            self.last_full_sweep = now
+        try:
+            if statsd:
+                statsd.incr('zuul.scheduler.wakeups')
+        except:
+            self.log.exception("Exception reporting scheduler stats")
+        pipelines = [pipeline for pipeline in self.layout.pipelines.values()
+                     if full or pipeline.isDirty()]
+        if self.pipeline_workers > 1 and len(pipelines) > 1:
+            self._processPipelinesInParallel(pipelines, full)
+        else:
+            for pipeline in pipelines:
+                self._processPipeline(pipeline, full)
+
+    def _processPipeline(self, pipeline, full):
+        if pipeline.manager.processQueue(full):
+            while pipeline.manager.processQueue():
+                pass
+
+    def _processPipelinesInParallel(self, pipelines, full):
+        # Each pipeline is handled by one worker at a time, and this
+        # waits until they are all done, so the rest of the run loop
+        # (management events and reconfiguration in particular) never
+        # runs at the same time as pipeline processing.
+        while len(self._pipeline_worker_threads) < self.pipeline_workers:
+            worker = PipelineWorker(
+                self, self._pipeline_queue,
+                'PipelineWorker-%s' % len(self._pipeline_worker_threads))
+            worker.start()
+            self._pipeline_worker_threads.append(worker)
+        self._pipeline_worker_failed = False
+        start = time.time()
+        for pipeline in pipelines:
+            self._pipeline_queue.put((pipeline, full))
+        self._pipeline_queue.join()
+        try:
+            if statsd:
+                # timers.zuul.scheduler.pipeline_processing
+                statsd.timing('zuul.scheduler.pipeline_processing',
+                              int((time.time() - start) * 1000))
+        except:
+            self.log.exception("Exception reporting pipeline worker stats")
+        if self._pipeline_worker_failed:
+            raise Exception("Exception processing pipelines")
+
+    def _stopPipelineWorkers(self):
+        for worker in self._pipeline_worker_threads:
+            self._pipeline_queue.put(None)
+        for worker in self._pipeline_worker_threads:
+            worker.join()
+        self._pipeline_worker_threads = []
+
+    def maintainConnectionCache(self, prune=True):
+        self.last_cache_maintenance = time.time()
         relevant = set()
         for pipeline in self.layout.pipelines.values():
             self.log.debug("Gather relevant cache items for: %s" % pipeline)
@@ -1045,7 +1425,7 @@ class Scheduler(threading.Thread):
                 relevant.add(item.change)
                 relevant.update(item.change.getRelatedChanges())
         for connection in self.connections.values():
-            connection.maintainCache(relevant)
+            connection.maintainCache(relevant, prune)
             self.log.debug(
                 "End maintain connection cache for: %s" % connection)
         self.log.debug("Connection cache size: %s" % len(relevant))
@@ -1053,11 +1433,32 @@ class Scheduler(threading.Thread):
     def process_event_queue(self):
         self.log.debug("Fetching trigger event")
         event = self.trigger_event_queue.get()
-        self.log.debug("Processing trigger event %s" % event)
+        key = self._getEventKey(event)
+        with self._pending_events_lock:
+            pending = self._pending_events.get(key, [])
+            if event in pending:
+                pending.remove(event)
+            if not pending:
+                self._pending_events.pop(key, None)
         try:
+            candidates = self.layout.event_filter_index.getFilters(event)
+            pipelines = self.layout.pipelines.values()
+            if event.superseded:
+                # The later patchset removes this one's items from the
+                # pipelines which dequeue on a new patchset, so only
+                # those which keep every patchset still need the event.
+                pipelines = [p for p in pipelines if p in candidates and
+                             not p.dequeue_on_new_patchset]
+                if not pipelines:
+                    self.log.debug("Skipping superseded trigger event %s" %
+                                   event)
+                    self._countEvent('coalesced')
+                    return
+            self._countEvent('processed')
+            self.log.debug("Processing trigger event %s" % event)
             project = self.layout.projects.get(event.project_name)
 
-            for pipeline in self.layout.pipelines.values():
+            for pipeline in pipelines:
                 if not (event.change_number or event.ref):
                     change = NullChange(project)
                 else:
@@ -1076,6 +1477,9 @@ class Scheduler(threading.Thread):
                             "connection trigger)",
                             e.change, pipeline.source)
                         continue
+                # Items which are, or depend on, this change may need to
+                # react to it even if the event does not otherwise apply.
+                pipeline.manager.setChangeDirty(change)
                 if not project or project.foreign:
                     self.log.debug("Project %s not found" % event.project_name)
                     continue
@@ -1083,11 +1487,15 @@ class Scheduler(threading.Thread):
                     pipeline.manager.removeOldVersionsOfChange(change)
                 elif event.isChangeAbandoned():
                     pipeline.manager.removeAbandonedChange(change)
-                if pipeline.manager.eventMatches(event, change):
+                filters = candidates.get(pipeline)
+                if not (filters or event.forced_pipeline):
+                    continue
+                if pipeline.manager.eventMatches(event, change, filters):
                     self.log.info("Adding %s, %s to %s" %
                                   (project, change, pipeline))
                     pipeline.manager.addChange(change)
         finally:
+            self._journalEventDone(event)
             self.trigger_event_queue.task_done()
 
     def process_management_queue(self):
@@ -1140,6 +1548,7 @@ class Scheduler(threading.Thread):
                 build.job.name))
         except Exception:
             self.log.exception("Exception estimating build time:")
+        build.build_set.item.setDirty()
         pipeline.manager.onBuildStarted(event.build)
 
     def _doBuildCompletedEvent(self, event):
@@ -1153,6 +1562,7 @@ class Scheduler(threading.Thread):
             self.log.warning("Build %s is not associated with a pipeline" %
                              (build,))
             return
+        build.build_set.item.setDirty()
         if build.end_time and build.start_time and build.result:
             duration = build.end_time - build.start_time
             try:
@@ -1172,9 +1582,25 @@ class Scheduler(threading.Thread):
             self.log.warning("Build set %s is not associated with a pipeline" %
                              (build_set,))
             return
+        build_set.item.setDirty()
         pipeline.manager.onMergeCompleted(event)
 
+    def getStatusVersion(self):
+        # This changes whenever the output of formatStatusJSON would,
+        # apart from the times of running builds, and is much cheaper
+        # to compute.
+        versions = [self.zuul_version, self.last_reconfigured,
+                    self._pause, self._exit,
+                    self.trigger_event_queue.qsize(),
+                    self.result_event_queue.qsize()]
+        for pipeline in self.layout.pipelines.values():
+            versions.append(pipeline.status_version)
+        return '-'.join([str(v) for v in versions])
+
     def formatStatusJSON(self):
+        return json.dumps(self.formatStatusData())
+
+    def formatStatusData(self):
         if self.config.has_option('zuul', 'url_pattern'):
             url_pattern = self.config.get('zuul', 'url_pattern')
         else:
@@ -1206,7 +1632,7 @@ class Scheduler(threading.Thread):
         data['pipelines'] = pipelines
         for pipeline in self.layout.pipelines.values():
             pipelines.append(pipeline.formatStatusJSON(url_pattern))
-        return json.dumps(data)
+        return data
 
 
 class BasePipelineManager(object):
@@ -1283,7 +1709,7 @@ class BasePipelineManager(object):
             allow_needs.update(action_reporter.getSubmitAllowNeeds())
         return allow_needs
 
-    def eventMatches(self, event, change):
+    def eventMatches(self, event, change, filters=None):
         if event.forced_pipeline:
             if event.forced_pipeline == self.pipeline.name:
                 self.log.debug("Event %s for change %s was directly assigned "
@@ -1291,7 +1717,9 @@ class BasePipelineManager(object):
                 return True
             else:
                 return False
-        for ef in self.event_filters:
+        if filters is None:
+            filters = self.event_filters
+        for ef in filters:
             if ef.matches(event, change):
                 self.log.debug("Event %s for change %s matched %s "
                                "in pipeline %s" % (event, change, ef, self))
@@ -1318,7 +1746,8 @@ class BasePipelineManager(object):
                 self.log.info("Reporting start, action %s item %s" %
                               (self.pipeline.start_actions, item))
                 ret = self.sendReport(self.pipeline.start_actions,
-                                      self.pipeline.source, item)
+                                      self.pipeline.source, item,
+                                      wait=False)
                 if ret:
                     self.log.error("Reporting item start %s received: %s" %
                                    (item, ret))
@@ -1326,18 +1755,23 @@ class BasePipelineManager(object):
                 self.log.exception("Exception while reporting start:")
 
     def sendReport(self, action_reporters, source, item,
-                   message=None):
+                   message=None, wait=True):
         """Sends the built message off to configured reporters.
 
         Takes the action_reporters, item, message and extra options and
-        sends them to the pluggable reporters.
+        sends them to the pluggable reporters.  Unless wait is set the
+        reports are sent in the background, and their errors are only
+        logged.
         """
         report_errors = []
         if len(action_reporters) > 0:
-            for reporter in action_reporters:
-                ret = reporter.report(source, self.pipeline, item)
-                if ret:
-                    report_errors.append(ret)
+            dispatcher = self.sched.report_dispatcher
+            requests = [dispatcher.submit(reporter, source, self.pipeline,
+                                          item)
+                        for reporter in action_reporters]
+            if not wait:
+                return
+            report_errors = dispatcher.wait(requests)
             if len(report_errors) == 0:
                 return
         return report_errors
@@ -1376,6 +1810,25 @@ class BasePipelineManager(object):
                 return item
         return None
 
+    def setChangeDirty(self, change):
+        # Mark any queue holding this change, or a change related to
+        # it, as needing to be processed.
+        if getattr(change, 'number', None) is None:
+            return
+        numbers = set([change.number])
+        numbers.update([c.number for c in change.getRelatedChanges()])
+        for queue in self.pipeline.queues:
+            if queue.dirty:
+                continue
+            for item in queue.queue:
+                if getattr(item.change, 'number', None) in numbers:
+                    queue.dirty = True
+                    break
+                needs_changes = getattr(item.change, 'needs_changes', [])
+                if [c for c in needs_changes if c.number in numbers]:
+                    queue.dirty = True
+                    break
+
     def findOldVersionOfChangeAlreadyInQueue(self, change):
         for item in self.pipeline.getAllItems():
             if not item.live:
@@ -1475,6 +1928,7 @@ class BasePipelineManager(object):
             if enqueue_time:
                 item.enqueue_time = enqueue_time
             item.live = live
+            item.bumpStatusVersion()
             self.reportStats(item)
             if not quiet:
                 if len(self.pipeline.start_actions) > 0:
@@ -1547,9 +2001,11 @@ class BasePipelineManager(object):
         else:
             self.log.debug("Preparing update repo for: %s" % item.change)
             url = self.pipeline.source.getGitUrl(item.change.project)
+            connection_name = self.pipeline.source.connection.connection_name
             self.sched.merger.updateRepo(item.change.project.name,
                                          url, build_set,
-                                         self.pipeline.precedence)
+                                         self.pipeline.precedence,
+                                         connection_name)
         # merge:merge has been emitted properly:
         build_set.merge_state = build_set.PENDING
         return False
@@ -1620,7 +2076,9 @@ class BasePipelineManager(object):
             return (True, nnfi)
         dep_items = self.getFailingDependentItems(item)
         actionable = change_queue.isActionable(item)
-        item.active = actionable
+        if item.active != actionable:
+            item.active = actionable
+            item.bumpStatusVersion()
         ready = False
         if dep_items:
             failing_reasons.append('a needed change is failing')
@@ -1667,26 +2125,41 @@ class BasePipelineManager(object):
             changed = True
         elif not failing_reasons and item.live:
             nnfi = item
-        item.current_build_set.failing_reasons = failing_reasons
+        if item.current_build_set.failing_reasons != failing_reasons:
+            item.current_build_set.failing_reasons = failing_reasons
+            item.bumpStatusVersion()
         if failing_reasons:
             self.log.debug("%s is a failing item because %s" %
                            (item, failing_reasons))
         return (changed, nnfi)
 
-    def processQueue(self):
-        # Do whatever needs to be done for each change in the queue
-        self.log.debug("Starting queue processor: %s" % self.pipeline.name)
+    def processQueue(self, full=False):
+        # Do whatever needs to be done for each change in the dirty
+        # queues (or every queue if full is set)
+        self.log.debug("Starting queue processor: %s (full: %s)" %
+                       (self.pipeline.name, full))
         changed = False
+        processed_items = 0
         for queue in self.pipeline.queues:
+            if not (full or queue.dirty):
+                continue
+            queue.dirty = False
             queue_changed = False
             nnfi = None  # Nearest non-failing item
-            for item in queue.queue[:]:
-                item_changed, nnfi = self._processOneItem(
-                    item, nnfi)
-                if item_changed:
-                    queue_changed = True
-                self.reportStats(item)
+            queue.holding_cache = {}
+            try:
+                for item in queue.queue[:]:
+                    item_changed, nnfi = self._processOneItem(
+                        item, nnfi)
+                    processed_items += 1
+                    if item_changed:
+                        queue_changed = True
+                    self.reportStats(item)
+            finally:
+                queue.holding_cache = None
             if queue_changed:
+                # Process it again until it settles.
+                queue.dirty = True
                 changed = True
                 status = ''
                 for item in queue.queue:
@@ -1694,8 +2167,16 @@ class BasePipelineManager(object):
                 if status:
                     self.log.debug("Queue %s status is now:\n %s" %
                                    (queue.name, status))
-        self.log.debug("Finished queue processor: %s (changed: %s)" %
-                       (self.pipeline.name, changed))
+        self.log.debug("Finished queue processor: %s (changed: %s, "
+                       "items: %s)" %
+                       (self.pipeline.name, changed, processed_items))
+        try:
+            if statsd and processed_items:
+                # stats_counts.zuul.pipeline.NAME.processed_items
+                key = 'zuul.pipeline.%s.processed_items' % self.pipeline.name
+                statsd.incr(key, processed_items)
+        except:
+            self.log.exception("Exception reporting queue processor stats")
         return changed
 
     def updateBuildDescriptions(self, build_set):
@@ -1727,6 +2208,7 @@ class BasePipelineManager(object):
         item = build.build_set.item
 
         self.pipeline.setResult(item, build)
+        # Releasing the mutex wakes up the items waiting for it
         self.sched.mutex.release(item, build.job)
         self.log.debug("Item %s status is now:\n %s" %
                        (item, item.formatStatus()))
@@ -1809,7 +2291,10 @@ class BasePipelineManager(object):
             try:
                 self.log.info("Reporting item %s, actions: %s" %
                               (item, actions))
-                ret = self.sendReport(actions, self.pipeline.source, item)
+                # Only wait for the report if the change can't leave
+                # the queue until it has merged.
+                ret = self.sendReport(actions, self.pipeline.source, item,
+                                      wait=self.changes_merge)
                 if ret:
                     self.log.error("Reporting item %s received: %s" %
                                    (item, ret))
@@ -15,10 +15,15 @@
 import logging
 import re
 import time
+
+import extras
+
 from zuul import exceptions
 from zuul.model import Change, Ref
 from zuul.source import BaseSource
 
+statsd = extras.try_import('statsd.statsd')
+
 
 # Walk the change dependency tree to find a cycle
 def detect_cycle(change, history=None):
@@ -34,6 +39,87 @@ def detect_cycle(change, history=None):
         detect_cycle(dep, history)
 
 
+# Change-Ids are an I followed by lower case hex, but Depends-On
+# headers are matched regardless of case, so compare them in this form.
+def normalize_change_id(change_id):
+    return 'I' + change_id[1:].lower()
+
+
+class ChangeQueryBatch(object):
+    """The query results needed to update a change and its dependencies.
+
+    They are fetched ahead of time, breadth-first, a level of the
+    dependency graph at a time; anything which wasn't is queried when
+    it is asked for.  Counts the queries run.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.changes = {}  # number -> query data
+        # Keyed by normalized Change-Id
+        self.depends_on = {}  # Change-Id -> [simple query record]
+        self.needed_by = {}  # Change-Id -> [simple query record]
+        self.queries = 0
+
+    def fetchChanges(self, numbers):
+        numbers = [n for n in numbers if n not in self.changes]
+        if not numbers:
+            return []
+        self.queries += 1
+        found = []
+        for data in self.connection.queryChanges(numbers):
+            self.changes[str(data['number'])] = data
+            found.append(data)
+        return found
+
+    def fetchRecords(self, depends_on_ids, needed_by_ids):
+        # The Change-Ids in commit messages, and the changes whose
+        # commit messages mention a Change-Id, in (at most) two
+        # queries made at once.
+        queries = []
+        if depends_on_ids:
+            queries.append(' OR '.join(['change:%s' % i
+                                        for i in depends_on_ids]))
+        if needed_by_ids:
+            queries.append(' OR '.join(['message:%s' % i
+                                        for i in needed_by_ids]))
+        if not queries:
+            return
+        self.queries += 1
+        results = self.connection.simpleQueries(queries)
+        if depends_on_ids:
+            for change_id in depends_on_ids:
+                self.depends_on[change_id] = []
+            for record in results.pop(0):
+                change_id = normalize_change_id(record['id'])
+                if change_id in self.depends_on:
+                    self.depends_on[change_id].append(record)
+        if needed_by_ids:
+            for change_id in needed_by_ids:
+                self.needed_by[change_id] = []
+            for record in results.pop(0):
+                for match in set(map(
+                        normalize_change_id,
+                        GerritSource.depends_on_re.findall(
+                            record['commitMessage']))):
+                    if match in self.needed_by:
+                        self.needed_by[match].append(record)
+
+    def query(self, number):
+        data = self.changes.get(str(number))
+        if data is None:
+            self.queries += 1
+            data = self.connection.query(number)
+        return data
+
+    def simpleQuery(self, query, cache, change_id):
+        change_id = normalize_change_id(change_id)
+        if change_id in cache:
+            return cache[change_id]
+        self.queries += 1
+        return self.connection.simpleQuery(query)
+
+
 class GerritSource(BaseSource):
     name = 'gerrit'
     log = logging.getLogger("zuul.source.Gerrit")
@@ -42,6 +128,8 @@ class GerritSource(BaseSource):
 
     depends_on_re = re.compile(r"^Depends-On: (I[0-9a-f]{40})\s*$",
                                re.MULTILINE | re.IGNORECASE)
+    # The most changes to fetch in one query
+    batch_size = 50
 
     def getRefSha(self, project, ref):
         refs = {}
@@ -157,9 +245,10 @@ class GerritSource(BaseSource):
             change.url = self._getGitwebUrl(project, sha=event.newrev)
         return change
 
-    def _getChange(self, number, patchset, refresh=False, history=None):
+    def _getChange(self, number, patchset, refresh=False, history=None,
+                   batch=None):
         key = '%s,%s' % (number, patchset)
-        change = self.connection.getCachedChange(key)
+        change = self.connection.change_cache.get(key)
         if change and not refresh:
             return change
         if not change:
@@ -168,14 +257,93 @@ class GerritSource(BaseSource):
             change.number = number
             change.patchset = patchset
         key = '%s,%s' % (change.number, change.patchset)
-        self.connection.updateChangeCache(key, change)
+        self.connection.change_cache.set(key, change)
+        top = batch is None
+        if top:
+            batch = self._fetchDependencies(number)
         try:
-            self._updateChange(change, history)
+            self._updateChange(change, history, batch)
         except Exception:
-            self.connection.deleteCachedChange(key)
+            self.connection.change_cache.delete(key)
             raise
+        if top:
+            self._reportQueries(change, batch)
         return change
 
+    def _isCached(self, number, patchset):
+        return '%s,%s' % (number, patchset) in self.connection.change_cache
+
+    def _fetchDependencies(self, number):
+        # Fetch everything _updateChange will look at, starting with
+        # the change itself and working outwards a level at a time so
+        # that each level takes a few batched queries.  As in
+        # _updateChange, the dependencies of merged changes, and
+        # changes already in the cache (unless they need to be
+        # refreshed), aren't followed.
+        batch = ChangeQueryBatch(self.connection)
+        seen = set()
+        frontier = [str(number)]
+        while frontier:
+            seen.update(frontier)
+            found = []
+            for i in range(0, len(frontier), self.batch_size):
+                found += batch.fetchChanges(
+                    frontier[i:i + self.batch_size])
+            frontier = []
+
+            def follow(number, patchset, refresh=False):
+                number = str(number)
+                if number in seen or number in frontier:
+                    return
+                if not refresh and self._isCached(number, patchset):
+                    return
+                frontier.append(number)
+
+            depends_on_ids = []
+            needed_by_ids = []
+            for data in found:
+                if 'project' not in data or data.get('status') == 'MERGED':
+                    continue
+                for dep in data.get('dependsOn', [])[:1]:
+                    parts = dep['ref'].split('/')
+                    follow(parts[3], parts[4])
+                for needed in data.get('neededBy', []):
+                    parts = needed['ref'].split('/')
+                    follow(parts[3], parts[4])
+                for match in self.depends_on_re.findall(
+                        data.get('commitMessage', '')):
+                    match = normalize_change_id(match)
+                    if (match not in depends_on_ids and
+                        match not in batch.depends_on):
+                        depends_on_ids.append(match)
+                change_id = normalize_change_id(data['id'])
+                if change_id not in batch.needed_by:
+                    needed_by_ids.append(change_id)
+            batch.fetchRecords(depends_on_ids, needed_by_ids)
+            for change_id in depends_on_ids:
+                for record in batch.depends_on[change_id]:
+                    follow(record['number'],
+                           record['currentPatchSet']['number'])
+            for change_id in needed_by_ids:
+                for record in batch.needed_by[change_id]:
+                    # Commit needed-by changes are always refreshed
+                    follow(record['number'],
+                           record['currentPatchSet']['number'],
+                           refresh=True)
+        return batch
+
+    def _reportQueries(self, change, batch):
+        self.log.debug("Updating %s took %s queries" %
+                       (change, batch.queries))
+        try:
+            if statsd:
+                # counters.zuul.connection.CONNECTION.update_queries
+                statsd.incr('zuul.connection.%s.update_queries' %
+                            self.connection.connection_name,
+                            batch.queries)
+        except:
+            self.log.exception("Exception reporting query stats")
+
     def getProjectOpenChanges(self, project):
         # This is a best-effort function in case Gerrit is unable to return
         # a particular change.  It happens.
@@ -194,10 +362,11 @@ class GerritSource(BaseSource):
                                    (record.get('number'),))
         return changes
 
-    def _getDependsOnFromCommit(self, message, change):
+    def _getDependsOnFromCommit(self, message, change, batch):
         records = []
         seen = set()
         for match in self.depends_on_re.findall(message):
+            match = normalize_change_id(match)
             if match in seen:
                 self.log.debug("Ignoring duplicate Depends-On: %s" %
                                (match,))
@@ -207,21 +376,23 @@ class GerritSource(BaseSource):
             self.log.debug("Updating %s: Running query %s "
                            "to find needed changes" %
                            (change, query,))
-            records.extend(self.connection.simpleQuery(query))
+            records.extend(batch.simpleQuery(query, batch.depends_on,
+                                             match))
         return records
 
-    def _getNeededByFromCommit(self, change_id, change):
+    def _getNeededByFromCommit(self, change_id, change, batch):
+        change_id = normalize_change_id(change_id)
         records = []
         seen = set()
         query = 'message:%s' % change_id
         self.log.debug("Updating %s: Running query %s "
                        "to find changes needed-by" %
                        (change, query,))
-        results = self.connection.simpleQuery(query)
+        results = batch.simpleQuery(query, batch.needed_by, change_id)
         for result in results:
             for match in self.depends_on_re.findall(
                 result['commitMessage']):
-                if match != change_id:
+                if normalize_change_id(match) != change_id:
                     continue
                 key = (result['number'], result['currentPatchSet']['number'])
                 if key in seen:
@@ -233,9 +404,11 @@ class GerritSource(BaseSource):
                 records.append(result)
         return records
 
-    def _updateChange(self, change, history=None):
+    def _updateChange(self, change, history=None, batch=None):
         self.log.info("Updating %s" % (change,))
-        data = self.connection.query(change.number)
+        if batch is None:
+            batch = ChangeQueryBatch(self.connection)
+        data = batch.query(change.number)
         change._data = data
 
         if change.patchset is None:
@@ -288,7 +461,8 @@ class GerritSource(BaseSource):
                     dep_num, history))
             self.log.debug("Updating %s: Getting git-dependent change %s,%s" %
                            (change, dep_num, dep_ps))
-            dep = self._getChange(dep_num, dep_ps, history=history)
+            dep = self._getChange(dep_num, dep_ps, history=history,
+                                  batch=batch)
             # Because we are not forcing a refresh in _getChange, it
             # may return without executing this code, so if we are
             # updating our change to add ourselves to a dependency
@@ -299,7 +473,7 @@ class GerritSource(BaseSource):
                 needs_changes.append(dep)
 
         for record in self._getDependsOnFromCommit(data['commitMessage'],
-                                                   change):
+                                                   change, batch):
             dep_num = record['number']
             dep_ps = record['currentPatchSet']['number']
             if dep_num in history:
@@ -308,7 +482,8 @@ class GerritSource(BaseSource):
             self.log.debug("Updating %s: Getting commit-dependent "
                            "change %s,%s" %
                            (change, dep_num, dep_ps))
-            dep = self._getChange(dep_num, dep_ps, history=history)
+            dep = self._getChange(dep_num, dep_ps, history=history,
+                                  batch=batch)
             # Because we are not forcing a refresh in _getChange, it
             # may return without executing this code, so if we are
             # updating our change to add ourselves to a dependency
@@ -326,11 +501,12 @@ class GerritSource(BaseSource):
                 dep_num, dep_ps = parts[3], parts[4]
                 self.log.debug("Updating %s: Getting git-needed change %s,%s" %
                                (change, dep_num, dep_ps))
-                dep = self._getChange(dep_num, dep_ps)
+                dep = self._getChange(dep_num, dep_ps, batch=batch)
                 if (not dep.is_merged) and dep.is_current_patchset:
                     needed_by_changes.append(dep)
 
-        for record in self._getNeededByFromCommit(data['id'], change):
+        for record in self._getNeededByFromCommit(data['id'], change,
+                                                  batch):
             dep_num = record['number']
             dep_ps = record['currentPatchSet']['number']
             self.log.debug("Updating %s: Getting commit-needed change %s,%s" %
@@ -339,7 +515,8 @@ class GerritSource(BaseSource):
             # dependency, cause that change to refresh so that it will
             # reference the latest patchset of its Depends-On (this
             # change).
-            dep = self._getChange(dep_num, dep_ps, refresh=True)
+            dep = self._getChange(dep_num, dep_ps, refresh=True,
+                                  batch=batch)
             if (not dep.is_merged) and dep.is_current_patchset:
                 needed_by_changes.append(dep)
         change.needed_by_changes = needed_by_changes
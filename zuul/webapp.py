@@ -13,7 +13,11 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import copy
+import calendar
+import collections
+import gzip
+import hashlib
+import io
 import json
 import logging
 import re
@@ -34,18 +38,75 @@ The supported urls are:
    queue / pipeline structure of the system
  - /status.json (backwards compatibility): same as /status
  - /status/change/X,Y: return status just for gerrit change X,Y
+ - /status/changes?ids=X,Y&ids=...: return status for several changes
+ - /status/pipeline/NAME: return status just for pipeline NAME
+ - /status/stream: a stream of Server-Sent Events, see below
 
 When returning status for a single gerrit change you will get an
-array of changes, they will not include the queue structure.
+array of changes, they will not include the queue structure.  When
+asking for several changes you will get an object mapping each change
+id to such an array.
+
+Responses carry an ETag and Last-Modified time which only change when
+the status does, so clients which send If-None-Match or
+If-Modified-Since get a 304 response if nothing has changed since
+their last request.  Responses are sent gzip compressed to clients
+which accept it, with an ETag of their own.
+
+The stream starts with a 'snapshot' event holding the same data as
+/status, followed by events describing the changes to it as they
+happen:
+
+ - item_enqueued: {pipeline, change} where change is as in /status
+ - item_updated: {pipeline, id, change} with only the changed fields
+ - item_dequeued: {pipeline, id}
+ - build_started, build_completed, build_updated: {pipeline, id, job}
+
+The elapsed and remaining times are not updated by events, clients
+can work them out from the start and estimated times.  The stream is
+closed after a while; when the client reconnects with a Last-Event-ID
+header it receives the events it missed rather than a new snapshot, as
+long as they are still held.  Each stream takes one of the web
+server's threads while it is open, so only max_streams are allowed at
+once, leaving the other threads for the rest of the requests; further
+streams get a 503 response.
 """
 
 
+class Stream(object):
+    """The body of a stream response, which frees its slot when the
+    server closes it."""
+
+    def __init__(self, webapp, events):
+        self.webapp = webapp
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.events.close()
+        self.webapp._release_stream()
+
+
 class WebApp(threading.Thread):
     log = logging.getLogger("zuul.WebApp")
     change_path_regexp = '/status/change/(.*)$'
+    changes_path_regexp = '/status/changes$'
+    pipeline_path_regexp = '/status/pipeline/(.*)$'
+    # How many stream events to keep for reconnecting clients
+    event_history = 1000
+    # How long to keep a stream open for, and how often to send
+    # something on an otherwise idle stream
+    stream_timeout = 300
+    stream_keepalive = 15
 
     def __init__(self, scheduler, port=8001, cache_expiry=1,
-                 listen_address='0.0.0.0'):
+                 listen_address='0.0.0.0', threads=10, max_streams=5):
         threading.Thread.__init__(self)
         self.scheduler = scheduler
         self.listen_address = listen_address
@@ -53,21 +114,54 @@ class WebApp(threading.Thread):
         self.cache_expiry = cache_expiry
         self.cache_time = 0
         self.cache = None
+        self.cache_version = None
+        self.cache_generation = 0
+        self.cache_etag = None
+        self.cache_modified = 0
+        self.cache_gzip = None
+        self.cache_lock = threading.Lock()
+        # Indexes into the cached status, rebuilt whenever it is
+        self.cache_changes = {}  # change id -> [change status]
+        self.cache_pipelines = {}  # pipeline name -> pipeline status
+        self.cache_items = {}  # (pipeline name, change id) -> status
+        # Stream events, as (id, event, data) tuples
+        self.events = collections.deque(maxlen=self.event_history)
+        self.event_id = 0
+        self.event_condition = threading.Condition()
+        # Open streams; while there are any, the refresh thread keeps
+        # the status and its events up to date for all of them.
+        self.max_streams = max_streams
+        self.streams = 0
+        self.stream_condition = threading.Condition()
+        self.refresh_thread = threading.Thread(target=self._refresh_streams)
+        self.refresh_thread.daemon = True
+        self.stopped = False
         self.daemon = True
         self.routes = {}
         self._init_default_routes()
         self.server = httpserver.serve(
             dec.wsgify(self.app), host=self.listen_address, port=self.port,
-            start_loop=False)
+            start_loop=False, threadpool_workers=threads)
 
     def _init_default_routes(self):
         self.register_path('/(status\.json|status)$', self.status)
         self.register_path(self.change_path_regexp, self.change)
+        self.register_path(self.changes_path_regexp, self.changes)
+        self.register_path(self.pipeline_path_regexp, self.pipeline)
+        self.register_path('/status/stream$', self.stream)
 
     def run(self):
+        self.refresh_thread.start()
         self.server.serve_forever()
 
     def stop(self):
+        with self.event_condition:
+            self.stopped = True
+            self.event_condition.notify_all()
+        with self.stream_condition:
+            self.stream_condition.notify_all()
+        if self.refresh_thread.is_alive():
+            self.refresh_thread.join()
         self.server.server_close()
 
     def _changes_by_func(self, func):
@@ -79,20 +173,101 @@ class WebApp(threading.Thread):
         is a flattened list of those collected changes.
         """
         status = []
-        jsonstruct = json.loads(self.cache)
-        for pipeline in jsonstruct['pipelines']:
-            for change_queue in pipeline['change_queues']:
-                for head in change_queue['heads']:
-                    for change in head:
-                        if func(change):
-                            status.append(copy.deepcopy(change))
+        for changes in self.cache_changes.values():
+            for change in changes:
+                if func(change):
+                    status.append(change)
         return json.dumps(status)
 
     def _status_for_change(self, rev):
         """Return the statuses for a particular change id X,Y."""
-        def func(change):
-            return change['id'] == rev
-        return self._changes_by_func(func)
+        changes = self.cache_changes.get(rev)
+        if changes:
+            return json.dumps(changes)
+        return json.dumps([])
+
+    def _index_status(self, data, diff):
+        changes = {}
+        pipelines = {}
+        items = {}
+        for pipeline in data['pipelines']:
+            pipelines[pipeline['name']] = pipeline
+            for change_queue in pipeline['change_queues']:
+                for head in change_queue['heads']:
+                    for change in head:
+                        changes.setdefault(change['id'], []).append(change)
+                        items[(pipeline['name'], change['id'])] = change
+        if diff:
+            self._add_events(self._diff_status(self.cache_items, items))
+        self.cache_changes = changes
+        self.cache_pipelines = pipelines
+        self.cache_items = items
+
+    def _diff_status(self, old_items, new_items):
+        """Return the stream events describing the changes between two
+        sets of indexed items."""
+        events = []
+        for key, change in new_items.items():
+            pipeline, change_id = key
+            old_change = old_items.get(key)
+            if old_change is None:
+                events.append(('item_enqueued',
+                               dict(pipeline=pipeline, change=change)))
+                continue
+            if old_change is change:
+                # The scheduler reused the item's cached status
+                continue
+            updated = {}
+            for k, v in change.items():
+                if k not in ('jobs', 'remaining_time') and \
+                        old_change.get(k) != v:
+                    updated[k] = v
+            if updated:
+                events.append(('item_updated',
+                               dict(pipeline=pipeline, id=change_id,
+                                    change=updated)))
+            old_jobs = dict([(j['name'], j) for j in old_change['jobs']])
+            for job in change['jobs']:
+                old_job = old_jobs.get(job['name'], {})
+                if job['result'] != old_job.get('result') and job['result']:
+                    event = 'build_completed'
+                elif (job['start_time'] != old_job.get('start_time') and
+                      job['start_time']):
+                    event = 'build_started'
+                elif (job['uuid'] != old_job.get('uuid') or
+                      job['result'] != old_job.get('result')):
+                    event = 'build_updated'
+                else:
+                    continue
+                events.append((event, dict(pipeline=pipeline, id=change_id,
+                                           job=job)))
+        for key in old_items:
+            if key not in new_items:
+                pipeline, change_id = key
+                events.append(('item_dequeued',
+                               dict(pipeline=pipeline, id=change_id)))
+        return events
+
+    def _add_events(self, events):
+        if not events:
+            return
+        with self.event_condition:
+            for event, data in events:
+                self.event_id += 1
+                self.events.append((self.event_id, event, json.dumps(data)))
+            self.event_condition.notify_all()
+
+    def _events_since(self, event_id):
+        """Return the events after event_id, or None if some of them
+        are no longer held."""
+        with self.event_condition:
+            if event_id > self.event_id:
+                return None
+            if event_id == self.event_id:
+                return []
+            if not self.events or self.events[0][0] > event_id + 1:
+                return None
+            return [e for e in self.events if e[0] > event_id]
 
     def register_path(self, path, handler):
         path_re = re.compile(path)
@@ -109,11 +284,36 @@ class WebApp(threading.Thread):
         else:
             raise webob.exc.HTTPNotFound()
 
+    def _accepts_gzip(self, request):
+        # A missing Accept-Encoding header technically allows any
+        # encoding, but not every client copes with one, so only
+        # compress when gzip is explicitly accepted.
+        for coding in request.headers.get('Accept-Encoding', '').split(','):
+            params = coding.split(';')
+            if params[0].strip().lower() != 'gzip':
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
     def status(self, request):
         def func():
-            return webob.Response(body=self.cache,
-                                  content_type='application/json')
-        return self._response_with_status_cache(func)
+            if self._accepts_gzip(request):
+                # Compressed along with the cache
+                response = webob.Response(body=self.cache_gzip,
+                                          content_type='application/json')
+                response.content_encoding = 'gzip'
+            else:
+                response = webob.Response(body=self.cache,
+                                          content_type='application/json')
+            return response
+        return self._response_with_status_cache(request, func)
 
     def change(self, request):
         def func():
@@ -125,29 +325,188 @@ class WebApp(threading.Thread):
                                       content_type='application/json')
             else:
                 raise webob.exc.HTTPNotFound()
-        return self._response_with_status_cache(func)
+        return self._response_with_status_cache(request, func)
+
+    def changes(self, request):
+        def func():
+            ids = []
+            for value in request.GET.getall('ids'):
+                ids.extend(value.split())
+            status = {}
+            for change_id in ids:
+                status[change_id] = self.cache_changes.get(change_id, [])
+            return webob.Response(body=json.dumps(status),
+                                  content_type='application/json')
+        return self._response_with_status_cache(request, func)
+
+    def pipeline(self, request):
+        def func():
+            m = re.match(self.pipeline_path_regexp, request.path)
+            pipeline = self.cache_pipelines.get(m.group(1))
+            if pipeline is None:
+                raise webob.exc.HTTPNotFound()
+            return webob.Response(body=json.dumps(pipeline),
+                                  content_type='application/json')
+        return self._response_with_status_cache(request, func)
+
+    def stream(self, request):
+        with self.stream_condition:
+            if self.streams >= self.max_streams:
+                response = webob.exc.HTTPServiceUnavailable()
+                response.retry_after = self.stream_keepalive
+                return response
+            self.streams += 1
+            self.stream_condition.notify_all()
+        try:
+            self._refresh_status_cache()
+            last_event_id = request.headers.get('Last-Event-ID')
+            try:
+                last_event_id = int(last_event_id)
+            except (TypeError, ValueError):
+                last_event_id = None
+            body = Stream(self, self._stream(last_event_id))
+        except:
+            self._release_stream()
+            raise
+        response = webob.Response(content_type='text/event-stream',
+                                  app_iter=body)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.cache_control.no_cache = True
+        return response
+
+    def _release_stream(self):
+        with self.stream_condition:
+            self.streams -= 1
+
+    def _refresh_streams(self):
+        # Refresh the status for all the open streams at once, so that
+        # each change to it is diffed once, however many clients are
+        # listening.
+        while True:
+            with self.stream_condition:
+                while not self.streams and not self.stopped:
+                    self.stream_condition.wait()
+                if self.stopped:
+                    return
+            try:
+                self._refresh_status_cache()
+            except Exception:
+                # Already logged
+                pass
+            with self.stream_condition:
+                if not self.stopped:
+                    self.stream_condition.wait(self.cache_expiry)
+
+    def _format_event(self, event_id, event, data):
+        return 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, event, data)
+
+    def _stream(self, last_event_id):
+        events = None
+        if last_event_id is not None:
+            events = self._events_since(last_event_id)
+        if events is None:
+            # Events are only added while the cache is locked
+            with self.cache_lock:
+                last_event_id = self.event_id
+                snapshot = self.cache
+            yield self._format_event(last_event_id, 'snapshot', snapshot)
+        else:
+            for event in events:
+                yield self._format_event(*event)
+                last_event_id = event[0]
+        end = time.time() + self.stream_timeout
+        last_sent = time.time()
+        while not self.stopped and time.time() < end:
+            with self.event_condition:
+                if self.event_id == last_event_id and not self.stopped:
+                    self.event_condition.wait(self.stream_keepalive)
+            events = self._events_since(last_event_id)
+            if events is None:
+                # We fell too far behind, start again
+                return
+            for event in events:
+                yield self._format_event(*event)
+                last_event_id = event[0]
+                last_sent = time.time()
+            if time.time() - last_sent > self.stream_keepalive:
+                yield ':\n\n'
+                last_sent = time.time()
 
     def _refresh_status_cache(self):
-        if (not self.cache or
-            (time.time() - self.cache_time) > self.cache_expiry):
+        with self.cache_lock:
+            version = self.scheduler.getStatusVersion()
+            if (self.cache and version == self.cache_version and
+                (time.time() - self.cache_time) <= self.cache_expiry):
+                return
             try:
-                self.cache = self.scheduler.formatStatusJSON()
-                # Call time.time() again because formatting above may take
-                # longer than the cache timeout.
-                self.cache_time = time.time()
+                # Even if the version hasn't changed, the times of
+                # running builds will have, so format it again once the
+                # cache has expired.  Only unchanged items are cheap to
+                # format, so this doesn't cost much.
+                data = self.scheduler.formatStatusData()
+                cache = json.dumps(data)
             except:
                 self.log.exception("Exception formatting status:")
                 raise
+            if cache != self.cache:
+                self.cache_generation += 1
+                self.cache_gzip = self._compress(cache)
+                self.cache = cache
+                self.cache_modified = time.time()
+                # Only the times of running builds change while the
+                # version stays the same, which make no events, so the
+                # items are only diffed once per version.
+                self._index_status(data, version != self.cache_version)
+            self.cache_version = version
+            self.cache_etag = hashlib.md5(
+                '%s/%s' % (version, self.cache_generation)).hexdigest()
+            # Call time.time() again because formatting above may take
+            # longer than the cache timeout.
+            self.cache_time = time.time()
+
+    def _compress(self, body):
+        # The full status is compressed once per change to it rather
+        # than once per request.  A fixed mtime keeps the output
+        # deterministic.
+        buf = io.BytesIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0)
+        f.write(body)
+        f.close()
+        return buf.getvalue()
 
-    def _response_with_status_cache(self, func):
+    def _not_modified(self, request, etag):
+        # If-None-Match takes precedence over If-Modified-Since
+        if request.if_none_match:
+            return etag in request.if_none_match
+        if request.if_modified_since:
+            # HTTP dates only have a resolution of one second
+            return (int(self.cache_modified) <=
+                    calendar.timegm(request.if_modified_since.utctimetuple()))
+        return False
+
+    def _response_with_status_cache(self, request, func):
         self._refresh_status_cache()
 
-        response = func()
+        # The compressed and uncompressed bodies are different
+        # representations, so each needs its own ETag.
+        gzipped = self._accepts_gzip(request)
+        etag = self.cache_etag
+        if gzipped:
+            etag += '-gzip'
+        if self._not_modified(request, etag):
+            response = webob.exc.HTTPNotModified()
+        else:
+            response = func()
+            if gzipped and not response.content_encoding:
+                response.body = self._compress(response.body)
+                response.content_encoding = 'gzip'
+        response.etag = etag
+        response.vary = ('Accept-Encoding',)
 
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.cache_control.public = True
         response.cache_control.max_age = self.cache_expiry
-        response.last_modified = self.cache_time
+        response.last_modified = self.cache_modified
         response.expires = self.cache_time + self.cache_expiry
 
         return response.conditional_response_app